@@ -0,0 +1,136 @@
+# coding=utf-8
+
+# Background acquisition for the FMR sweeps.
+#
+# The instrument loop runs in a SweepWorker thread and only pushes small
+# notifications (e.g. "point n is measured") into a bounded queue; the data
+# itself lives in the preallocated result containers. The live figure drains
+# the queue from a GUI timer, so slow drawing never delays the next setpoint.
+#
+# Usage :
+#     def acquire(worker):
+#         for i, p in enumerate(points):
+#             if worker.stopping:
+#                 break
+#             ...measure...
+#             worker.put(i + 1)
+#     run_with_live_figure(acquire, on_items, fig)
+
+import queue
+import threading
+
+__all__ = ['SweepWorker', 'run_with_live_figure']
+
+
+class SweepWorker(object):
+    '''
+    Runs an acquisition function in a background thread.
+
+    Parameters:
+    maxsize (int): Size of the notification queue.
+
+    The acquisition function gets the worker as its only argument, must check
+    worker.stopping between points and report progress with worker.put().
+    Exceptions raised in the thread are re-raised by join().
+    '''
+
+    def __init__(self, maxsize=256):
+        self.queue = queue.Queue(maxsize)
+        self.dropped = 0
+        self.error = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self, acquire):
+        self._thread = threading.Thread(target=self._run, args=(acquire,),
+                                        name='SweepWorker', daemon=True)
+        self._thread.start()
+
+    def _run(self, acquire):
+        try:
+            acquire(self)
+        except BaseException as E:
+            self.error = E
+
+    @property
+    def stopping(self):
+        '''True once stop() was called, the acquisition should end after the current point'''
+        return self._stop.is_set()
+
+    def stop(self):
+        '''Asks the acquisition to stop after the current point'''
+        self._stop.set()
+
+    def is_alive(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def put(self, item, block=False):
+        '''
+        Queues a notification. With block=False a full queue drops the item,
+        so consumers should only rely on the latest one (e.g. a point count).
+        '''
+        if block:
+            self.queue.put(item)
+            return
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            self.dropped += 1
+
+    def drain(self):
+        '''Returns (and removes) every queued item'''
+        items = []
+        while True:
+            try:
+                items.append(self.queue.get_nowait())
+            except queue.Empty:
+                return items
+
+    def join(self, timeout=None):
+        '''Waits for the thread and re-raises its exception, if any'''
+        if self._thread is not None:
+            self._thread.join(timeout)
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+
+def run_with_live_figure(acquire, on_items, fig, interval=0.05, maxsize=256):
+    '''
+    Runs acquire(worker) in a SweepWorker while fig drains its queue.
+
+    on_items(items) is called from a GUI timer of fig (every interval s)
+    with the notifications queued since the last call (possibly none), and
+    once more after the acquisition ends. The call blocks while running the
+    GUI event loop. Closing the figure or interrupting the kernel stops the
+    acquisition after the current point; the interrupt is then re-raised.
+
+    Returns: the SweepWorker
+    '''
+    worker = SweepWorker(maxsize)
+
+    def drain():
+        items = worker.drain()
+        if items:
+            on_items(items)
+
+    timer = fig.canvas.new_timer(interval=int(interval * 1000))
+    timer.add_callback(drain)
+    close_cid = fig.canvas.mpl_connect('close_event', lambda event: worker.stop())
+    worker.start(acquire)
+    timer.start()
+    try:
+        while worker.is_alive():
+            fig.canvas.start_event_loop(interval)
+            # Non interactive backends have no running timers
+            drain()
+    except KeyboardInterrupt:
+        worker.stop()
+        raise
+    finally:
+        timer.stop()
+        fig.canvas.mpl_disconnect(close_cid)
+        worker._thread.join()
+        drain()
+        worker.join()
+    return worker
@@ -0,0 +1,95 @@
+# coding=utf-8
+
+# Adaptive point placement for 1D sweeps.
+#
+# The sweep first measures a coarse grid. Each interval between neighbouring
+# points then gets a loss: how much the (normalised) signal changes over it
+# plus how far it bends away from a straight line. Intervals above the
+# tolerance are split in two, the worst first, until the point budget is
+# spent, no interval is wider than twice the minimum step or all losses are
+# below tolerance. Flat baseline is left coarse, the resonance gets dense.
+#
+# Usage :
+#     E.sweep_field(9, np.linspace(500, 2500, 41), save_dir,
+#                   adaptive=Refiner(max_points=120, min_step=1))
+
+import numpy as np
+
+__all__ = ['interval_loss', 'Refiner']
+
+
+def interval_loss(x, channels):
+    '''
+    Loss of every interval of the sorted points x.
+
+    Parameters:
+    x (array): Sorted setpoints.
+    channels (list of arrays): Signals at x (e.g. [X, Y]).
+
+    Returns: array of len(x) - 1 losses, the worst channel of each interval.
+        Axes are normalised to their range, so the loss is dimensionless.
+    '''
+    x = np.asarray(x, dtype=float)
+    dx = np.diff(x) / max(np.ptp(x), 1E-300)
+    loss = np.zeros(len(dx))
+    for y in channels:
+        y = np.asarray(y, dtype=float)
+        span = np.ptp(y)
+        if not np.isfinite(span) or span == 0:
+            continue
+        dy = np.diff(y) / span
+        # Change of slope at every inner point, times the interval width
+        # estimates the deviation of the interval from a straight line
+        slope = dy / np.where(dx > 0, dx, np.inf)
+        bend = np.zeros(len(x))
+        bend[1:-1] = np.abs(np.diff(slope))
+        curvature = 0.5 * (bend[:-1] + bend[1:]) * dx
+        loss = np.maximum(loss, np.abs(dy) + curvature)
+    return loss
+
+
+class Refiner(object):
+    '''
+    Chooses where an adaptive sweep measures next.
+
+    Parameters:
+    max_points (int): Point budget of the whole sweep (coarse grid included).
+    min_step (float): Smallest spacing between points, in setpoint units.
+    tolerance (float): Intervals with a lower loss (see interval_loss) are
+        not split. 0.02 ~ 2 % of the signal range.
+    max_passes (int): Maximum number of refinement passes.
+    '''
+
+    def __init__(self, max_points=100, min_step=0.0, tolerance=0.02, max_passes=12):
+        self.max_points = max_points
+        self.min_step = min_step
+        self.tolerance = tolerance
+        self.max_passes = max_passes
+        self.passes = 0
+
+    def __str__(self):
+        return 'Refiner : %d points max, min step %.4g, tolerance %.3g' % (
+            self.max_points, self.min_step, self.tolerance)
+
+    def reset(self):
+        self.passes = 0
+
+    def next_points(self, x, X, Y):
+        '''
+        Setpoints of the next pass (sorted, empty when done), given the
+        measured setpoints x (any order) and signals X, Y.
+        '''
+        x = np.asarray(x, dtype=float)
+        remaining = self.max_points - len(x)
+        if remaining <= 0 or len(x) < 3 or self.passes >= self.max_passes:
+            return np.array([])
+        order = np.argsort(x)
+        xs = x[order]
+        loss = interval_loss(xs, [np.asarray(X)[order], np.asarray(Y)[order]])
+        splittable = (np.diff(xs) >= 2 * self.min_step) & (loss > self.tolerance)
+        worst = np.nonzero(splittable)[0]
+        worst = worst[np.argsort(loss[worst])[::-1]][:remaining]
+        if not len(worst):
+            return np.array([])
+        self.passes += 1
+        return np.sort(0.5 * (xs[worst] + xs[worst + 1]))
@@ -0,0 +1,166 @@
+# coding=utf-8
+
+# Batch resonance extraction from saved sweeps.
+#
+# analyze_directory() reads every sweep CSV of a directory (only the swept
+# column and X / Y), smooths the signal and locates the extrema of the
+# derivative line with sub-sample (parabolic) interpolation. The files are
+# spread over a process pool and the results come back as one table.
+#
+# Usage :
+#     table = analyze_directory(r'...\Data\NiFe_2')
+#     plt.plot(table['frequency_ghz'], table['resonance'], 'o')
+
+import os
+import re
+import glob
+import concurrent.futures
+import numpy as np
+import pandas as pd
+
+from filters import Smooth1D
+
+__all__ = ['parse_sweep_name', 'read_sweep', 'map_files', 'extract_line', 'analyze_sweep',
+           'analyze_directory']
+
+_number = r'(-?[\d.]+(?:e[-+]?\d+)?)'
+_field_sweep_name = re.compile(r'freq_' + _number + r'_GHz_field_')
+_frequency_sweep_name = re.compile(r'field_' + _number + r'_Oe_freq_')
+_level_name = re.compile(r'_' + _number + r'_dB')
+
+# Parameter column of the two sweep kinds
+PARAMETERS = {'field_Oe': 'field', 'frequency_ghz': 'frequency'}
+
+
+def parse_sweep_name(path):
+    '''
+    Fixed parameters of a sweep from its file name (as written by
+    sweep_field / sweep_frequency).
+    Returns: dict with frequency_ghz or field_Oe, and level_db (NaN if absent)
+    '''
+    name = os.path.basename(path).replace('\\', '/').split('/')[-1]
+    info = {'frequency_ghz': np.nan, 'field_Oe': np.nan, 'level_db': np.nan}
+    match = _field_sweep_name.search(name)
+    if match:
+        info['frequency_ghz'] = float(match.group(1).rstrip('.'))
+    match = _frequency_sweep_name.search(name)
+    if match:
+        info['field_Oe'] = float(match.group(1).rstrip('.'))
+    match = _level_name.search(name)
+    if match:
+        info['level_db'] = float(match.group(1).rstrip('.'))
+    return info
+
+
+def read_sweep(path, channels=('X', 'Y')):
+    '''
+    Reads only the swept column and channels of a sweep CSV.
+    Returns: sweep kind ('field' / 'frequency'), setpoints, list of channel arrays
+    '''
+    columns = set(PARAMETERS) | set(channels)
+    df = pd.read_csv(path, usecols=lambda name: name in columns)
+    parameter = [name for name in PARAMETERS if name in df.columns][0]
+    return PARAMETERS[parameter], df[parameter].to_numpy(), [df[name].to_numpy() for name in channels]
+
+
+def _map_chunk(function, paths, args):
+    return [function(path, *args) for path in paths]
+
+
+def map_files(function, paths, args=(), processes=None, chunk_size=16):
+    '''
+    [function(path, *args) for path in paths], run in chunks on a process
+    pool (processes=None : one per CPU, 1 : in this process). function must
+    be importable (a module level function).
+    '''
+    chunks = [paths[i:i + chunk_size] for i in range(0, len(paths), chunk_size)]
+    if processes == 1 or len(chunks) <= 1:
+        return _map_chunk(function, paths, args)
+    rows = []
+    with concurrent.futures.ProcessPoolExecutor(processes) as pool:
+        jobs = [pool.submit(_map_chunk, function, chunk, args) for chunk in chunks]
+        for job in jobs:
+            rows.extend(job.result())
+    return rows
+
+
+def _glob_paths(directory, pattern):
+    if isinstance(directory, str):
+        return sorted(glob.glob(os.path.join(directory, pattern)))
+    return list(directory)
+
+
+def _vertex(x, y, i):
+    '''Abscissa of the parabola through the points i-1, i, i+1 (i at the edge : x[i])'''
+    if i == 0 or i == len(x) - 1:
+        return x[i]
+    x0, x1, x2 = x[i - 1:i + 2]
+    y0, y1, y2 = y[i - 1:i + 2]
+    den = (x0 - x1) * (x0 - x2) * (x1 - x2)
+    a = (x2 * (y1 - y0) + x1 * (y0 - y2) + x0 * (y2 - y1)) / den
+    b = (x2**2 * (y0 - y1) + x1**2 * (y2 - y0) + x0**2 * (y1 - y2)) / den
+    if a == 0:
+        return x1
+    return min(max(-b / (2 * a), x0), x2)
+
+
+def extract_line(x, y, smooth=1):
+    '''
+    Resonance of one derivative line y(x), smoothed over -smooth..smooth
+    points first (0 : raw). Smoothing steadies the position but widens the
+    peak to peak linewidth by roughly the kernel width.
+    Returns: resonance (midway between the extrema), peak to peak linewidth,
+        peak to peak amplitude
+    '''
+    order = np.argsort(x)
+    x, y = np.asarray(x, dtype=float)[order], np.asarray(y, dtype=float)[order]
+    keep = np.isfinite(x) & np.isfinite(y)
+    x, y = x[keep], y[keep]
+    if len(x) < 3:
+        return np.nan, np.nan, np.nan
+    if smooth:
+        y = Smooth1D(y, smooth)
+    i_max, i_min = np.argmax(y), np.argmin(y)
+    x_max, x_min = _vertex(x, y, i_max), _vertex(x, y, i_min)
+    return 0.5 * (x_max + x_min), abs(x_max - x_min), y[i_max] - y[i_min]
+
+
+def analyze_sweep(path, channel='both', smooth=1):
+    '''
+    Resonance of one sweep CSV.
+    channel 'X', 'Y' or 'both' (mean of the X and Y results, like get_midpoint).
+    Returns: dict (one table row)
+    '''
+    row = {'file': path}
+    row.update(parse_sweep_name(path))
+    try:
+        channels = ['X', 'Y'] if channel == 'both' else [channel]
+        kind, x, ys = read_sweep(path, channels)
+        lines = np.array([extract_line(x, y, smooth) for y in ys])
+        resonance, linewidth, amplitude = lines.mean(axis=0)
+        row.update({'sweep': kind, 'resonance': resonance,
+                    'linewidth_pp': linewidth, 'amplitude': amplitude, 'points': len(x), 'error': ''})
+    except Exception as E:
+        row.update({'sweep': '', 'resonance': np.nan, 'linewidth_pp': np.nan,
+                    'amplitude': np.nan, 'points': 0, 'error': repr(E)})
+    return row
+
+
+def analyze_directory(directory, pattern='*.csv', channel='both', smooth=1, processes=None,
+                      chunk_size=16):
+    '''
+    Analyzes every sweep CSV matching pattern in directory (or a list of
+    paths) with analyze_sweep, on a pool of processes (None = one per CPU,
+    1 = in this process).
+
+    Returns: DataFrame, one row per file sorted by the fixed parameter, with
+        file, sweep ('field' / 'frequency'), frequency_ghz, field_Oe,
+        level_db, resonance (Oe or GHz), linewidth_pp, amplitude, points and
+        error (empty if the file was read)
+    '''
+    rows = map_files(analyze_sweep, _glob_paths(directory, pattern), (channel, smooth),
+                     processes, chunk_size)
+    columns = ['file', 'sweep', 'frequency_ghz', 'field_Oe', 'level_db', 'resonance',
+               'linewidth_pp', 'amplitude', 'points', 'error']
+    table = pd.DataFrame(rows, columns=columns)
+    return table.sort_values(['frequency_ghz', 'field_Oe'], kind='stable').reset_index(drop=True)
@@ -0,0 +1,118 @@
+# coding=utf-8
+
+# Acquisition throughput benchmarks on the simulated rack (sim_backend.py).
+#
+# Runs the Experiment sweep entry points against simulated instruments with a
+# given bus latency and reports points per second and bus round trips per
+# point, so changes to the acquisition loop can be compared without the lab.
+#
+# Usage :
+#     python benchmark.py
+#     python benchmark.py --latency 0.002 --points 100 --reps 5
+
+import argparse
+import contextlib
+import io
+import os
+import tempfile
+import time
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+
+from sim_backend import SimRack, set_rack
+from instrument_base import SIM_BACKEND
+from fmr_experiment import Experiment
+
+__all__ = ['make_sim_experiment', 'run_case', 'run_benchmarks']
+
+
+def make_sim_experiment(save_dir, latency=0.0, **rack_kwargs):
+    '''
+    Returns (Experiment, SimRack) on a fresh simulated rack.
+    All fixed delays of the Experiment are set to 0 so only the
+    acquisition overhead is measured.
+    '''
+    rack = set_rack(SimRack(latency=latency, **rack_kwargs))
+    with contextlib.redirect_stdout(io.StringIO()):
+        E = Experiment(logFilePath=os.path.join(save_dir, 'benchmark.log'), backend=SIM_BACKEND)
+    E.LIA.TC = 10E-6
+    E.read_delay = 0
+    E.rep_delay = 0
+    E.sen_delay = 0
+    E.from0delay = 0
+    # No magnet ramp (the settle polling at line starts is kept)
+    E.PS.ramp_rate = None
+    return E, rack
+
+
+def run_case(name, rack, num_points, function, *args, **kwargs):
+    '''Runs function(*args, **kwargs) and returns a dict of throughput figures'''
+    rack.reset_stats()
+    t0 = time.perf_counter()
+    function(*args, **kwargs)
+    elapsed = time.perf_counter() - t0
+    plt.close('all')
+    return {'case': name,
+            'points': num_points,
+            'time_s': elapsed,
+            'points_per_s': num_points / elapsed,
+            'round_trips_per_point': rack.round_trips / num_points,
+            'reads_per_point': rack.stats['read'] / num_points}
+
+
+def run_benchmarks(latency=1E-3, points=50, reps=1, map_shape=(5, 20), livefig=False):
+    '''
+    Benchmarks sweep_field, sweep_frequency (point by point and stepped)
+    and make2D on the simulated rack.
+
+    Parameters:
+    latency (float): Simulated bus latency per transaction in s.
+    points (int): Number of points of the 1D sweeps.
+    reps (int): read_reps used for every point.
+    map_shape (tuple): (frequencies, fields) of the make2D benchmark.
+    livefig (bool): Include live plotting (Agg canvas) in the 1D sweeps.
+
+    Returns: list of dicts (one per case)
+    '''
+    results = []
+    with tempfile.TemporaryDirectory() as save_dir:
+        E, rack = make_sim_experiment(save_dir, latency)
+        E.read_reps = reps
+        fields = np.linspace(0, 200, points)
+        frequencies = np.linspace(2, 4, points)
+        results.append(run_case('sweep_field', rack, points, E.sweep_field,
+                                3.0, fields, save_dir, livefig=livefig, savefig=False,
+                                read_reps=reps))
+        results.append(run_case('sweep_frequency', rack, points, E.sweep_frequency,
+                                100.0, frequencies, save_dir, livefig=livefig, savefig=False,
+                                read_reps=reps))
+        results.append(run_case('sweep_frequency stepped', rack, points, E.sweep_frequency,
+                                100.0, frequencies, save_dir, livefig=livefig, savefig=False,
+                                read_reps=reps, stepped=True))
+        n_freq, n_field = map_shape
+        results.append(run_case('make2D', rack, n_freq * n_field, E.make2D,
+                                np.linspace(2, 4, n_freq), np.linspace(0, 200, n_field),
+                                save_dir, read_reps=reps))
+        E.close()
+    return results
+
+
+def print_results(results):
+    header = '{:<26}{:>8}{:>10}{:>12}{:>16}{:>14}'
+    row = '{:<26}{:>8d}{:>10.3f}{:>12.1f}{:>16.2f}{:>14.2f}'
+    print(header.format('case', 'points', 'time (s)', 'points/s', 'round trips/pt', 'reads/pt'))
+    for r in results:
+        print(row.format(r['case'], r['points'], r['time_s'], r['points_per_s'],
+                         r['round_trips_per_point'], r['reads_per_point']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='FMR sweep throughput benchmarks on the simulated rack')
+    parser.add_argument('--latency', type=float, default=1E-3, help='bus latency per transaction (s)')
+    parser.add_argument('--points', type=int, default=50, help='points per 1D sweep')
+    parser.add_argument('--reps', type=int, default=1, help='read repetitions per point')
+    parser.add_argument('--livefig', action='store_true', help='include live plotting')
+    args = parser.parse_args()
+    print_results(run_benchmarks(args.latency, args.points, args.reps, livefig=args.livefig))
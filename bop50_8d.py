@@ -1,10 +1,17 @@
+import time as _time
+import math as _math
 from instrument_base import InstrumentBase as _InstrumentBase
+from instrument_base import cached_setting as _cached_setting
 
 class KEPCO_BOP(_InstrumentBase):
-    def __init__(self, GPIB_Address=6, GPIB_Device=0, ResourceName=None, logFile=None):
+    _cache_commands = {'FUNC:MODE': ['OperationMode'],
+                       'CURR': ['current'],
+                       'VOLT': ['voltage']}
+
+    def __init__(self, GPIB_Address=6, GPIB_Device=0, ResourceName=None, logFile=None, backend=None):
         if ResourceName is None:
             ResourceName = 'GPIB%d::%d::INSTR' % (GPIB_Device, GPIB_Address)
-        super().__init__(ResourceName, logFile)
+        super().__init__(ResourceName, logFile, backend)
         self._IDN = 'KEPCO BOP 50-8D'
         self.VI.write_termination = None
         self.VI.read_termination = self.VI.LF
@@ -12,9 +19,36 @@ class KEPCO_BOP(_InstrumentBase):
         self.write('*RST')
         self.write('OUTPUT ON')
 
-    def __del__(self):
-        self.write('VOLT 0')
-        super().__del__()
+        # Ramp engine (see set_current)
+        # Maximum current slew rate in A/s, None jumps straight to the setpoint
+        self.ramp_rate = 1.0
+        # Largest current step of a ramp in A (smaller changes are one step)
+        self.ramp_step = 0.05
+        # Settled once the measured current (less readback_offset) is this
+        # close to the setpoint (A), 'auto' : settle_counts readback steps
+        # (the larger of readback_resolution and readback_noise, see
+        # calibrate_readback), None does not poll
+        self.settle_tolerance = 'auto'
+        self.settle_counts = 2
+        self.readback_resolution = 1E-3
+        self.readback_noise = 0.0
+        self.readback_offset = 0.0
+        # Only changes larger than this (A) are polled, e.g. the first current
+        # of a sweep, the steps of a sweep are left to the read delay
+        self.settle_min_step = 0.02
+        self.settle_timeout = 10.0
+        # On timeout 'log' it and go on (settled False), or 'raise' a TimeoutError
+        self.settle_timeout_action = 'log'
+        self.settle_poll = 0.02
+        self.last_settle_s = 0.0
+        self.settled = True
+
+    def close(self):
+        if not self._closed and self._last_user:
+            # Ramp the coil down before dropping the voltage limit
+            self.ramp_to(0, settle=False)
+            self.write('VOLT 0')
+        super().close()
 
     def SetRange(self, r):
         '''
@@ -46,12 +80,15 @@ class KEPCO_BOP(_InstrumentBase):
     def CurrentMode(self):
         ''' Changes to constant current operation mode '''
         self.write('FUNC:MODE CURR')
+        self._cache_set('OperationMode', 'Constant Current')
 
     def VoltageMode(self):
         ''' Changes to constant voltage operation mode '''
         self.write('FUNC:MODE VOLT')
+        self._cache_set('OperationMode', 'Constant Voltage')
 
     @property
+    @_cached_setting
     def OperationMode(self):
         ''' Returns actual operation mode '''
         modes = ['Constant Voltage', 'Constant Current']
@@ -65,8 +102,10 @@ class KEPCO_BOP(_InstrumentBase):
             VoltageOut(voltage)
         '''
         self.write('VOLT %0.4f' % vOut)
+        self._cache_set('voltage', round(vOut, 4))
 
     @property
+    @_cached_setting
     def voltage(self):
         '''
         On Voltage mode:
@@ -82,14 +121,16 @@ class KEPCO_BOP(_InstrumentBase):
 
     def CurrentOut(self, cOut):
         '''
-        Sets the Output/Protection Current
+        Sets the Output/Protection Current at once (no ramp, see set_current)
 
         Usage :
             CurrentOut(current)
         '''
         self.write('CURR %0.4f' % cOut)
+        self._cache_set('current', round(cOut, 4))
 
     @property
+    @_cached_setting
     def current(self):
         '''
         On Voltage mode:
@@ -101,10 +142,98 @@ class KEPCO_BOP(_InstrumentBase):
 
     @current.setter
     def current(self, cOut):
-        self.CurrentOut(cOut)
+        self.set_current(cOut)
 
     def set_current(self, cOut):
-        self.CurrentOut(cOut)
+        '''Ramps to cOut at ramp_rate and waits until the magnet settled (see ramp_to)'''
+        self.ramp_to(cOut)
+
+    def ramp_to(self, cOut, rate=None, settle=True, timeout_action=None):
+        '''
+        Steps the current to cOut in steps of at most ramp_step A, at most
+        rate A/s (default ramp_rate), then, for changes above settle_min_step
+        and the settle tolerance, waits until the measured current is within
+        it (see wait_settled, timeout_action : default settle_timeout_action).
+
+        Usage :
+            ramp_to(current)
+        Returns: total time in s (ramp + settling)
+        '''
+        rate = self.ramp_rate if rate is None else rate
+        t0 = _time.perf_counter()
+        start = self.current
+        change = cOut - start
+        steps = max(1, int(_math.ceil(abs(change) / self.ramp_step - 1E-9))) if rate else 1
+        step_time = abs(change) / steps / rate if rate else 0.0
+        for k in range(1, steps + 1):
+            if k > 1:
+                _time.sleep(max(0.0, t0 + (k - 1) * step_time - _time.perf_counter()))
+            self.CurrentOut(start + change * k / steps if k < steps else cOut)
+        ramp_s = _time.perf_counter() - t0
+        settle_s = 0.0
+        if settle and abs(change) > max(self.settle_min_step, self._tolerance() or 0.0):
+            settle_s = self.wait_settled(cOut, action=timeout_action)
+        if steps > 1 or settle_s > self.settle_poll:
+            self._log('RAMP ', '{:.4f} -> {:.4f} A : ramp {:.3g} s, settle {:.3g} s'.format(
+                start, cOut, ramp_s, settle_s))
+        return ramp_s + settle_s
+
+    def zero(self):
+        '''
+        Ramps to 0 A for the cleanup paths (end of a sweep, errors) : a
+        settle timeout is only logged, never raised
+        '''
+        return self.ramp_to(0, timeout_action='log')
+
+    def _tolerance(self, tolerance=None):
+        tolerance = self.settle_tolerance if tolerance is None else tolerance
+        if tolerance == 'auto':
+            return self.settle_counts * max(self.readback_resolution, self.readback_noise)
+        return tolerance
+
+    def wait_settled(self, cOut=None, tolerance=None, timeout=None, action=None):
+        '''
+        Polls MeasuredCurrent every settle_poll s until it is within
+        tolerance (default settle_tolerance) of cOut (default the programmed
+        current), at most timeout s (default settle_timeout), then logs it or
+        raises a TimeoutError (action, default settle_timeout_action).
+        Returns: settling time in s (also in last_settle_s, settled is False
+            after a logged timeout)
+        '''
+        tolerance = self._tolerance(tolerance)
+        action = self.settle_timeout_action if action is None else action
+        self.settled = True
+        if tolerance is None:
+            return 0.0
+        cOut = self.current if cOut is None else cOut
+        timeout = self.settle_timeout if timeout is None else timeout
+        t0 = _time.perf_counter()
+        while abs(self.MeasuredCurrent - self.readback_offset - cOut) > tolerance:
+            if _time.perf_counter() - t0 > timeout:
+                self.settled = False
+                message = 'Current not settled at {:.4f} A after {:.3g} s'.format(cOut, timeout)
+                self._log('ERR ', message)
+                if action == 'raise':
+                    raise TimeoutError(message)
+                break
+            _time.sleep(self.settle_poll)
+        self.last_settle_s = _time.perf_counter() - t0
+        return self.last_settle_s
+
+    def calibrate_readback(self, n=20):
+        '''
+        Reads MeasuredCurrent n times at the present (settled) current and
+        sets readback_offset (mean - programmed current) and readback_noise
+        (standard deviation), used by the 'auto' settle tolerance.
+        Returns: offset, noise (A)
+        '''
+        readings = [self.MeasuredCurrent for i in range(n)]
+        mean = sum(readings) / n
+        self.readback_offset = mean - self.current
+        self.readback_noise = _math.sqrt(sum((r - mean)**2 for r in readings) / max(n - 1, 1))
+        self._log('CAL  ', 'Readback offset {:.4g} A, noise {:.4g} A'.format(self.readback_offset,
+                                                                         self.readback_noise))
+        return self.readback_offset, self.readback_noise
 
     def BEEP(self):
         '''BEEP'''
@@ -0,0 +1,198 @@
+# coding=utf-8
+
+# Shared, queue-backed log writer for the SpinLab instruments.
+#
+# Callers only put (timestamp, source, action, value) tuples on a queue; a
+# background thread formats them and appends them to the log file in batches,
+# either when flush_lines lines are pending, flush_interval seconds have passed,
+# or the logger is flushed / closed.
+#
+# All instruments and the Experiment writing to the same file share one
+# BufferedLogger (see get_logger).
+#
+# A failed write (disk full, too many open files...) does not stop the
+# thread : the lines are kept and written again with the next batch (at most
+# max_pending, the oldest are dropped), the error is reported on stderr once
+# and kept in last_error.
+
+import atexit
+import datetime
+import os
+import queue
+import sys
+import threading
+import time
+
+__all__ = ['BufferedLogger', 'get_logger',
+           'LOG_QUIET', 'LOG_COMMANDS', 'LOG_RESPONSES']
+
+# Verbosity levels
+LOG_QUIET = 0      # Only OPEN_/CLOSE and errors
+LOG_COMMANDS = 1   # + every command sent to the instruments
+LOG_RESPONSES = 2  # + every response payload
+
+_response_actions = ['resp', 'len return data:']
+
+
+def action_level(action):
+    '''Verbosity level needed for an action to be logged'''
+    action = action.strip()
+    if action in ['OPEN_', 'CLOSE'] or action.startswith('ERR'):
+        return LOG_QUIET
+    if action in _response_actions:
+        return LOG_RESPONSES
+    return LOG_COMMANDS
+
+
+class BufferedLogger(object):
+    '''
+    Batching log writer with a background thread.
+
+    Parameters:
+    logFile (str): Path of the log file (lines are appended).
+    flush_lines (int): Number of pending lines that triggers a write.
+    flush_interval (float): Maximum time in s a line waits in memory.
+    verbosity (int): LOG_QUIET, LOG_COMMANDS or LOG_RESPONSES.
+    max_pending (int): Lines kept while writes fail.
+    '''
+
+    def __init__(self, logFile, flush_lines=200, flush_interval=1.0, verbosity=LOG_RESPONSES,
+                 max_pending=100000):
+        self.logFile = os.path.abspath(logFile)
+        self.flush_lines = flush_lines
+        self.flush_interval = flush_interval
+        self.verbosity = verbosity
+        self.max_pending = max_pending
+        self.closed = False
+        self.last_error = None
+        self.dropped = 0
+        self._users = 0
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='BufferedLogger', daemon=True)
+        self._thread.start()
+
+    def __str__(self):
+        return 'BufferedLogger : %s' % self.logFile
+
+    def log(self, source, action, value=''):
+        '''
+        Queue one log line. source can be None (Experiment level lines).
+        The line is dropped if action is above the current verbosity.
+        '''
+        if self.closed or action_level(action) > self.verbosity:
+            return
+        self._queue.put((datetime.datetime.utcnow(), source, action, value))
+
+    def flush(self, timeout=None):
+        '''
+        Blocks until every line queued so far is written, at most timeout s
+        (None : as long as the writer thread runs).
+        Returns: True if the lines were written
+        '''
+        if self.closed or not self._thread.is_alive():
+            return False
+        done = threading.Event()
+        self._queue.put(done)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not done.wait(0.5):
+            if not self._thread.is_alive() or (deadline is not None and time.monotonic() > deadline):
+                return False
+        return self.last_error is None
+
+    def close(self):
+        '''Flush pending lines and stop the writer thread'''
+        if self.closed:
+            return
+        self.closed = True
+        self._queue.put(None)
+        self._thread.join()
+
+    # Reference counting used by the instruments sharing this logger
+    def acquire(self):
+        self._users += 1
+        return self
+
+    def release(self):
+        self._users -= 1
+        if self._users <= 0:
+            self.close()
+
+    @staticmethod
+    def _format(item):
+        timestamp, source, action, value = item
+        if source is None:
+            return '%s %s : %s \n' % (timestamp, action, repr(value))
+        return '%s %s %s : %s \n' % (timestamp, source, action, repr(value))
+
+    def _write(self, lines):
+        if lines:
+            with open(self.logFile, 'a') as log:
+                log.write(''.join(lines))
+
+    def _try_write(self, lines):
+        '''Writes lines, returns the lines still to write (all of them if it failed)'''
+        try:
+            self._write(lines)
+        except Exception as E:
+            if self.last_error is None:
+                sys.stderr.write('BufferedLogger : cannot write %s (%r), lines kept\n' % (self.logFile, E))
+            self.last_error = E
+            if len(lines) > self.max_pending:
+                self.dropped += len(lines) - self.max_pending
+                lines = lines[-self.max_pending:]
+            return lines
+        if self.last_error is not None and self.dropped:
+            sys.stderr.write('BufferedLogger : %d lines of %s lost\n' % (self.dropped, self.logFile))
+        self.last_error = None
+        self.dropped = 0
+        return []
+
+    def _run(self):
+        lines = []
+        last_flush = time.monotonic()
+        while True:
+            timeout = max(self.flush_interval - (time.monotonic() - last_flush), 0)
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = False
+            if isinstance(item, tuple):
+                lines.append(self._format(item))
+                # After a failed write only retry every flush_interval
+                if (len(lines) < self.flush_lines or self.last_error is not None) and \
+                        time.monotonic() - last_flush < self.flush_interval:
+                    continue
+            lines = self._try_write(lines)
+            last_flush = time.monotonic()
+            if isinstance(item, threading.Event):
+                item.set()
+            elif item is None:
+                return
+
+
+_loggers = {}
+_loggers_lock = threading.Lock()
+
+
+def get_logger(logFile, header='SpinLab Instruments LogFile\n'):
+    '''
+    Returns the shared BufferedLogger writing to logFile (one per path).
+    The file is created with header if it does not exist yet.
+    Every caller should call release() on the logger when done with it.
+    '''
+    path = os.path.abspath(logFile)
+    with _loggers_lock:
+        logger = _loggers.get(path)
+        if logger is None or logger.closed:
+            if not os.path.isfile(path):
+                with open(path, 'w') as log:
+                    log.write(header)
+            logger = BufferedLogger(path)
+            _loggers[path] = logger
+        return logger.acquire()
+
+
+@atexit.register
+def _close_all():
+    for logger in list(_loggers.values()):
+        logger.close()
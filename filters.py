@@ -1,38 +1,103 @@
 import numpy
 import scipy
+import scipy.ndimage
 import scipy.signal
 import scipy.optimize
 
+# The Gaussian kernel of Smooth is the product of two 1D kernels, so maps are
+# filtered with one 1D pass per axis. Kernels at least FFT_MIN_KERNEL points
+# long are applied by FFT convolution instead of direct convolution.
+FFT_MIN_KERNEL = 31
+
 def Spline_Filter(arr, a=50):
     return scipy.signal.spline_filter(arr, a)
 
-def Gaussian_Filter(arr, nf=5,  nh='nf'):
-    return Smooth(arr, nf,  nh)
+def Gaussian_Filter(arr, nf=5,  nh='nf', dtype=None, inplace=False):
+    return Smooth(arr, nf,  nh, dtype, inplace)
+
+def _gaussian_kernel(n):
+    # exp(-x**2/n) on -n..n, normalised
+    if n <= 0:
+        return numpy.ones(1)
+    x = numpy.arange(-n, n+1)
+    k = numpy.exp(-x**2.0/n)
+    return k / k.sum()
+
+def _convolve_axis(a, k, axis):
+    '''Convolution of a with the symmetric kernel k along axis (edges repeated)'''
+    if len(k) == 1:
+        return a
+    if len(k) < FFT_MIN_KERNEL:
+        return scipy.ndimage.convolve1d(a, k, axis=axis, mode='nearest')
+    n = len(k) // 2
+    pad = [(0, 0)] * a.ndim
+    pad[axis] = (n, n)
+    shape = [1] * a.ndim
+    shape[axis] = len(k)
+    out = scipy.signal.fftconvolve(numpy.pad(a, pad, mode='edge'), k.reshape(shape).astype(a.dtype),
+                                   mode='valid', axes=axis)
+    return out.astype(a.dtype, copy=False)
 
-def Smooth(S, nf=3,  nh='nf'):
+def Smooth(S, nf=3,  nh='nf', dtype=None, inplace=False):
+    '''
+    Gaussian smoothing of the map S: exp(-(x**2/nh + y**2/nf)) over
+    -nh..nh (axis 0) and -nf..nf (axis 1), edges repeated.
+    dtype (e.g. numpy.float32) sets the processing precision.
+    inplace=True writes the result into S (and returns it).
+    '''
     if nh == 'nf':
         nh = nf
-    nh = int(nh)
-    nf = int(nf)
-    x, y = numpy.mgrid[-nh:nh+1, -nf:nf+1]
-    g = numpy.exp(-(x**2.0/nh + y**2.0/nf))
-    g = g / g.sum()
-    out = scipy.ndimage.convolve(S.real, g, mode='nearest')
-    if S.dtype == 'complex':
-        out = out + 1.0j*scipy.ndimage.convolve(S.imag, g, mode='nearest')
+    kh = _gaussian_kernel(int(nh))
+    kf = _gaussian_kernel(int(nf))
+
+    def smooth(a):
+        if dtype is not None:
+            a = a.astype(dtype, copy=False)
+        return _convolve_axis(_convolve_axis(a, kh, 0), kf, 1)
+
+    out = smooth(S.real)
+    if numpy.iscomplexobj(S):
+        out = out + 1.0j*smooth(S.imag)
+    if inplace:
+        S[...] = out
+        return S
     return out
 
-def Revove_BG_Min(arr, nf=5, nh=5):
-    S = Smooth(arr, nf=nf, nh=nh)
+def Smooth1D(v, n=3, axis=-1):
+    '''Gaussian smoothing exp(-x**2/n) over -n..n points along axis (edges repeated)'''
+    v = numpy.asarray(v, dtype=float)
+    return _convolve_axis(v, _gaussian_kernel(int(n)), axis % v.ndim)
+
+def _output(arr, inplace, dtype):
+    if inplace:
+        return arr
+    return arr.astype(arr.dtype if dtype is None else dtype, copy=True)
+
+def Revove_BG_Min(arr, nf=5, nh=5, inplace=True, dtype=None):
+    '''
+    Subtracts from every column (field) its minimum along axis 0 of the
+    smoothed map. inplace=False returns a new array (of dtype, if given).
+    '''
+    S = Smooth(arr, nf=nf, nh=nh, dtype=dtype)
     bg = numpy.min(S.real, axis=0)
-    arr -= bg[None,:]
-    return arr
-
-def Revove_BG_Median(arr):
-    S = arr.copy()
-    bg = numpy.zeros_like(S[0,:].real)
-    m = numpy.median(S.real, axis=0)
-    for i, x in enumerate(m):
-        bg[i] = numpy.mean(S.real[:,i][S[:,i].real < x])
-    arr -= bg[None,:]
-    return arr
\ No newline at end of file
+    out = _output(arr, inplace, dtype)
+    out -= bg[None,:]
+    return out
+
+def Revove_BG_Median(arr, inplace=True, dtype=None):
+    '''
+    Subtracts from every column the mean of its values below the column
+    median. NaN (unmeasured) points are ignored. inplace=False returns a new
+    array (of dtype, if given).
+    '''
+    R = arr.real if dtype is None else arr.real.astype(dtype)
+    if numpy.isnan(R).any():
+        m = numpy.nanmedian(R, axis=0)
+    else:
+        m = numpy.median(R, axis=0)
+    below = R < m[None,:]
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        bg = numpy.where(below, R, 0).sum(axis=0) / below.sum(axis=0)
+    out = _output(arr, inplace, dtype)
+    out -= bg[None,:]
+    return out
@@ -1,31 +1,43 @@
 # Some generic packages we need
 import os
 import time
+import asyncio
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 from datetime import datetime
 
 # Let's import our instrument classes
+from buffered_log import get_logger
 from hp_8673g import HP_CWG
 from srs_sr830 import SRS_SR830
 from bop50_8d import KEPCO_BOP
+from sweep_result import SweepResult, MapResult
+from live_plot import LiveSweepPlot, LiveMapPlot
+from acquisition import run_with_live_figure
+from settling import Settler
+from integration import integrate
+from robust_stats import get_estimator, interquartile_mean, RepetitionBuffer
+from run_store import RunStore
+from scan_order import ScanCosts, plan_scan, line_start_wait
 
 class Experiment():
-    def __init__(self, logFilePath=None):
+    def __init__(self, logFilePath=None, backend=None):
         if logFilePath is None:
             if not os.path.isdir(os.path.abspath('./Experiment_Logs')):
                 os.mkdir(os.path.abspath('./Experiment_Logs'))
             logFilePath = './Experiment_Logs/FMR_log_{}.log'.format(self._get_timestring())
         with open(logFilePath, 'w') as log:
             log.write('SpinLab Instruments LogFile @ {}\n'.format(datetime.utcnow()))
-        self._logFile = os.path.abspath(logFilePath)
+        # One buffered logger shared by the Experiment and all instruments
+        self._logger = get_logger(logFilePath)
+        self._logFile = self._logger.logFile
         self._logWrite('OPEN_')
 
         # Initialise our Instruments
-        self.SG = HP_CWG(logFile=self._logFile)
-        self.PS = KEPCO_BOP(logFile=self._logFile)
-        self.LIA = SRS_SR830(logFile=self._logFile)
+        self.SG = HP_CWG(logFile=self._logFile, backend=backend)
+        self.PS = KEPCO_BOP(logFile=self._logFile, backend=backend)
+        self.LIA = SRS_SR830(logFile=self._logFile, backend=backend)
 
         # Some initial PS settings for safety
         self.PS.CurrentMode()
@@ -37,28 +49,145 @@ class Experiment():
         self.sen_delay = 3
         self.read_reps = 1
         self.rep_delay = 0
-        self.avg_func = np.mean
-        self.read_delay = 0.02
-        self.from0delay = 4
+        # Averaging of the repetitions: 'iqm', 'trimmed', 'median', 'huber', 'mean'
+        # (see robust_stats.py) or any function of an array
+        self.avg_func = 'iqm'
+        # Wait after every setpoint (s), 'auto' waits for the LIA output filter (see settler)
+        self.read_delay = 'auto'
+        self.settler = Settler(self.LIA)
+        # Wait (s) after the first current of a sweep, 'ramp' : only the PS ramp
+        # and the measured settling (see KEPCO_BOP.set_current, PS.ramp_rate)
+        self.from0delay = 'ramp'
+        # Use the SR830 data buffer for the repetitions : True when read_reps > 1,
+        # 'auto' the faster way, timed at the sweep setup or from the
+        # crossover (see measure_read_crossover), False
+        self.buffered_reads = 'auto'
+        # rep_delay : smallest read_reps read faster from the buffer
+        self.read_crossover = {}
+        # (rep_delay, read_reps) : buffer faster, timed at the sweep setup
+        self._read_choice = {}
+        # SG error check every n frequency points (0 = after every point)
+        self.sg_check_every = 10
+        # Maximum redraws per second of the live sweep figures
+        self.plot_fps = 10
+        # Run the instrument loop in a background thread while the live figure
+        # is drawn from a GUI timer (only used with livefig / make2D)
+        self.threaded_sweeps = False
+        # RunStore the sweeps and maps are also written to (see open_store)
+        self.store = None
+        # Write the CSV / npy files too when a store is open
+        self.save_csv = True
+        # With a store open, write every sweep point as soon as it is measured
+        self.stream_points = True
 
+        self._worker = None
+        # True while make2D keeps the magnet energized between lines
+        self._hold_magnet = False
+        self._closed = False
         self._welcome()
 
     
-    def __del__(self):
+    def close(self):
+        '''
+        Closes the instruments (PS output to 0 V, SG RF off) and the log.
+        Safe to call more than once.
+        '''
+        if self._closed:
+            return
+        self._closed = True
         self._logWrite('CLOSE')
-        del self.PS
-        del self.SG
-        del self.LIA
+        self.close_store()
+        for instrument in [self.PS, self.SG, self.LIA]:
+            instrument.close()
+        self._logger.release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __del__(self):
+        # Last resort only, call close() explicitly
+        if not getattr(self, '_closed', True):
+            self.close()
 
     def __str__(self):
         return 'FMR Experiment @ ' + self._get_timestring()
     
     def _logWrite(self, action, value=''):
-            if self._logFile is not None:
-                with open(self._logFile, 'a') as log:
-                    timestamp = datetime.utcnow()
-                    log.write('%s %s : %s \n' % (timestamp, action, repr(value)))
+        self._logger.log(None, action, value)
     _log = _logWrite
+
+    @property
+    def log_verbosity(self):
+        '''
+        Verbosity of the shared log file
+        0 : only OPEN_/CLOSE and errors
+        1 : + instrument commands
+        2 : + instrument responses (default)
+        '''
+        return self._logger.verbosity
+
+    @log_verbosity.setter
+    def log_verbosity(self, level):
+        self._logger.verbosity = level
+
+    def flush_log(self):
+        '''Write every pending log line to disk, returns False if they could not be written'''
+        return self._logger.flush()
+
+    ### Run store
+    def open_store(self, path, metadata=None, chunk_rows=256, sync_interval=2.0):
+        '''
+        Opens (or continues) the RunStore at path (see run_store.py), every
+        following sweep and map is written to it as a table, with the
+        instrument state in its metadata. The CSV / npy files are only
+        written as well while save_csv is True (run_store.export_csv
+        converts the store later).
+        Sweep points (stream_points) and map lines are written as they are
+        measured and fsync'ed at least every sync_interval s, so a crash
+        loses at most the last seconds (see make2D resume).
+        Returns: the RunStore
+        '''
+        self.close_store()
+        info = {'log_file': self._logFile}
+        info.update(metadata or {})
+        self.store = RunStore(path, 'a', metadata=info, chunk_rows=chunk_rows, sync_interval=sync_interval)
+        self._log('STORE', self.store.path)
+        return self.store
+
+    def close_store(self):
+        if self.store is not None:
+            self.store.close()
+            self.store = None
+
+    def _instrument_state(self):
+        '''Metadata of a sweep : SG level, LIA settings, delays and the time'''
+        return {'time': time.time(), 'timestring': self._get_timestring(), 'level_db': self.SG.level,
+                'tc': self.LIA.TC, 'sen': self.LIA.SEN, 'slope_db': self.LIA.SlopeDB,
+                'sen_delay': self.sen_delay, 'read_reps': self.read_reps, 'rep_delay': self.rep_delay,
+                'read_delay': self.read_delay, 'from0delay': self.from0delay, 'ramp_rate': self.PS.ramp_rate,
+                'avg_func': str(self.avg_func)}
+
+    def _stream_sweep(self, result, filename):
+        '''With a store open and stream_points, writes every point of result as it is measured'''
+        if self.store is not None and self.stream_points:
+            name = self.store.unique_name(filename.strip('\\'))
+            result.to_store(self.store, name, metadata=self._instrument_state(), stream=True)
+
+    def _save_sweep(self, result, save_dir, filename):
+        if self.store is not None:
+            if result.sink is None:
+                name = self.store.unique_name(filename.strip('\\'))
+                result.to_store(self.store, name, metadata=self._instrument_state())
+            else:
+                # Last points of the streamed table, the line is finished
+                result.sink.close()
+                result.sink = None
+            self.store.sync()
+        if self.store is None or self.save_csv:
+            result.to_csv(save_dir + r'\\' + filename + '.csv')
        
 
     def _welcome(self):
@@ -81,7 +210,15 @@ class Experiment():
             'Read Repetition Delay': self.rep_delay,
             'Repetition Averaging Function': self.avg_func,
             'Read Delay': self.read_delay,
+            'Settling': self.settler,
             'From 0 Delay (s)': self.from0delay,
+            'PS Ramp Rate (A/s)': self.PS.ramp_rate,
+            'Buffered Reads': self.buffered_reads,
+            'SG Error Check Every': self.sg_check_every,
+            'Live Plot Max FPS': self.plot_fps,
+            'Threaded Sweeps': self.threaded_sweeps,
+            'Run Store': self.store,
+            'Stream Points': self.stream_points,
             'Log File': self._logFile}
         for key, val in parameters.items():
             print(key, ':\t', val)
@@ -112,7 +249,7 @@ class Experiment():
     
     def _get_avg_func(self, avg_func):
         if avg_func is None:
-            avg_func = self.avg_mid_50
+            avg_func = self.avg_func
         return avg_func
     
     def _get_read_delay(self, read_delay):
@@ -125,147 +262,693 @@ class Experiment():
             from0delay = self.from0delay
         return from0delay
 
+    def _line_start_delay(self, from0delay, current):
+        '''
+        Wait after setting the first current of a sweep : from0delay, or
+        while make2D holds the magnet, from0delay scaled by the relative
+        jump from the present current (see scan_order.line_start_wait).
+        None with from0delay='ramp', the PS ramp waits for the magnet itself.
+        '''
+        from0delay = self._get_from0delay(from0delay)
+        if from0delay == 'ramp':
+            return 0.0
+        # Compared as programmed (0.1 mA), a serpentine line starts where the last one ended
+        return line_start_wait(from0delay, self.PS.current, round(current, 4), self._hold_magnet)
+
+    def _start_line(self, current, from0delay=None):
+        '''
+        First current of a sweep, then the line start wait (for the async
+        sweeps, run on the PS thread) : the jump is taken from the current
+        read in the same call, before it is set
+        '''
+        delay = self._line_start_delay(from0delay, current)
+        self.PS.set_current(current)
+        time.sleep(delay)
+
+    def _release_magnet(self):
+        '''Current to 0 at the end of a sweep, unless make2D holds the magnet'''
+        if not self._hold_magnet:
+            self.PS.zero()
+
+    def _get_sg_check_every(self, sg_check_every):
+        if sg_check_every is None:
+            sg_check_every = self.sg_check_every
+        return sg_check_every
+
 
     def sweep_field(self, frequency, fields, save_dir, livefig=True, savefig=True, closefig=False,
                     file_prefix='', sen=0.002, sen_delay=None, read_reps=None, rep_delay=None,
-                    read_delay=None, from0delay=None, avg_func=None, return_XY=False):
+                    read_delay=None, from0delay=None, avg_func=None, return_XY=False, adaptive=None):
+        '''
+        adaptive=Refiner(...) (see adaptive.py) measures fields as a coarse
+        grid first and then adds points where the signal changes or bends,
+        the result is saved sorted by field.
+        '''
         if not os.path.isdir(save_dir):
             os.mkdir(save_dir)
         currents = self.field2current(fields)
 
-        # Janky solution to the current not immediately jumping from 0 to first value
+        # The PS ramps to the first current and waits until the magnet follows
+        delay = self._line_start_delay(from0delay, currents[0])
         self.SG.set_frequency_ghz(frequency)
         self.PS.set_current(currents[0])
-        time.sleep(self._get_from0delay(from0delay))
+        time.sleep(delay)
 
+        refine = None
+        if adaptive is None:
+            result, filename = self._field_sweep_result(frequency, fields, currents, livefig, file_prefix)
+        else:
+            result, filename = self._field_sweep_result(frequency, fields, currents, livefig, file_prefix,
+                                                        capacity=adaptive.max_points)
+            adaptive.reset()
+
+            def refine(result):
+                new_fields = adaptive.next_points(result.setpoints, result.X, result.Y)
+                new_currents = self.field2current(new_fields)
+                result.plan(new_fields, current_A=new_currents)
+                return new_currents
+        self._sweep_parameter(result, currents, self.PS.set_current, save_dir, livefig,
+                              savefig, closefig, sen, sen_delay, read_reps,
+                              rep_delay, read_delay, avg_func, filename, refine)
+        if adaptive is not None:
+            result = result.sorted()
+        self._save_sweep(result, save_dir, filename)
+
+        if return_XY:
+            return result.X, result.Y
+        return result
+
+    def _field_sweep_result(self, frequency, fields, currents, livefig, file_prefix, capacity=None):
+        '''
+        Returns the empty SweepResult and file name of a field sweep, makes its figure.
+        With capacity (adaptive sweeps) fields are only the first planned points.
+        '''
         filename = file_prefix + r'freq_{:.4g}_GHz_field_{:.4g}-{:.4g}_Oe_{:.4g}_dB'.format(
-            frequency, fields.min(), fields.max(), float(self.SG.level[2:-2]))
+            frequency, fields.min(), fields.max(), self.SG.level)
         
         if livefig:
             plot_title = 'Field Sweep {:.4g} – {:.4g} Oe @ {:.4g} GHz, {:.4g} dB'.format(
-                fields.min(), fields.max(), frequency, float(self.SG.level[2:-2]))
-            self._make_fig(plot_title, 'Field (Oe)', 'Voltage (AU)')
-            
-        x_arr, y_arr = self._sweep_parameter(currents, self.PS.set_current, save_dir, livefig,
-                                             savefig, closefig, sen, sen_delay, read_reps,
-                                             rep_delay, read_delay, avg_func, fields, filename)
-        
-        df = pd.DataFrame({'current_A': currents, 'field_Oe': fields, 'X': x_arr, 'Y': y_arr})
-        df.to_csv(save_dir + r'\\' + filename + '.csv', index=False)
+                fields.min(), fields.max(), frequency, self.SG.level)
+            self._make_fig(plot_title, 'Field (Oe)', 'Voltage (AU)', (fields.min(), fields.max()))
 
-        if return_XY:
-            return x_arr, y_arr
+        metadata = {'frequency_ghz': frequency, 'level_db': self.SG.level}
+        if capacity is None:
+            result = SweepResult('field_Oe', fields, aux={'current_A': currents}, metadata=metadata)
+        else:
+            result = SweepResult('field_Oe', aux={'current_A': np.nan}, metadata=metadata,
+                                 capacity=max(capacity, len(fields)))
+            result.plan(fields, current_A=currents)
+        self._stream_sweep(result, filename)
+        return result, filename
         
     
     def sweep_frequency(self, field, frequencies, save_dir, livefig=True, savefig=True, closefig=False,
                         file_prefix='', sen=None, sen_delay=None, read_reps=None, rep_delay=None,
-                        read_delay=None, from0delay=None, avg_func=None, return_XY=False):
+                        read_delay=None, from0delay=None, avg_func=None, return_XY=False,
+                        sg_check_every=None, stepped=False, adaptive=None):
+        '''
+        stepped=True uses the SG's own stepped sweep, advanced by a trigger per
+        point, with the lock-in storing every point in its buffer (see
+        _sweep_stepped). frequencies must then be evenly spaced.
+        adaptive=Refiner(...) refines the frequencies as in sweep_field
+        (point by point only).
+        '''
         if not os.path.isdir(save_dir):
             os.mkdir(save_dir)
         current = self.field2current(field)
 
-        # Janky solution to the current not immediately jumping from 0 to first value
+        # The PS ramps to the first current and waits until the magnet follows
+        delay = self._line_start_delay(from0delay, current)
         self.SG.set_frequency_ghz(frequencies[0])
         self.PS.set_current(current)
-        time.sleep(self._get_from0delay(from0delay))
+        time.sleep(delay)
 
+        refine = None
+        if adaptive is None:
+            result, filename = self._frequency_sweep_result(field, frequencies, livefig, file_prefix)
+        else:
+            result, filename = self._frequency_sweep_result(field, frequencies, livefig, file_prefix,
+                                                            capacity=adaptive.max_points)
+            adaptive.reset()
+
+            def refine(result):
+                new_frequencies = adaptive.next_points(result.setpoints, result.X, result.Y)
+                result.plan(new_frequencies)
+                return new_frequencies
+        sg_check_every = self._get_sg_check_every(sg_check_every)
+        if stepped and adaptive is not None:
+            self._log('ERR ', 'Adaptive sweeps are point by point, not stepped.')
+            stepped = False
+        if stepped and not np.allclose(np.diff(frequencies), frequencies[1] - frequencies[0]):
+            self._log('ERR ', 'Stepped sweep needs evenly spaced frequencies, sweeping point by point.')
+            stepped = False
+        buffer_points = len(frequencies) * self._get_read_reps(read_reps)
+        if stepped and buffer_points > self.LIA.BufferSize:
+            self._log('ERR ', 'Stepped sweep needs {} LIA buffer points ({} max), sweeping point by point.'.format(
+                buffer_points, self.LIA.BufferSize))
+            stepped = False
+        if stepped:
+            self._sweep_stepped(result, save_dir, livefig, savefig, closefig, sen, read_reps,
+                                rep_delay, read_delay, avg_func, filename)
+        elif sg_check_every:
+            # Check the SG message register once every sg_check_every points
+            with self.SG.deferred_errors(sg_check_every):
+                self._sweep_parameter(result, frequencies, self.SG.set_frequency_ghz, save_dir, livefig,
+                                      savefig, closefig, sen, sen_delay, read_reps,
+                                      rep_delay, read_delay, avg_func, filename, refine)
+        else:
+            self._sweep_parameter(result, frequencies, self.SG.set_frequency_ghz, save_dir, livefig,
+                                  savefig, closefig, sen, sen_delay, read_reps,
+                                  rep_delay, read_delay, avg_func, filename, refine)
+        if adaptive is not None:
+            result = result.sorted()
+        self._save_sweep(result, save_dir, filename)
+
+        if return_XY:
+            return result.X, result.Y
+        return result
+
+    def _frequency_sweep_result(self, field, frequencies, livefig, file_prefix, capacity=None):
+        '''Returns the empty SweepResult and file name of a frequency sweep, see _field_sweep_result'''
         filename = file_prefix + r'\field_{:.4g}_Oe_freq_{:.4g}-{:.4g}_GHz_{:.4g}_dB'.format(
-            field, frequencies.min(), frequencies.max(), float(self.SG.level[2:-2]))
+            field, frequencies.min(), frequencies.max(), self.SG.level)
         
         if livefig:
             plot_title = 'Frequency Sweep {:.4g} – {:.4g} GHz @ {:.4g} Oe, {:.4g} dB'.format(
-                frequencies.min(), frequencies.max(), field, float(self.SG.level[2:-2]))
-            self._make_fig(plot_title, 'Frequency (GHz)', 'Voltage (AU)')
-            
-        x_arr, y_arr = self._sweep_parameter(frequencies, self.SG.set_frequency_ghz, save_dir, livefig,
-                                             savefig, closefig, sen, sen_delay, read_reps,
-                                             rep_delay, read_delay, avg_func, frequencies, filename)
-        
-        df = pd.DataFrame({'frequency_ghz': frequencies, 'X': x_arr, 'Y': y_arr})
-        df.to_csv(save_dir + r'\\' + filename + '.csv', index=False)
-        
-        if return_XY:
-            return x_arr, y_arr
+                frequencies.min(), frequencies.max(), field, self.SG.level)
+            self._make_fig(plot_title, 'Frequency (GHz)', 'Voltage (AU)',
+                           (frequencies.min(), frequencies.max()))
+
+        metadata = {'field_Oe': field, 'level_db': self.SG.level}
+        if capacity is None:
+            result = SweepResult('frequency_ghz', frequencies, metadata=metadata)
+        else:
+            result = SweepResult('frequency_ghz', metadata=metadata, capacity=max(capacity, len(frequencies)))
+            result.plan(frequencies)
+        self._stream_sweep(result, filename)
+        return result, filename
+
+
+    def _sweep_stepped(self, result, save_dir, livefig, savefig, closefig, sen, read_reps,
+                       rep_delay, read_delay, avg_func, filename):
+        '''
+        Frequency sweep on the SG stepped sweep registers.
+        Per point only two commands go over the bus (SG trigger, LIA trigger),
+        no queries: the lock-in stores read_reps samples per step in its
+        buffer and everything is read in bulk at the end. The sensitivity is
+        therefore not adapted during the sweep, only checked at the end.
+
+        The frequencies actually swept are stored in result.
+        '''
+        read_reps = self._get_read_reps(read_reps)
+        rep_delay = self._get_rep_delay(rep_delay)
+        avg_func = self._get_avg_func(avg_func)
+        frequencies = result._data[result.parameter]
+        n = len(frequencies)
+
+        self._prepare_lia(sen)
+        read_delay = self._settle_delay(read_delay)
+        try:
+            frequencies[:] = self.SG.configure_stepped_sweep(frequencies[0], frequencies[-1], n)
+            self.LIA.configure_buffer('Trigger')
+            self.LIA.start_buffer()
+            self.SG.begin_single_sweep()
+            for i in range(n):
+                if i > 0:
+                    self.SG.trigger()
+                time.sleep(read_delay)
+                for rep in range(read_reps):
+                    self.LIA.software_trigger()
+                    time.sleep(rep_delay)
+        except BaseException:
+            # Never leave the magnet energized after an error
+            self._hold_magnet = False
+            raise
+        finally:
+            try:
+                self.LIA.pause_buffer()
+                self.SG.sweep_mode = 'Off'
+            finally:
+                self._release_magnet()
+
+        X_reps = self.LIA.read_buffer(1, 0, n * read_reps).reshape(n, read_reps)
+        Y_reps = self.LIA.read_buffer(2, 0, n * read_reps).reshape(n, read_reps)
+        estimator = get_estimator(avg_func)
+        (X, X_err), (Y, Y_err) = estimator(X_reps), estimator(Y_reps)
+        result.extend(X, Y, sen=self.LIA.SEN, X_std=X_reps.std(axis=1), Y_std=Y_reps.std(axis=1),
+                      reps=read_reps, settle_s=read_delay, X_err=X_err, Y_err=Y_err)
+        if max(np.abs(result.X).max(), np.abs(result.Y).max()) > 0.8 * self.LIA.SEN:
+            self._log('ERR ', 'Signal above 80% of the LIA sensitivity during stepped sweep.')
 
+        if livefig:
+            self._update_sweep_plot(result.setpoints, result.X, result.Y)
+            self._finish_sweep_plot(save_dir, filename, savefig, closefig)
+        return result
 
-    def _sweep_parameter(self, params, setter_method, save_dir, livefig, savefig, closefig, sen,
-                         sen_delay, read_reps, rep_delay, read_delay, avg_func, xrange, filename):
+    def _prepare_lia(self, sen):
+        # Settings are cached from here on, re-read them if changed by hand
+        self.LIA.check_front_panel()
         self.LIA.SEN = self._get_sen(sen)
-        X_array, Y_array = np.array([], dtype=float), np.array([], dtype=float)
-        for i, param in enumerate(params):
-            setter_method(param)
-            time.sleep(self._get_read_delay(read_delay))
-            X, Y = self.readXY(avg_func, read_reps, rep_delay, sen_delay)
-            X_array = np.append(X_array, X)
-            Y_array = np.append(Y_array, Y)
-            if livefig:
-                self._update_sweep_plot(xrange[0:i + 1], X_array, Y_array)
-        self.PS.current = 0
-        if livefig and savefig:
-            self.fig.savefig(save_dir + '\\' + filename + '.png', dpi=600)
-        if livefig and closefig:
-            plt.close(self.fig)
-        return X_array, Y_array
+
+    def _settle_delay(self, read_delay):
+        '''Fixed wait after a setpoint (s), the settler's minimum wait for 'auto' '''
+        read_delay = self._get_read_delay(read_delay)
+        if read_delay == 'auto':
+            return self.settler.wait_time()
+        return read_delay
+
+    def _settle(self, read_delay, start):
+        '''
+        Waits after a setpoint sent at start (time.perf_counter()).
+        Returns: the settle time (s) counted from start
+        '''
+        if read_delay == 'auto':
+            return self.settler.settle(start)
+        time.sleep(read_delay)
+        return time.perf_counter() - start
+
+    def _sweep_parameter(self, result, params, setter_method, save_dir, livefig, savefig, closefig, sen,
+                         sen_delay, read_reps, rep_delay, read_delay, avg_func, filename, refine=None):
+        '''
+        Sets every value of params with setter_method and fills result point by point.
+        refine(result), if given, is called after every pass: it plans the next
+        points in result and returns their params (empty to end the sweep).
+        With threaded_sweeps the points are measured in a background thread and
+        the live figure is updated from a GUI timer; closing the figure or
+        interrupting the kernel stops the sweep after the current point.
+        '''
+        self._prepare_lia(sen)
+        self._prepare_reads(read_reps, rep_delay)
+        read_delay = self._get_read_delay(read_delay)
+        threaded = livefig and self.threaded_sweeps
+
+        def acquire(worker=None):
+            if worker is not None:
+                self._worker = worker
+            try:
+                batch = params
+                while len(batch) and not self._stopping():
+                    for param in batch:
+                        if self._stopping():
+                            break
+                        start = time.perf_counter()
+                        setter_method(param)
+                        settle = self._settle(read_delay, start)
+                        result.append(settle_s=settle,
+                                      **self._read_point(avg_func, read_reps, rep_delay, sen_delay))
+                        if worker is not None:
+                            worker.put(result.size)
+                        elif livefig:
+                            plot()
+                    batch = [] if refine is None else refine(result)
+                if self._stopping():
+                    self._log('STOP ', 'Sweep stopped after {} points'.format(result.size))
+            except BaseException:
+                # Never leave the magnet energized after an error
+                self._hold_magnet = False
+                raise
+            finally:
+                self._release_magnet()
+                if worker is not None:
+                    self._worker = None
+
+        def plot(n=None):
+            x, X, Y = (result.column(name, n) for name in (result.parameter, 'X', 'Y'))
+            if refine is not None:
+                # Refined points arrive out of order
+                order = np.argsort(x)
+                x, X, Y = x[order], X[order], Y[order]
+            self._update_sweep_plot(x, X, Y)
+
+        def on_items(items):
+            # Only the latest point count matters, the data is in result
+            plot(items[-1])
+
+        if threaded:
+            run_with_live_figure(acquire, on_items, self.fig)
+        else:
+            acquire()
+        if livefig:
+            self._finish_sweep_plot(save_dir, filename, savefig, closefig)
+        return result
+
+    ### Asynchronous sweeps
+    async def asweep_field(self, frequency, fields, save_dir, livefig=True, savefig=True, closefig=False,
+                           file_prefix='', sen=0.002, sen_delay=None, read_reps=None, rep_delay=None,
+                           read_delay=None, from0delay=None, avg_func=None, return_XY=False):
+        '''
+        Coroutine version of sweep_field, usage in a notebook :
+            result = await E.asweep_field(9, fields, save_dir)
+        The SG frequency and the first magnet current are set concurrently and
+        the settling delays start with the commands instead of after them.
+        '''
+        if not os.path.isdir(save_dir):
+            os.mkdir(save_dir)
+        currents = self.field2current(fields)
+        await asyncio.gather(self.SG.arun(self.SG.set_frequency_ghz, frequency),
+                             self.PS.arun_blocking(self._start_line, currents[0], from0delay))
+
+        result, filename = self._field_sweep_result(frequency, fields, currents, livefig, file_prefix)
+        await self._asweep_parameter(result, currents, self.PS, self.PS.set_current, save_dir, livefig,
+                                     savefig, closefig, sen, sen_delay, read_reps,
+                                     rep_delay, read_delay, avg_func, filename)
+        self._save_sweep(result, save_dir, filename)
+
+        if return_XY:
+            return result.X, result.Y
+        return result
+
+    async def asweep_frequency(self, field, frequencies, save_dir, livefig=True, savefig=True, closefig=False,
+                               file_prefix='', sen=None, sen_delay=None, read_reps=None, rep_delay=None,
+                               read_delay=None, from0delay=None, avg_func=None, return_XY=False,
+                               sg_check_every=None):
+        '''Coroutine version of sweep_frequency (point by point only), see asweep_field'''
+        if not os.path.isdir(save_dir):
+            os.mkdir(save_dir)
+        current = self.field2current(field)
+        await asyncio.gather(self.SG.arun(self.SG.set_frequency_ghz, frequencies[0]),
+                             self.PS.arun_blocking(self._start_line, current, from0delay))
+
+        result, filename = self._frequency_sweep_result(field, frequencies, livefig, file_prefix)
+        sg_check_every = self._get_sg_check_every(sg_check_every)
+        sweep = self._asweep_parameter(result, frequencies, self.SG, self.SG.set_frequency_ghz, save_dir,
+                                       livefig, savefig, closefig, sen, sen_delay, read_reps,
+                                       rep_delay, read_delay, avg_func, filename)
+        if sg_check_every:
+            with self.SG.deferred_errors(sg_check_every):
+                await sweep
+        else:
+            await sweep
+        self._save_sweep(result, save_dir, filename)
+
+        if return_XY:
+            return result.X, result.Y
+        return result
+
+    async def _asweep_parameter(self, result, params, instrument, setter_method, save_dir, livefig, savefig,
+                                closefig, sen, sen_delay, read_reps, rep_delay, read_delay, avg_func, filename):
+        '''
+        Coroutine version of _sweep_parameter, setter_method is a method of
+        instrument. The read delay of each point runs while its setpoint is
+        being sent.
+        '''
+        await self.LIA.arun(self._prepare_lia, sen)
+        await self.LIA.arun(self._prepare_reads, read_reps, rep_delay)
+        read_delay = self._get_read_delay(read_delay)
+        # The PS ramps and polls off the bus thread
+        run = instrument.arun_blocking if instrument is self.PS else instrument.arun
+        try:
+            for param in params:
+                start = time.perf_counter()
+                await asyncio.gather(run(setter_method, param),
+                                     asyncio.sleep(self._settle_delay(read_delay)))
+                if read_delay == 'auto' and self.settler.poll:
+                    await self.LIA.arun(self.settler.settle, start)
+                settle = time.perf_counter() - start
+                point = await self.LIA.arun(self._read_point, avg_func, read_reps, rep_delay, sen_delay)
+                result.append(settle_s=settle, **point)
+                if livefig:
+                    self._update_sweep_plot(result.setpoints, result.X, result.Y)
+        except BaseException:
+            # Never leave the magnet energized after an error
+            self._hold_magnet = False
+            raise
+        finally:
+            # As _sweep_parameter : kept on while make2D holds the magnet
+            await self.PS.arun_blocking(self._release_magnet)
+        if livefig:
+            self._finish_sweep_plot(save_dir, filename, savefig, closefig)
+        return result
     
 
     def make2D(self, frequencies, fields, save_dir, primary='frequency', channel='X', livefig=False,
                savefig=False, closefig=False, file_prefix='', sen=None, sen_delay=None, read_reps=None,
-               rep_delay=None, read_delay=None, from0delay=None, avg_func=None, integrate=False):
-        arr = np.zeros((len(frequencies), len(fields)))
+               rep_delay=None, read_delay=None, from0delay=None, avg_func=None, integrate=False,
+               stepped=False, track=None, resume=False, schedule=None):
+        '''
+        Measures a frequency x field map line by line.
+        track=ResonanceTracker(...) (primary='frequency' only, see tracking.py)
+        sweeps only a field window around the line predicted from the rows
+        measured so far; the other points of the map stay NaN.
+        With a store open (see open_store) every line is written to it as
+        soon as it is measured. resume=True continues the last map of the
+        store with the same axes, primary, channel and integrate (or
+        resume='table name'): the stored instrument settings are restored
+        and only the missing lines are measured.
+        schedule=plan_scan(...) (see scan_order.py) sets the inner axis (it
+        overrides primary), serpentine lines and holds the magnet between
+        lines (ramped down at the end). schedule='serpentine' / 'raster'
+        keeps primary and holds the magnet.
+        Returns: MapResult (X, Y and the plotted channel Z, indexed [frequency, field])
+        '''
+        serpentine = hold = False
+        if isinstance(schedule, str):
+            inner = 'field' if primary == 'frequency' else 'frequency'
+            schedule = plan_scan(frequencies, fields, self._scan_costs(from0delay), inner=inner,
+                                 traversal=schedule, magnet='hold')
+        if schedule is not None:
+            primary = schedule.primary
+            serpentine, hold = schedule.serpentine, schedule.hold_magnet
+            self._log('PLAN ', repr(schedule))
+        if serpentine and stepped and primary == 'field':
+            self._log('ERR ', 'Stepped frequency sweeps only go up, no serpentine lines.')
+            serpentine = False
+        if track is not None and primary != 'frequency':
+            self._log('ERR ', "Resonance tracking needs primary='frequency', measuring full lines.")
+            track = None
+        result = MapResult(frequencies, fields, primary, metadata={'channel': channel, 'integrate': integrate,
+                                                                   'track': str(track),
+                                                                   'schedule': str(schedule)})
+        table = None
+        if resume:
+            table = self._find_map_table(result, resume)
+        if table is not None:
+            self._restore_state(table.metadata)
+            result = MapResult.from_table(table)
+            self._log('RESUM', '{} : {} of {} lines on disk'.format(table.name, result.done.sum(),
+                                                                    len(result.done)))
+        arr = result.Z
         if primary=='frequency':
             param1 = frequencies
             param2 = fields
             sweep_param2 = self.sweep_field
+            sweep_kwargs = {}
         elif primary=='field':
             param1 = fields
             param2 = frequencies
             sweep_param2 = self.sweep_frequency
+            sweep_kwargs = {'stepped': stepped}
 
-        fig, ax = plt.subplots(figsize=(10,7))
-        plot = ax.pcolormesh(fields, frequencies, arr, cmap='coolwarm')
-        cbar = fig.colorbar(plot)
-        plt.show()
-        
-        for i, val1 in enumerate(param1):
-            X_arr, Y_arr = sweep_param2(val1, param2, save_dir, livefig=livefig, savefig=savefig,
-                                        closefig=closefig, file_prefix=file_prefix, sen=sen, sen_delay=sen_delay,
-                                        read_reps=read_reps, rep_delay=rep_delay, read_delay=read_delay,
-                                        from0delay=from0delay, avg_func=avg_func, return_XY=True)
-            if channel == 'X':
-                channel_arr = X_arr
-            elif channel == 'Y':
-                channel_arr = Y_arr
-            
-            intstatus = 'Unintegrated'
-
-            if integrate:
-                channel_arr = self._integrate(param2, channel_arr)[1]
-                intstatus = 'Integrated'
-            
-            title = '2D Sweep: Frequency {:.4g} – {:.4g} GHz, Field {:.4g} – {:.4g} Oe, {:.4g} dB, Channel {}, {}'.format(
-            frequencies.min(), frequencies.max(), fields.min(), fields.max(), float(self.SG.level[2:-2]), channel, intstatus)
-            ax.clear()
-
-            if primary == 'frequency':
-                arr[i] = channel_arr
-                plot = ax.pcolormesh(fields, frequencies[:i + 1], arr[:i + 1], cmap='coolwarm')
-            elif primary == 'field':
-                arr[:, i] = channel_arr
-                plot = ax.pcolormesh(fields[:i + 1], frequencies, arr[:, :i + 1], cmap='coolwarm')
-
-            ax.set_xlabel('Field (Oe)')
-            ax.set_ylabel('Frequency (GHz)')
-            ax.set_title(title)
-            cbar.update_normal(plot)
-            fig.canvas.draw()
-            plt.pause(0.05)
-            
+        intstatus = 'Integrated' if integrate else 'Unintegrated'
+        title = '2D Sweep: Frequency {:.4g} – {:.4g} GHz, Field {:.4g} – {:.4g} Oe, {:.4g} dB, Channel {}, {}'.format(
+            frequencies.min(), frequencies.max(), fields.min(), fields.max(), self.SG.level, channel, intstatus)
+        # The map is allocated once (NaN filled), each line only updates its data
+        live_map = LiveMapPlot(fields, frequencies, arr, title, max_fps=self.plot_fps)
+        if result.done.any():
+            live_map.update(arr[np.isfinite(arr)])
+        if self.threaded_sweeps and livefig:
+            # Figures can only be made on the GUI thread
+            self._log('ERR ', 'No live line figures with threaded_sweeps, only the map is shown.')
+            livefig = False
+
+        def sweep_line(val1, values):
+            return sweep_param2(val1, values, save_dir, livefig=livefig, savefig=savefig,
+                                closefig=closefig, file_prefix=file_prefix, sen=sen,
+                                sen_delay=sen_delay, read_reps=read_reps, rep_delay=rep_delay,
+                                read_delay=read_delay, from0delay=from0delay, avg_func=avg_func,
+                                return_XY=True, **sweep_kwargs)
+
+        def reversed_line(val1, values):
+            X_arr, Y_arr = sweep_line(val1, values[::-1])
+            return X_arr[::-1], Y_arr[::-1]
+
+        if track is not None:
+            track.reset()
+            for i in np.flatnonzero(result.done & np.isfinite(result.resonance)):
+                track.add(frequencies[i], result.resonance[i])
         filename = file_prefix + '2Dsweep_freq_{:.4g}-{:.4g}_GHz_field_{:.4g}-{:.4g}_Oe_{:.4g}_dB_channel_{}_{}'.format(
-            frequencies.min(), frequencies.min(), fields.min(), fields.max(), float(self.SG.level[2:-2]), channel, intstatus)
-        np.save(save_dir + '\\' + filename, arr)
-        plt.savefig(save_dir + '\\' + filename + '.png', dpi=600)
+            frequencies.min(), frequencies.min(), fields.min(), fields.max(), self.SG.level, channel, intstatus)
+        if self.store is not None and table is None:
+            # Every line is appended as soon as it is measured
+            table = result.create_table(self.store, self.store.unique_name(filename.strip('\\')),
+                                        metadata=self._instrument_state())
+
+        def acquire(worker=None):
+            if worker is not None:
+                self._worker = worker
+            self._hold_magnet = hold
+            try:
+                for i, val1 in enumerate(param1):
+                    if result.done[i]:
+                        # Resumed, already on disk
+                        continue
+                    # Serpentine : every other line starts where the previous one ended
+                    line = reversed_line if serpentine and i % 2 else sweep_line
+                    if track is None:
+                        X_arr, Y_arr = line(val1, param2)
+                    else:
+                        X_arr, Y_arr, result.resonance[i] = self._track_line(track, val1, param2, line)
+                    if self._stopping():
+                        # The partial line is only kept in its CSV
+                        break
+                    if channel == 'X':
+                        channel_arr = X_arr
+                    elif channel == 'Y':
+                        channel_arr = Y_arr
+
+                    if integrate:
+                        # Unmeasured (NaN) points of tracked lines are skipped
+                        channel_arr = self._integrate(param2, channel_arr)[1]
+
+                    result.set_line(i, X_arr, Y_arr, channel_arr)
+                    if table is not None:
+                        result.store_line(table, i)
+                    if worker is not None:
+                        worker.put(i, block=True)
+                    else:
+                        live_map.update(channel_arr)
+            finally:
+                if self._hold_magnet:
+                    self._hold_magnet = False
+                    self.PS.zero()
+                if worker is not None:
+                    self._worker = None
+
+        def on_items(items):
+            for i in items:
+                live_map.update(arr[result.line(i)])
+
+        if self.threaded_sweeps:
+            run_with_live_figure(acquire, on_items, live_map.fig)
+        else:
+            acquire()
+        live_map.finish()
+
+        if table is not None:
+            self.store.sync()
+        if table is None or self.save_csv:
+            np.save(save_dir + '\\' + filename, arr)
+        live_map.fig.savefig(save_dir + '\\' + filename + '.png', dpi=600)
+        return result
     
 
+    def measure_scan_costs(self, frequencies, fields, points=5, sen=None, read_reps=None, rep_delay=None,
+                           read_delay=None, sen_delay=None, from0delay=None, avg_func=None, line_s=0.5):
+        '''
+        Times points of a field and of a frequency sweep over the first
+        values of fields and frequencies (setpoint, settling, reading, as in
+        a sweep, nothing saved) for plan_scan.
+        Returns: ScanCosts
+        '''
+        self._prepare_lia(sen)
+        self._prepare_reads(read_reps, rep_delay)
+        read_delay = self._get_read_delay(read_delay)
+        cost = {}
+        try:
+            self.SG.set_frequency_ghz(frequencies[0])
+            delay = self._line_start_delay(from0delay, self.field2current(fields[0]))
+            self.PS.set_current(self.field2current(fields[0]))
+            time.sleep(delay)
+            for name, setter, values in [('field', self.PS.set_current, self.field2current(fields[:points])),
+                                         ('frequency', self.SG.set_frequency_ghz, frequencies[:points])]:
+                t0 = time.perf_counter()
+                for value in values:
+                    start = time.perf_counter()
+                    setter(value)
+                    self._settle(read_delay, start)
+                    self._read_point(avg_func, read_reps, rep_delay, sen_delay)
+                cost[name] = (time.perf_counter() - t0) / len(values)
+        finally:
+            self.PS.zero()
+        costs = ScanCosts(cost['field'], cost['frequency'], line_s=line_s, **self._magnet_costs(from0delay))
+        self._log('COSTS', repr(costs))
+        return costs
+
+    def _scan_costs(self, from0delay=None):
+        '''Costs for plan_scan when none were measured : equal point costs, magnet costs'''
+        return ScanCosts(**self._magnet_costs(from0delay))
+
+    def _magnet_costs(self, from0delay=None):
+        '''ScanCosts magnet terms : from0delay, or with 'ramp' the PS ramp time per Oe'''
+        from0delay = self._get_from0delay(from0delay)
+        if from0delay != 'ramp':
+            return {'from0_s': from0delay}
+        rate = self.PS.ramp_rate
+        return {'from0_s': 0.0, 'field_slew_s_per_oe': self.field2current(1.0) / rate if rate else 0.0}
+
+    def _find_map_table(self, result, resume):
+        '''
+        Table of the store to resume the map result from : the table named
+        resume, or the last one with the same axes, primary, channel and
+        integrate. None (logged) if there is none.
+        '''
+        if self.store is None:
+            self._log('ERR ', 'Nothing to resume, no store is open (see open_store).')
+            return None
+        if isinstance(resume, str):
+            names = [resume] if resume in self.store else []
+        else:
+            names = self.store.tables[::-1]
+        for name in names:
+            info = self.store[name].metadata
+            if info.get('primary') != result.primary or \
+                    any(info.get(key) != result.metadata[key] for key in ['channel', 'integrate']):
+                continue
+            if np.shape(info.get('frequencies')) == result.frequencies.shape and \
+                    np.shape(info.get('fields')) == result.fields.shape and \
+                    np.allclose(info['frequencies'], result.frequencies) and \
+                    np.allclose(info['fields'], result.fields):
+                return self.store[name]
+        self._log('ERR ', 'No map to resume in {}, starting a new one.'.format(self.store.path))
+        return None
+
+    def _restore_state(self, state):
+        '''Sets the SG level, LIA settings and delays stored by _instrument_state'''
+        if 'level_db' in state:
+            self.SG.level = float(state['level_db'])
+        if 'tc' in state:
+            self.LIA.TC = state['tc']
+        if 'slope_db' in state:
+            self.LIA.FilterSlope(str(int(state['slope_db']) // 6 - 1))
+        if 'sen' in state:
+            self.sen = state['sen']
+        for name in ['sen_delay', 'read_reps', 'rep_delay', 'read_delay', 'from0delay']:
+            if name in state:
+                setattr(self, name, state[name])
+        if 'ramp_rate' in state:
+            self.PS.ramp_rate = state['ramp_rate']
+        if state.get('avg_func') in ['mean', 'iqm', 'interquartile_mean', 'trimmed',
+                                     'trimmed_mean', 'median', 'huber']:
+            self.avg_func = state['avg_func']
+
+    def _track_line(self, tracker, frequency, fields, sweep_line):
+        '''
+        Measures the field line at frequency in the windows given by tracker
+        (only the fields not measured yet), until the resonance is found.
+        sweep_line(frequency, fields) measures fields and returns X, Y.
+        Returns: X, Y over fields (NaN where not measured), resonance field (NaN if not found)
+        '''
+        X = np.full(len(fields), np.nan)
+        Y = np.full(len(fields), np.nan)
+        measured = np.zeros(len(fields), dtype=bool)
+        for window in tracker.windows(frequency):
+            if window is None:
+                todo = ~measured
+            else:
+                centre, width = window
+                todo = (np.abs(fields - centre) <= width / 2.0) & ~measured
+            if todo.any():
+                X[todo], Y[todo] = sweep_line(frequency, fields[todo])
+                measured |= todo
+            field = tracker.locate(fields[measured], X[measured], Y[measured])
+            if field is not None:
+                tracker.add(frequency, field)
+                return X, Y, field
+            if self._stopping():
+                break
+        self._log('ERR ', 'No resonance found at {:.4g} GHz'.format(frequency))
+        return X, Y, np.nan
+
     def field2current(self, field):
         return field / 669
     
@@ -273,75 +956,139 @@ class Experiment():
         return current * 669
     
 
-    def _make_fig(self, title, xlabel, ylabel):
-        self.fig, self.ax = plt.subplots(figsize=(9,6))
-
-        self.l1, = self.ax.plot([], [], alpha=0.4, label='Channel 1 (X)')
-        self.l2, = self.ax.plot([], [], alpha=0.4, label='Channel 2 (Y)')
-        self.sc1 = self.ax.scatter([], [], s=10)
-        self.sc2 = self.ax.scatter([], [], s=10)
+    def _stopping(self):
+        '''True once a threaded sweep was asked to stop'''
+        return self._worker is not None and self._worker.stopping
 
-        self.ax.set_xlabel(xlabel)
-        self.ax.set_ylabel(ylabel)
-        self.ax.set_title(title)
-        self.ax.legend()
-        plt.show()
+    def _make_fig(self, title, xlabel, ylabel, xlim=None):
+        self.live_plot = LiveSweepPlot(title, xlabel, ylabel, xlim=xlim, max_fps=self.plot_fps)
+        self.fig, self.ax = self.live_plot.fig, self.live_plot.ax
 
     def _update_sweep_plot(self, xdata, ch1_data, ch2_data):
-        self.l1.remove()
-        self.l2.remove()
-        self.sc1.remove()
-        self.sc2.remove()
-
-        self.l1, = self.ax.plot(xdata, ch1_data, alpha=0.4, label='Channel 1 (X)', color='green')
-        self.l2, = self.ax.plot(xdata, ch2_data, alpha=0.4, label='Channel 2 (Y)', color='purple')
-        self.sc1 = self.ax.scatter(xdata, ch1_data, s=10, c='green')
-        self.sc2 = self.ax.scatter(xdata, ch2_data, s=10, c='purple')
+        # Rate limited, call self.live_plot.finish() after the last point
+        self.live_plot.update(xdata, ch1_data, ch2_data)
 
-        min_y = min(ch1_data.min(), ch2_data.min())
-        max_y = max(ch1_data.max(), ch2_data.max())
-        # self.ax.set_ylim(min_y - 0.05 * abs(min_y), max_y + 0.05 * abs(max_y))
-
-        # self.ax.legend()
-
-        self.fig.canvas.draw()
-        self.fig.canvas.flush_events()
+    def _finish_sweep_plot(self, save_dir, filename, savefig, closefig):
+        self.live_plot.finish()
+        if savefig:
+            self.fig.savefig(save_dir + '\\' + filename + '.png', dpi=600)
+        if closefig:
+            plt.close(self.fig)
 
     
     def readXY(self, avg_func, read_reps, rep_delay, sen_delay):
+        point = self._read_point(avg_func, read_reps, rep_delay, sen_delay)
+        return point['X'], point['Y']
+
+    def _read_point(self, avg_func, read_reps, rep_delay, sen_delay):
+        '''
+        Reads read_reps samples and averages them with avg_func.
+        Returns: dict of SweepResult columns (X, Y, sen, X_std, Y_std, reps,
+            X_err, Y_err : standard errors of X and Y)
+        '''
         read_reps = self._get_read_reps(read_reps)
         rep_delay = self._get_rep_delay(rep_delay)
         avg_func = self._get_avg_func(avg_func)
         sen_delay = self._get_sen_delay(sen_delay)
                 
-        X_arr, Y_arr = np.array([], dtype=float), np.array([], dtype=float)
-        for i in range(read_reps):
-            X, Y = self.LIA.returnXY()
-            X_arr = np.append(X_arr, X)
-            Y_arr = np.append(Y_arr, Y)
-            time.sleep(rep_delay)
-        Xval = avg_func(X_arr)
-        Yval = avg_func(Y_arr)
+        X_arr = []
+        if self._use_buffer(read_reps, rep_delay):
+            # Let the lock-in store the repetitions and read them in bulk
+            X_arr, Y_arr = self.LIA.getXY_buffered(read_reps, self._buffer_rate(rep_delay))
+        if not len(X_arr):
+            # Not buffered, or nothing stored (buffer timeout)
+            X_arr, Y_arr = self._read_reps(read_reps, rep_delay)
+        # Both channels in one call
+        (Xval, Yval), (X_err, Y_err) = get_estimator(avg_func)(np.vstack([X_arr, Y_arr]))
 
-        sen_ratio = abs(max(abs(Xval), abs(Yval)))/self.LIA.SEN
+        sen = self.LIA.SEN
+        sen_ratio = abs(max(abs(Xval), abs(Yval)))/sen
         if sen_ratio > 0.8:
             self.LIA.decrease_sensitivity()
             time.sleep(sen_delay)
-        return Xval, Yval
+        return {'X': Xval, 'Y': Yval, 'sen': sen, 'X_std': X_arr.std(), 'Y_std': Y_arr.std(),
+                'reps': len(X_arr), 'X_err': X_err, 'Y_err': Y_err}
     
+    def _read_reps(self, read_reps, rep_delay):
+        '''read_reps SNAP? reads, rep_delay s apart'''
+        reps = RepetitionBuffer(read_reps)
+        for i in range(read_reps):
+            reps.add(*self.LIA.getXY())
+            time.sleep(rep_delay)
+        return reps.values
+
+    def _buffer_rate(self, rep_delay):
+        return 512 if rep_delay <= 0 else 1.0 / rep_delay
+
+    def _use_buffer(self, read_reps, rep_delay):
+        '''
+        Whether the repetitions are read from the LIA buffer. With
+        buffered_reads='auto' : from the crossover of rep_delay if measured
+        (measure_read_crossover), else from the comparison made at the sweep
+        setup (see _prepare_reads), SNAP? reads if there was none.
+        '''
+        if read_reps <= 1 or not self.buffered_reads:
+            return False
+        if self.buffered_reads != 'auto':
+            return True
+        if rep_delay in self.read_crossover:
+            return read_reps >= self.read_crossover[rep_delay]
+        return self._read_choice.get((rep_delay, read_reps), False)
+
+    def _prepare_reads(self, read_reps, rep_delay):
+        '''
+        Sweep setup, before the first setpoint : with buffered_reads='auto'
+        and no measured crossover, times read_reps repetitions read both
+        ways once (cached per rep_delay and read_reps)
+        '''
+        read_reps = self._get_read_reps(read_reps)
+        rep_delay = self._get_rep_delay(rep_delay)
+        if self.buffered_reads != 'auto' or read_reps <= 1 or rep_delay in self.read_crossover \
+                or (rep_delay, read_reps) in self._read_choice:
+            return
+        self._read_choice[(rep_delay, read_reps)] = self._buffer_faster(read_reps, rep_delay)
+
+    def _buffer_faster(self, n, rep_delay):
+        '''Times n repetitions read one by one and from the LIA buffer'''
+        t0 = time.perf_counter()
+        self._read_reps(n, rep_delay)
+        t_snap = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        self.LIA.getXY_buffered(n, self._buffer_rate(rep_delay))
+        return time.perf_counter() - t0 < t_snap
+
+    def measure_read_crossover(self, rep_delay=None, reps=(2, 4, 8, 16, 32, 64)):
+        '''
+        Times read_reps repetitions read one by one (SNAP?) and from the LIA
+        buffer (SRAT / STRT / fill wait / PAUS / TRCB) for every count of
+        reps. The crossover is the smallest count from which the buffer is
+        faster for every larger count (inf if it never is), used with
+        buffered_reads='auto'. Run it once before the sweeps, it takes
+        hundreds of reads (tens of s with rep_delay > 0).
+        Returns: crossover (read_reps)
+        '''
+        rep_delay = self._get_rep_delay(rep_delay)
+        faster = [self._buffer_faster(n, rep_delay) for n in reps]
+        crossover = np.inf
+        for n, buffer_faster in zip(reps[::-1], faster[::-1]):
+            if not buffer_faster:
+                break
+            crossover = n
+        self.read_crossover[rep_delay] = crossover
+        self._log('XOVER', 'Buffered reads from {} repetitions (rep_delay {} s)'.format(crossover, rep_delay))
+        return crossover
+
     def avg_mid_50(self, arr):
-        return np.mean(arr[np.logical_and(arr >= np.percentile(arr, 25), arr <= np.percentile(arr, 75))])
+        return interquartile_mean(arr)[0]
     
 
-    def _integrate(self, xarr, varr, c=0.0):
-        varr = varr - np.mean(varr)
-        intg_x = np.insert(xarr, 0, xarr[0] - (xarr[1] - xarr[0]))
-        intg_y = np.array([c])
-        
-        for i in range(len(xarr)):
-            dydx = varr[i]
-            intg_y = np.append(intg_y, dydx * (intg_x[i + 1] - intg_x[i]) + intg_y[i])
-        return intg_x[1:], intg_y[1:]
+    def _integrate(self, xarr, varr, c=0.0, axis=-1, **kwargs):
+        '''
+        Mean subtracted integral of varr over xarr (a sweep, or a map along
+        axis). kwargs go to integration.integrate (method, baseline...).
+        Returns: xarr, integral
+        '''
+        return np.asarray(xarr), integrate(xarr, varr, axis=axis, c=c, **kwargs)
 
 ### Here lie some helper functions
 
@@ -1,16 +1,32 @@
+import contextlib as _contextlib
+import numpy as _np
 from instrument_base import InstrumentBase as _InstrumentBase
+from instrument_base import cached_setting as _cached_setting
 
 class HP_CWG(_InstrumentBase):
-    def __init__(self, GPIB_Address=15, GPIB_Device=0, ResourceName=None, logFile=None):
+    _cache_commands = {'FR': ['frequency'],
+                       'TR': ['frequency'],
+                       'W6': ['frequency'],
+                       'LE': ['level', 'range', 'vernier'],
+                       'RA': ['level', 'range'],
+                       'VE': ['level', 'vernier'],
+                       'RU': ['level', 'range'],
+                       'RD': ['level', 'range']}
+
+    def __init__(self, GPIB_Address=15, GPIB_Device=0, ResourceName=None, logFile=None, backend=None):
         if ResourceName is None:
             ResourceName = 'GPIB%d::%d::INSTR' % (GPIB_Device, GPIB_Address)
-        super().__init__(ResourceName, logFile)
+        super().__init__(ResourceName, logFile, backend)
         self._IDN = 'HP 8673G CW Gen'
         self.VI.write_termination = self.VI.LF
         self.VI.read_termination = self.VI.LF
         self.VI.clear()
         self.RF_ON = True
         self.SWEEP_MODE = 'Off'
+        self._last_command = None
+        self._deferred = False
+        self._check_every = None
+        self._pending_commands = []
         self.error_codes = {
             '00': 'NO ERROR.',
             '01': 'FREQUENCY OUT OF RANGE.',
@@ -41,12 +57,17 @@ class HP_CWG(_InstrumentBase):
             '99': 'RAM NOT FUNCTIONAL AT POWER UP.'
         }
         
-    def __del__(self):
-        "We'll reset the HP8673G and turn off the RF output"
-        self.VI.clear()
-        self.VI.write('R0')
-        self.RF_ON = False
-        super().__del__()
+    def close(self):
+        "We'll reset the HP8673G and turn off the RF output (last user of the session only)"
+        if not self._closed and self._last_user:
+            self.VI.clear()
+            self.VI.write('R0')
+            self.RF_ON = False
+        super().close()
+
+    def write(self, command):
+        super().write(command)
+        self._last_command = command
 
     def _frequencyIn(self, command):
         frequency_hz = self.query(command)[2:-2]
@@ -57,17 +78,21 @@ class HP_CWG(_InstrumentBase):
     
     ### Main frequency/Centre frequency (they seem to be the same thing to me) methods
     @property
+    @_cached_setting
     def frequency(self):
         return self._frequencyIn('OK')
     
     @frequency.setter
     def frequency(self, frequency_val):
-        self._frequencyOut(frequency_val, 'FR')
-        self._check_message()
+        self.setFrequency(frequency_val)
 
     def setFrequency(self, frequency_val):
         self._frequencyOut(frequency_val, 'FR')
         self._check_message()
+        self._cache_set('frequency', round(frequency_val, 9))
+
+    def set_frequency_ghz(self, frequency_val):
+        self.setFrequency(frequency_val)
     
     
     ### Start frequency methods
@@ -166,6 +191,7 @@ class HP_CWG(_InstrumentBase):
 
     ### Level, RANGE, and VERNIER methods
     @property
+    @_cached_setting
     def level(self):
         level_string = self.query('LE OA')
         return float(level_string[2:-2])
@@ -179,9 +205,11 @@ class HP_CWG(_InstrumentBase):
         else:
             self.write('LE {:.1f} DB'.format(value))
             self._check_message()
+            self._cache_set('level', round(float(value), 1))
 
     
     @property
+    @_cached_setting
     def range(self):
         range_string = self.query('RA OA')
         return int(range_string[2:-2])
@@ -197,9 +225,11 @@ class HP_CWG(_InstrumentBase):
         else:
             self.write('RA {} DB'.format(value))
             self._check_message()
+            self._cache_set('range', value)
 
 
     @property
+    @_cached_setting
     def vernier(self):
         vernier_string = self.query('VE OA')
         return float(vernier_string[2:-2])
@@ -213,6 +243,7 @@ class HP_CWG(_InstrumentBase):
         else:
             self.write('VE {:.1f} DB'.format(value))
             self._check_message()
+            self._cache_set('vernier', round(float(value), 1))
 
     
     def increase_range(self):
@@ -228,12 +259,75 @@ class HP_CWG(_InstrumentBase):
         code = self.query('MG')
         return code, self.error_codes[code]
     
+    def _raise_message(self, code, description, command):
+        self.invalidate_cache()
+        self._log('ERR ', 'Device message code {0}: {1} (command "{2}")'.format(code, description, command))
+        raise ValueError('Device message code {0}: {1} (command "{2}")'.format(code, description, command))
+
     def _check_message(self):
+        if self._deferred:
+            self._pending_commands.append(self._last_command)
+            if self._check_every and len(self._pending_commands) >= self._check_every:
+                self.check_pending_messages()
+            return None
+        code, description = self.message
+        if code == '00':
+            return None
+        self._raise_message(code, description, self._last_command)
+
+    def check_pending_messages(self):
+        '''
+        Checks the message register once for all the setter commands queued
+        in deferred mode. If there is an error the queued commands are resent
+        one at a time (they are all absolute settings) until the one causing
+        it is found, so the ValueError names the right command.
+        '''
+        pending, self._pending_commands = self._pending_commands, []
+        if not pending:
+            return None
         code, description = self.message
         if code == '00':
             return None
-        self._log('ERR ', 'Device message code {0}: {1}'.format(code, description))
-        raise ValueError('Device message code {0}: {1}'.format(code, description))
+        if len(pending) == 1:
+            self._raise_message(code, description, pending[0])
+        for command in pending:
+            self.write(command)
+            code, description = self.message
+            if code != '00':
+                self._raise_message(code, description, command)
+        # Could not be reproduced, report it against the whole block
+        self._raise_message(code, description, '; '.join(pending))
+
+    @_contextlib.contextmanager
+    def deferred_errors(self, check_every=None):
+        '''
+        Context manager that defers the message register check (MG) done
+        after every setter.
+
+        Usage :
+            with SG.deferred_errors(check_every=20):
+                for f in frequencies:
+                    SG.frequency = f
+                    ...
+
+        check_every : Check after this many setter commands (None = only at
+                      the end of the block).
+        '''
+        if self._deferred:
+            # Nested block, the outer one does the checking
+            yield self
+            return
+        self._deferred = True
+        self._check_every = check_every
+        try:
+            yield self
+        except BaseException:
+            self._pending_commands = []
+            raise
+        finally:
+            self._deferred = False
+            self._check_every = None
+        self.check_pending_messages()
     
 
     ### Trigger and sweep methods
@@ -257,6 +351,28 @@ class HP_CWG(_InstrumentBase):
             pass
         else:
             self.write('W{}'.format([0, 2, 3][['Off', 'Auto', 'Manual'].index(mode)]))
+            self.SWEEP_MODE = mode
 
     def begin_single_sweep(self):
-        self.write('W6')
\ No newline at end of file
+        self.write('W6')
+
+    def configure_stepped_sweep(self, start, stop, num_points):
+        '''
+        Programs the start / stop / number of steps registers for a stepped
+        sweep advanced with trigger().
+
+        Usage :
+            freqs = configure_stepped_sweep(2.0, 4.0, 201)
+            begin_single_sweep()  # Go to the start frequency
+            trigger()             # One step up
+
+        Returns the frequencies (GHz) the generator will actually step through
+        (the step size is rounded by the instrument).
+        '''
+        self.sweep_mode = 'Off'
+        self.startFrequency = start
+        self.stopFrequency = stop
+        self.numSteps = int(num_points - 1)
+        step = self.stepSize
+        self.sweep_mode = 'Manual'
+        return _np.minimum(start + step * _np.arange(num_points), stop)
\ No newline at end of file
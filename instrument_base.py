@@ -1,16 +1,209 @@
 import pyvisa
-import datetime
+import asyncio
+import atexit
+import concurrent.futures
+import functools
+import json
 import os
+import threading
 import numpy as np
 import time
+from buffered_log import get_logger
 
-__all__ = ['InstrumentBase']
+__all__ = ['InstrumentBase', 'ResourcePool', 'resource_pool', 'findResource', 'probe_resources',
+           'cached_setting', 'bus_executor']
 
-def findResource(search_string, filter_string='', query_string='*IDN?', open_delay=2, **kwargs):
+# Backend string for the in-process simulated rack (see sim_backend.py)
+SIM_BACKEND = '@sim'
+
+def open_resource_manager(backend=None):
+    '''
+    Returns a ResourceManager for backend.
+    backend=None picks the NI-VISA library on Windows and pyvisa-py elsewhere,
+    backend='@sim' returns the simulated rack.
+    '''
+    if backend is None:
+        if os.name == 'nt':
+            return pyvisa.ResourceManager()
+        return pyvisa.ResourceManager('@py')
+    if backend == SIM_BACKEND:
+        from sim_backend import SimResourceManager
+        return SimResourceManager()
+    return pyvisa.ResourceManager(backend)
+
+class ResourcePool(object):
+    '''
+    Process-wide pool of VISA ResourceManagers and sessions.
+    Hands out one ResourceManager per backend and shares open sessions
+    between everybody asking for the same ResourceName. Sessions are
+    reference counted and closed when their last user releases them.
+    Every session has one lock (see lock) shared by all its users.
+    '''
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._managers = {}
+        self._sessions = {}  # (backend, ResourceName) : [session, users, lock]
+
+    def resource_manager(self, backend=None):
+        '''Returns the shared ResourceManager of backend'''
+        with self._lock:
+            if backend not in self._managers:
+                self._managers[backend] = open_resource_manager(backend)
+            return self._managers[backend]
+
+    def open(self, ResourceName, backend=None, **kwargs):
+        '''
+        Returns an open session to ResourceName, reusing the pooled one if any.
+        kwargs are only used when a new session has to be opened.
+        '''
+        key = (backend, ResourceName)
+        with self._lock:
+            if key not in self._sessions:
+                VI = self.resource_manager(backend).open_resource(ResourceName, **kwargs)
+                self._sessions[key] = [VI, 0, threading.RLock()]
+            self._sessions[key][1] += 1
+            return self._sessions[key][0]
+
+    def _entry(self, VI):
+        for entry in self._sessions.values():
+            if entry[0] is VI:
+                return entry
+        return None
+
+    def lock(self, VI):
+        '''
+        Lock of session VI, shared by every user of the session, so two
+        instrument objects on one pooled session never interleave transactions
+        '''
+        with self._lock:
+            entry = self._entry(VI)
+            return threading.RLock() if entry is None else entry[2]
+
+    def users(self, VI):
+        '''Number of users of session VI (0 if it is not pooled)'''
+        with self._lock:
+            entry = self._entry(VI)
+            return 0 if entry is None else entry[1]
+
+    def release(self, VI):
+        '''Drops one user of session VI and closes it if nobody else uses it'''
+        with self._lock:
+            for key, entry in list(self._sessions.items()):
+                if entry[0] is VI:
+                    entry[1] -= 1
+                    if entry[1] <= 0:
+                        del self._sessions[key]
+                        VI.close()
+                    return
+
+    def is_open(self, ResourceName, backend=None):
+        return (backend, ResourceName) in self._sessions
+
+    def close_all(self, backend=None):
+        '''
+        Closes every pooled session and ResourceManager, or only those of
+        backend (e.g. '@sim' when the simulated rack is replaced)
+        '''
+        with self._lock:
+            for key, (VI, users, lock) in list(self._sessions.items()):
+                if backend is not None and key[0] != backend:
+                    continue
+                try:
+                    VI.close()
+                except Exception:
+                    pass
+                del self._sessions[key]
+            for key, rm in list(self._managers.items()):
+                if backend is not None and key != backend:
+                    continue
+                try:
+                    rm.close()
+                except Exception:
+                    pass
+                del self._managers[key]
+
+resource_pool = ResourcePool()
+atexit.register(resource_pool.close_all)
+
+# On-disk cache of resource name -> identity string used by findResource
+DEFAULT_CACHE_FILE = os.path.join(os.path.expanduser('~'), '.spinlab_visa_cache.json')
+
+def _load_idn_cache(cache_file):
+    if cache_file is None or not os.path.isfile(cache_file):
+        return {}
+    try:
+        with open(cache_file, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _save_idn_cache(cache_file, cache):
+    if cache_file is None:
+        return
+    try:
+        with open(cache_file, 'w') as f:
+            json.dump(cache, f, indent=1)
+    except OSError:
+        pass
+
+def _probe_resource(resource, backend, query_string, open_delay, timeout, **kwargs):
+    '''Opens resource and returns its answer to query_string (None on failure)'''
+    already_open = resource_pool.is_open(resource, backend)
+    try:
+        VI = resource_pool.open(resource, backend, timeout=int(timeout * 1000), **kwargs)
+    except Exception:
+        return None
+    try:
+        if not already_open:
+            time.sleep(open_delay)
+        VI.clear()
+        return VI.query(query_string).strip()
+    except Exception:
+        return None
+    finally:
+        resource_pool.release(VI)
+
+def probe_resources(resources, query_string='*IDN?', open_delay=2, timeout=2, backend=None,
+                    max_workers=8, **kwargs):
+    """Queries all resources concurrently for their identity.
+
+    Parameters:
+    resources (list): Resource names to probe.
+    query_string (str): The command you want to send to query a resource for its identity.
+    open_delay (float): Delay after the the resource is opned before the identity query is made.
+    timeout (float): Time in s a resource gets to answer (on top of open_delay).
+    backend (None | str): VISA backend, see open_resource_manager.
+    max_workers (int): Number of resources probed at the same time.
+
+    Returns: dict resource name : identity string (None if it did not answer)
+    """
+    resources = list(resources)
+    if not resources:
+        return {}
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+    futures = {executor.submit(_probe_resource, resource, backend, query_string,
+                               open_delay, timeout, **kwargs): resource
+               for resource in resources}
+    # Resources are probed in parallel so the whole scan is bounded by the slowest batch
+    batches = -(-len(resources) // max_workers)
+    done, _ = concurrent.futures.wait(futures, timeout=batches * (open_delay + timeout) + 1)
+    executor.shutdown(wait=False)
+    found = dict.fromkeys(resources)
+    for future in done:
+        found[futures[future]] = future.result()
+    return found
+
+def findResource(search_string, filter_string='', query_string='*IDN?', open_delay=2, backend=None,
+                 timeout=2, cache_file=DEFAULT_CACHE_FILE, max_workers=8, **kwargs):
     """Helps you look for a particular VISA instrument. You can cycle through all visable VISA
     resources and initialise them (initialise only the resources you want with filter_string), query
     them for their identity (can specify different identity commands), and look for the
     search_string in the returned identity.
+
+    Identities are cached in cache_file. Cached matches are checked with a single
+    identity query before anything else; only if that fails are all resources
+    probed (concurrently) and the cache rebuilt.
     
     Note: Do not use for the HP 8673G as I don't know its HP-IB query command. LMK if you do.
     
@@ -20,25 +213,84 @@ def findResource(search_string, filter_string='', query_string='*IDN?', open_del
     filter_string (str): The substring that you want your resources' names to have.
     query_string (str): The command you want to send to query a resource for its identity.
     open_delay (float): Delay after the the resource is opned before the identity query is made.
+    backend (None | str): VISA backend, see open_resource_manager.
+    timeout (float): Time in s a resource gets to answer (on top of open_delay).
+    cache_file (None | str): JSON cache of resource identities, None disables the cache.
+    max_workers (int): Number of resources probed at the same time.
     
-    Returns: None | ResourceManager object
+    Returns: None | resource name (str)
     """
-    if os.name == 'nt':
-        rm = pyvisa.ResourceManager()
-    else:
-        rm = pyvisa.ResourceManager('@py')
-    for resource in rm.list_resources():
-        if filter_string in resource:
-            VI = rm.open_resource(resource, **kwargs)
-            time.sleep(open_delay)
-            try:
-                VI.clear()
-                if search_string in VI.query(query_string):
-                    return resource
-            except:
-                pass
+    cache = _load_idn_cache(cache_file)
+    cache_key = '%s|%s' % (backend, query_string)
+    cached = cache.get(cache_key, {})
+    for resource, idn in cached.items():
+        if filter_string in resource and idn is not None and search_string in idn:
+            # One cheap query, no open_delay, to check the instrument is still there
+            if _probe_resource(resource, backend, query_string, 0, timeout, **kwargs) == idn:
+                return resource
+
+    rm = resource_pool.resource_manager(backend)
+    resources = [r for r in rm.list_resources() if filter_string in r]
+    found = probe_resources(resources, query_string, open_delay, timeout, backend,
+                            max_workers, **kwargs)
+    cached.update(found)
+    cache[cache_key] = cached
+    _save_idn_cache(cache_file, cache)
+    for resource in resources:
+        if found[resource] is not None and search_string in found[resource]:
+            return resource
     return None
 
+### Asynchronous I/O
+_bus_executors = {}
+_wait_executors = {}
+_bus_executors_lock = threading.Lock()
+
+def bus_name(ResourceName):
+    '''Interface part of ResourceName, e.g. GPIB0 for GPIB0::8::INSTR'''
+    return ResourceName.split('::')[0].upper()
+
+def bus_executor(ResourceName):
+    '''
+    Single thread executor shared by every instrument on the bus of
+    ResourceName. Asynchronous calls on one bus run one after the other,
+    like the bus itself does, calls on different buses run in parallel.
+
+    Everything on one bus (on GPIB0 : SG, LIA and PS) is serialized on this
+    one thread, so a call that mostly waits (PS ramp and settle polling)
+    holds up the other instruments for as long. Run those with
+    InstrumentBase.arun_blocking (see wait_executor).
+    '''
+    bus = bus_name(ResourceName)
+    with _bus_executors_lock:
+        if bus not in _bus_executors:
+            _bus_executors[bus] = concurrent.futures.ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix='bus_%s' % bus)
+        return _bus_executors[bus]
+
+def wait_executor(ResourceName):
+    '''
+    Single thread executor of the instrument at ResourceName for calls that
+    mostly wait between transactions. Its transactions still hold the
+    session lock, and interleave with the other instruments of the bus
+    one transaction at a time.
+    '''
+    with _bus_executors_lock:
+        if ResourceName not in _wait_executors:
+            _wait_executors[ResourceName] = concurrent.futures.ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix='wait_%s' % ResourceName)
+        return _wait_executors[ResourceName]
+
+def _shutdown_bus_executors():
+    with _bus_executors_lock:
+        for executor in list(_bus_executors.values()) + list(_wait_executors.values()):
+            executor.shutdown(wait=False)
+        _bus_executors.clear()
+        _wait_executors.clear()
+
+atexit.register(_shutdown_bus_executors)
+
+
 class ValuesFormat(object):
     def __init__(self):
         # Info: 
@@ -60,58 +312,188 @@ class ValuesFormat(object):
         self.converter = 'f'
         self.separator = ','
 
+
+def cached_setting(getter):
+    '''
+    Decorator for instrument setting getters (use below @property).
+    The first call queries the instrument, later calls are served from the
+    instrument's settings cache until it is invalidated (see InstrumentBase).
+    '''
+    key = getter.__name__
+
+    @functools.wraps(getter)
+    def cached_getter(self):
+        cache = self._settings_cache
+        if key not in cache:
+            cache[key] = getter(self)
+        return cache[key]
+    return cached_getter
+
         
 class InstrumentBase(object):
     '''
     Base class for all instrument classes in spinlab
+
+    Settings read with @cached_setting getters are kept in _settings_cache.
+    Setters should store the value they programmed with _cache_set. The cache
+    is dropped on *RST, refresh() and check_front_panel(); writes starting
+    with a header in _cache_commands drop the keys listed for that header.
+
+    Every transaction holds the lock of the VISA session (_lock, shared by
+    every instrument object on the same pooled session), so an instrument
+    can be used from several threads. The a* coroutines (awrite, aquery,
+    aquery_values, arun) run on the executor of the instrument's bus and let
+    an asyncio event loop wait for several instruments at once, arun_blocking
+    runs long waits off the bus thread.
     '''
 
-    def __init__(self, ResourceName, logFile=None, **kargs):
-        if os.name == 'nt':
-            rm = pyvisa.ResourceManager()
-        else:
-            rm = pyvisa.ResourceManager('@py')
-        self.VI = rm.open_resource(ResourceName, **kargs)
+    # Command header : cache keys invalidated when it is written
+    _cache_commands = {}
+
+    def __init__(self, ResourceName, logFile=None, backend=None, **kargs):
+        self._closed = True
+        self.VI = resource_pool.open(ResourceName, backend, **kargs)
+        self._closed = False
         self._IDN = self.VI.resource_name
         if logFile is None:
             self._logFile = None
+            self._logger = None
         else:
-            if not os.path.isfile(logFile):
-                with open(logFile, 'w') as log:
-                    log.write('SpinLab Instruments LogFile\n')
-            self._logFile = os.path.abspath(logFile)
+            self._logger = get_logger(logFile)
+            self._logFile = self._logger.logFile
         self._logWrite('OPEN_')
         self.values_format = ValuesFormat()
+        self._settings_cache = {}
+        self._lock = resource_pool.lock(self.VI)
+        self._executor = bus_executor(self.VI.resource_name)
+        self._wait_executor = wait_executor(self.VI.resource_name)
 
-    def __del__(self):
+    def close(self):
+        '''Release the VISA session and the log file. Safe to call twice.'''
+        if self._closed:
+            return
+        self._closed = True
         self._logWrite('CLOSE')
-        self.VI.close()
+        resource_pool.release(self.VI)
+        if self._logger is not None:
+            self._logger.release()
+
+    @property
+    def _last_user(self):
+        '''True if no other object uses the pooled session, shutdown commands are only sent then'''
+        return resource_pool.users(self.VI) <= 1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __del__(self):
+        # Last resort only, call close() explicitly
+        if not getattr(self, '_closed', True):
+            self.close()
 
     def __str__(self):
         return "%s : %s" % ('spinlab.instrument', self._IDN)
 
     def _logWrite(self, action, value=''):
-        if self._logFile is not None:
-            with open(self._logFile, 'a') as log:
-                timestamp = datetime.datetime.utcnow()
-                log.write('%s %s %s : %s \n' %
-                          (timestamp, self._IDN, action, repr(value)))
+        if self._logger is not None:
+            self._logger.log(self._IDN, action, value)
     _log = _logWrite
 
     def write(self, command):
-        self._logWrite('write', command)
-        self.VI.write(command)
+        with self._lock:
+            self._logWrite('write', command)
+            self.VI.write(command)
+            self._invalidate_for(command)
+
+    ### Asynchronous I/O
+    def _locked_call(self, func, *args, **kwargs):
+        with self._lock:
+            return func(*args, **kwargs)
+
+    async def arun(self, func, *args, **kwargs):
+        '''
+        Runs func(*args, **kwargs) on the bus executor holding the instrument
+        lock, so a compound operation (e.g. set_current) stays atomic.
+        Usage : await PS.arun(PS.set_current, 1.5)
+        '''
+        loop = asyncio.get_running_loop()
+        call = functools.partial(self._locked_call, func, *args, **kwargs)
+        return await loop.run_in_executor(self._executor, call)
+
+    async def arun_blocking(self, func, *args, **kwargs):
+        '''
+        arun on the instrument's own thread (see wait_executor) instead of
+        the bus executor, for calls that mostly wait, e.g.
+        await PS.arun_blocking(PS.set_current, 1.5)
+        '''
+        loop = asyncio.get_running_loop()
+        call = functools.partial(self._locked_call, func, *args, **kwargs)
+        return await loop.run_in_executor(self._wait_executor, call)
+
+    async def awrite(self, command):
+        return await self.arun(self.write, command)
+
+    async def aquery(self, command):
+        return await self.arun(self.query, command)
+
+    async def aquery_values(self, command, data_points=None):
+        return await self.arun(self.query_values, command, data_points)
+
+    ### Settings cache
+    def _invalidate_for(self, command):
+        if '*RST' in command:
+            self._settings_cache.clear()
+            return
+        for header, keys in self._cache_commands.items():
+            if command.startswith(header):
+                for key in keys:
+                    self._settings_cache.pop(key, None)
+
+    def _cache_set(self, key, value):
+        self._settings_cache[key] = value
+
+    def invalidate_cache(self, key=None):
+        '''Forget one cached setting (or all of them if key is None)'''
+        if key is None:
+            self._settings_cache.clear()
+        else:
+            self._settings_cache.pop(key, None)
+
+    def refresh(self):
+        '''Forget every cached setting, the next reads query the instrument'''
+        self._logWrite('refresh')
+        self.invalidate_cache()
+
+    def _front_panel_changed(self):
+        # Instruments able to detect local (front panel) changes override this
+        return False
+
+    def check_front_panel(self):
+        '''
+        Drops the settings cache if the instrument was changed by hand.
+        Returns True in that case.
+        '''
+        if self._front_panel_changed():
+            self._logWrite('front panel change')
+            self.refresh()
+            return True
+        return False
 
     def read(self):
-        self._logWrite('read ')
-        returnR = self.VI.read()
-        self._logWrite('resp ', returnR)
+        with self._lock:
+            self._logWrite('read ')
+            returnR = self.VI.read()
+            self._logWrite('resp ', returnR)
         return returnR
     
     def query(self, command):
-        self._logWrite('query', command)
-        returnQ = self.VI.query(command)
-        self._logWrite('resp ', returnQ)
+        with self._lock:
+            self._logWrite('query', command)
+            returnQ = self.VI.query(command)
+            self._logWrite('resp ', returnQ)
         return returnQ
 
     def query_type(self, command, type_caster):
@@ -129,8 +511,13 @@ class InstrumentBase(object):
     def query_float(self, command):
         return self.query_type(command, float)
 
-    def query_values(self, command):
+    def query_values(self, command, data_points=None):
+        with self._lock:
+            return self._query_values(command, data_points)
+
+    def _query_values(self, command, data_points=None):
         # NOTE: self.values_format should be set to the adequate format
+        # data_points is needed for binary transfers without a length header
         if self.values_format.is_binary:
             read_term = self.VI.read_termination
             self.VI.read_termination = None
@@ -140,6 +527,9 @@ class InstrumentBase(object):
                        'header_fmt': self.values_format.header_fmt,
                        'delay': self.values_format.delay,
                        'container': self.values_format.container}
+            if data_points is not None:
+                options['data_points'] = data_points
+                options['expect_termination'] = False
             data = self.VI.query_binary_values(command, **options)
             self.VI.read_termination = read_term
         else:
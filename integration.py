@@ -0,0 +1,80 @@
+# coding=utf-8
+
+# Integration of lock-in (field derivative) signals.
+#
+# integrate() is a cumulative sum along one axis, so a single sweep and a
+# whole map (every row or every column at once) take the same vectorised
+# path. Points that were not measured (NaN) add nothing and stay NaN.
+
+import numpy as np
+
+__all__ = ['integrate']
+
+
+def integrate(x, v, axis=-1, c=0.0, subtract_mean=True, method='rectangle', baseline=None):
+    '''
+    Integrates v over x along axis.
+
+    Parameters:
+    x (array): Abscissa, either the shape of v or 1D along axis.
+    v (array): Signal (1D sweep or map).
+    axis (int): Axis of v to integrate along.
+    c (float): Integration constant (value before the first point).
+    subtract_mean (bool): Subtract the mean of every line first (removes
+        the constant offset of the derivative signal).
+    method (str): 'rectangle' : y[i] = c + sum(k <= i) v[k] * (x[k] - x[k-1]),
+            the first step taken equal to the second one (historical
+            Experiment._integrate result).
+        'trapezoid' : y[0] = c, then trapezoidal steps.
+    baseline (str | None): 'linear' subtracts the straight line through the
+        first and last integrated point of every line (then adds c), for
+        derivative signals with a slowly drifting offset.
+
+    Returns: array shaped like v
+    '''
+    v = np.asarray(v, dtype=float)
+    axis = axis % v.ndim
+    x = np.asarray(x, dtype=float)
+    if x.ndim == 1 and v.ndim > 1:
+        shape = [1] * v.ndim
+        shape[axis] = len(x)
+        x = x.reshape(shape)
+    x = np.broadcast_to(x, v.shape)
+
+    missing = np.isnan(v)
+    if subtract_mean:
+        with np.errstate(invalid='ignore'):
+            v = v - np.nanmean(np.where(missing, np.nan, v), axis=axis, keepdims=True)
+    v = np.where(missing, 0.0, v)
+
+    n = v.shape[axis]
+    dx = np.diff(x, axis=axis)
+    if method == 'rectangle':
+        first = np.take(dx, [0], axis=axis) if n > 1 else np.zeros_like(np.take(x, [0], axis=axis))
+        steps = v * np.concatenate([first, dx], axis=axis)
+    elif method == 'trapezoid':
+        head = np.take(v, np.arange(n - 1), axis=axis)
+        tail = np.take(v, np.arange(1, n), axis=axis)
+        steps = np.concatenate([np.zeros_like(np.take(v, [0], axis=axis)),
+                                0.5 * (head + tail) * dx], axis=axis)
+    else:
+        raise ValueError('Unknown integration method %r' % method)
+    y = c + np.cumsum(steps, axis=axis)
+
+    if baseline == 'linear':
+        valid = ~missing
+        # First and last measured point of every line
+        index = np.arange(n).reshape([-1 if i == axis else 1 for i in range(v.ndim)])
+        lo = np.where(valid, index, n).min(axis=axis, keepdims=True)
+        hi = np.where(valid, index, -1).max(axis=axis, keepdims=True)
+        lo, hi = np.minimum(lo, n - 1), np.maximum(hi, 0)
+        x0, x1 = np.take_along_axis(x, lo, axis), np.take_along_axis(x, hi, axis)
+        y0, y1 = np.take_along_axis(y, lo, axis), np.take_along_axis(y, hi, axis)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            slope = np.where(x1 != x0, (y1 - y0) / (x1 - x0), 0.0)
+        y = y - (y0 + slope * (x - x0)) + c
+    elif baseline is not None:
+        raise ValueError('Unknown baseline %r' % baseline)
+
+    y[missing] = np.nan
+    return y
@@ -0,0 +1,218 @@
+# coding=utf-8
+
+# Lineshape fitting and Kittel / damping extraction.
+#
+# Every channel of a sweep is fitted to the derivative of a symmetric plus
+# an antisymmetric Lorentzian sharing the resonance Hr and the half width
+# dH (u = (H - Hr) / dH) :
+#     y = S * -2u / (1 + u**2)**2 + A * (1 - u**2) / (1 + u**2)**2 + c
+# by Levenberg-Marquardt with the analytic Jacobian. The model is linear in
+# S, A and c, so the start values only need Hr and dH, taken from the
+# extrema of the line (see batch_analysis.extract_line).
+#
+# The resonances and widths of all field sweeps are then fitted globally:
+#     f = gamma * sqrt(Hr * (Hr + 4 pi Meff)),  gamma = g * muB / h
+#     dH = dH0 + alpha * f / gamma                  (Gilbert damping)
+#
+# Usage :
+#     table, summary = characterise_directory(r'...\Data\NiFe_2')
+
+import numpy as np
+import pandas as pd
+import scipy.optimize
+
+from batch_analysis import read_sweep, map_files, parse_sweep_name, extract_line, _glob_paths
+from tracking import fit_kittel
+
+__all__ = ['lorentzian_derivative', 'fit_lineshape', 'fit_sweep', 'fit_directory',
+           'fit_kittel_g', 'fit_damping', 'characterise_directory']
+
+# muB / h in GHz/Oe
+MUB_H = 1.39962449E-3
+
+
+def _errors(J, residual, n_params):
+    '''Standard errors from the Jacobian J, NaN if the fit is degenerate'''
+    dof = max(len(residual) - n_params, 1)
+    if not (np.all(np.isfinite(J)) and np.all(np.isfinite(residual))):
+        return np.full(n_params, np.nan)
+    with np.errstate(over='ignore', invalid='ignore'):
+        JTJ = J.T @ J
+    if not np.all(np.isfinite(JTJ)) or np.linalg.matrix_rank(JTJ) < n_params:
+        return np.full(n_params, np.nan)
+    try:
+        cov = np.linalg.inv(JTJ) * (residual @ residual) / dof
+    except np.linalg.LinAlgError:
+        return np.full(n_params, np.nan)
+    return np.sqrt(np.abs(np.diag(cov)))
+
+
+def _shapes(x, Hr, dH):
+    u = (x - Hr) / dH
+    D = 1 + u**2
+    f_s = -2 * u / D**2
+    f_a = (1 - u**2) / D**2
+    # Derivatives with respect to u
+    df_s = (6 * u**2 - 2) / D**3
+    df_a = (2 * u**3 - 6 * u) / D**3
+    return u, f_s, f_a, df_s, df_a
+
+
+def lorentzian_derivative(x, Hr, dH, S, A, c=0.0):
+    '''Symmetric (S) plus antisymmetric (A) Lorentzian derivative, offset c'''
+    _, f_s, f_a, _, _ = _shapes(np.asarray(x, dtype=float), Hr, dH)
+    return S * f_s + A * f_a + c
+
+
+def _model(p, x, n):
+    Hr, dH = p[:2]
+    _, f_s, f_a, _, _ = _shapes(x, Hr, dH)
+    amps = p[2:].reshape(n, 3)
+    return amps[:, :1] * f_s + amps[:, 1:2] * f_a + amps[:, 2:]
+
+
+def _jacobian(p, x, n):
+    # Rows: channel by channel, columns: Hr, dH, then (S, A, c) per channel
+    Hr, dH = p[:2]
+    u, f_s, f_a, df_s, df_a = _shapes(x, Hr, dH)
+    amps = p[2:].reshape(n, 3)
+    dy_du = amps[:, :1] * df_s + amps[:, 1:2] * df_a
+    J = np.zeros((n, len(x), 2 + 3 * n))
+    J[:, :, 0] = -dy_du / dH
+    J[:, :, 1] = -dy_du * u / dH
+    for i in range(n):
+        J[i, :, 2 + 3 * i] = f_s
+        J[i, :, 3 + 3 * i] = f_a
+        J[i, :, 4 + 3 * i] = 1
+    return J.reshape(n * len(x), -1)
+
+
+def _linear_amplitudes(x, ys, Hr, dH):
+    _, f_s, f_a, _, _ = _shapes(x, Hr, dH)
+    basis = np.column_stack([f_s, f_a, np.ones_like(x)])
+    return np.linalg.lstsq(basis, ys.T, rcond=None)[0].T
+
+
+def fit_lineshape(x, ys, p0=None):
+    '''
+    Fits the channels ys (list of arrays over x) with one Hr and dH.
+
+    p0 (Hr, dH) : start values, from the extrema of the strongest channel if None.
+    Returns: dict Hr, dH (half width), their standard errors, S / A / c per
+        channel (lists), rms residual, success
+    '''
+    x = np.asarray(x, dtype=float)
+    ys = np.atleast_2d(np.asarray(ys, dtype=float))
+    keep = np.isfinite(x) & np.all(np.isfinite(ys), axis=0)
+    x, ys = x[keep], ys[:, keep]
+    n = len(ys)
+    if p0 is None:
+        strongest = ys[np.argmax(np.ptp(ys, axis=1))]
+        Hr, pp, _ = extract_line(x, strongest, smooth=1)
+        # Peak to peak width of the absorption derivative is 2 dH / sqrt(3)
+        p0 = (Hr, max(pp * np.sqrt(3) / 2, np.min(np.diff(np.sort(x)))))
+    amps = _linear_amplitudes(x, ys, *p0)
+    start = np.concatenate([p0, amps.ravel()])
+    scale = max(np.abs(ys).max(), 1E-300)
+    fit = scipy.optimize.least_squares(
+        lambda p: (_model(p, x, n) - ys).ravel() / scale, start,
+        jac=lambda p: _jacobian(p, x, n) / scale, method='lm')
+    p = fit.x
+    residual = fit.fun * scale
+    errors = _errors(fit.jac, fit.fun, len(p))
+    amps = p[2:].reshape(n, 3)
+    return {'Hr': p[0], 'dH': abs(p[1]), 'Hr_err': errors[0], 'dH_err': errors[1],
+            'S': list(amps[:, 0]), 'A': list(amps[:, 1]), 'c': list(amps[:, 2]),
+            'rms': np.sqrt(np.mean(residual**2)), 'success': bool(fit.success)}
+
+
+def fit_sweep(path, channels=('X', 'Y')):
+    '''Fits one sweep CSV, returns a table row (see fit_directory)'''
+    row = {'file': path}
+    row.update(parse_sweep_name(path))
+    try:
+        kind, x, ys = read_sweep(path, channels)
+        result = fit_lineshape(x, ys)
+        row.update({'sweep': kind, 'resonance': result['Hr'], 'resonance_err': result['Hr_err'],
+                    'linewidth': result['dH'], 'linewidth_err': result['dH_err'],
+                    'symmetric': result['S'][0], 'antisymmetric': result['A'][0],
+                    'rms': result['rms'], 'error': '' if result['success'] else 'not converged'})
+    except Exception as E:
+        row.update({'sweep': '', 'resonance': np.nan, 'resonance_err': np.nan, 'linewidth': np.nan,
+                    'linewidth_err': np.nan, 'symmetric': np.nan, 'antisymmetric': np.nan,
+                    'rms': np.nan, 'error': repr(E)})
+    return row
+
+
+def fit_directory(directory, pattern='*.csv', channels=('X', 'Y'), processes=None, chunk_size=16):
+    '''
+    Fits every sweep CSV of directory (or a list of paths) on a process pool.
+
+    Returns: DataFrame, one row per file, with file, sweep, frequency_ghz,
+        field_Oe, level_db, resonance, linewidth (half width) and their
+        errors, symmetric / antisymmetric amplitudes of the first channel,
+        rms residual and error (empty if fitted)
+    '''
+    rows = map_files(fit_sweep, _glob_paths(directory, pattern), (tuple(channels),),
+                     processes, chunk_size)
+    columns = ['file', 'sweep', 'frequency_ghz', 'field_Oe', 'level_db', 'resonance', 'resonance_err',
+               'linewidth', 'linewidth_err', 'symmetric', 'antisymmetric', 'rms', 'error']
+    table = pd.DataFrame(rows, columns=columns)
+    return table.sort_values(['frequency_ghz', 'field_Oe'], kind='stable').reset_index(drop=True)
+
+
+def fit_kittel_g(frequencies, fields, errors=None):
+    '''
+    In-plane Kittel fit f = g * muB/h * sqrt(H * (H + 4 pi Meff)).
+    errors (of the fields) weight the fit if given.
+    Returns: dict g, Meff_4pi (G), Ms (emu/cm3, = Meff_4pi / 4 pi), their errors
+    '''
+    f = np.asarray(frequencies, dtype=float)
+    H = np.asarray(fields, dtype=float)
+    sigma = np.ones_like(H) if errors is None else np.where(np.asarray(errors) > 0, errors, 1.0)
+    gyro, Meff = fit_kittel(f, H)
+
+    def residual(p):
+        return (H - (-p[1] / 2 + np.sqrt(p[1]**2 / 4 + (f / (p[0] * MUB_H))**2))) / sigma
+
+    fit = scipy.optimize.least_squares(residual, [gyro / MUB_H, Meff], method='lm')
+    g_err, M_err = _errors(fit.jac, fit.fun, 2)
+    g, Meff = fit.x
+    return {'g': g, 'g_err': g_err, 'Meff_4pi': Meff, 'Meff_4pi_err': M_err,
+            'Ms': Meff / (4 * np.pi), 'Ms_err': M_err / (4 * np.pi)}
+
+
+def fit_damping(frequencies, linewidths, g, errors=None):
+    '''
+    Linear fit of the half width dH = dH0 + alpha * f / (g * muB/h).
+    Returns: dict alpha, dH0 (Oe) and their errors
+    '''
+    f = np.asarray(frequencies, dtype=float)
+    dH = np.asarray(linewidths, dtype=float)
+    w = np.ones_like(dH) if errors is None else 1 / np.where(np.asarray(errors) > 0, errors, 1.0)
+    basis = np.column_stack([np.ones_like(f), f]) * w[:, None]
+    (dH0, slope), _, _, _ = np.linalg.lstsq(basis, dH * w, rcond=None)
+    residual = (dH - dH0 - slope * f) * w
+    dH0_err, slope_err = _errors(basis, residual, 2)
+    gyro = g * MUB_H
+    return {'alpha': slope * gyro, 'alpha_err': slope_err * gyro, 'dH0': dH0, 'dH0_err': dH0_err}
+
+
+def characterise_directory(directory, pattern='*.csv', channels=('X', 'Y'), processes=None,
+                           weighted=True):
+    '''
+    fit_directory, then the Kittel (g, Meff) and damping (alpha, dH0) fits
+    over the converged field sweeps.
+    Returns: table, summary dict
+    '''
+    table = fit_directory(directory, pattern, channels, processes)
+    ok = (table['sweep'] == 'field') & (table['error'] == '') \
+        & np.isfinite(table['frequency_ghz']) & np.isfinite(table['resonance'])
+    fits = table[ok]
+    summary = {'sweeps': len(table), 'fitted': int(ok.sum())}
+    if len(fits) >= 3:
+        summary.update(fit_kittel_g(fits['frequency_ghz'], fits['resonance'],
+                                    fits['resonance_err'] if weighted else None))
+        summary.update(fit_damping(fits['frequency_ghz'], fits['linewidth'], summary['g'],
+                                   fits['linewidth_err'] if weighted else None))
+    return table, summary
@@ -0,0 +1,252 @@
+# coding=utf-8
+
+# Live figures for the FMR sweeps.
+#
+# LiveSweepPlot keeps its line and scatter artists for the whole sweep and
+# only updates their data. Redraws are blitted (the static background is
+# cached) and capped at max_fps, however fast points arrive. The axes limits
+# grow in steps with some headroom, so a full redraw is only needed when the
+# data leaves the current view.
+#
+# LiveMapPlot does the same for make2D: the mesh is created once over the
+# whole (NaN filled) map and only its data and color limits are updated.
+
+import time
+import numpy as np
+import matplotlib.pyplot as plt
+
+__all__ = ['LiveSweepPlot', 'LiveMapPlot']
+
+
+class LiveSweepPlot(object):
+    '''
+    Live X / Y plot of a 1D sweep.
+
+    Parameters:
+    title, xlabel, ylabel (str): Figure labels.
+    xlim (tuple | None): Fixed x range (e.g. the whole sweep), autoscaled if None.
+    max_fps (float): Maximum redraws per second.
+    headroom (float): Fraction of the data range added when the y axis grows.
+    '''
+
+    def __init__(self, title, xlabel, ylabel, xlim=None, max_fps=10, headroom=0.2, figsize=(9, 6)):
+        self.fig, self.ax = plt.subplots(figsize=figsize)
+        self.max_fps = max_fps
+        self.headroom = headroom
+        self._fixed_xlim = xlim is not None
+        self._xlim = None
+
+        ax = self.ax
+        self.l1, = ax.plot([], [], alpha=0.4, label='Channel 1 (X)', color='green', animated=True)
+        self.l2, = ax.plot([], [], alpha=0.4, label='Channel 2 (Y)', color='purple', animated=True)
+        self.sc1 = ax.scatter([], [], s=10, c='green', animated=True)
+        self.sc2 = ax.scatter([], [], s=10, c='purple', animated=True)
+        self.artists = [self.l1, self.l2, self.sc1, self.sc2]
+
+        ax.set_xlabel(xlabel)
+        ax.set_ylabel(ylabel)
+        ax.set_title(title)
+        ax.legend(loc='upper right')
+        if xlim is not None and xlim[0] != xlim[1]:
+            ax.set_xlim(min(xlim), max(xlim))
+        ax.set_ylim(-1E-9, 1E-9)
+
+        self._background = None
+        self._last_draw = 0.0
+        self._pending = None
+        self.redraws = 0
+        self.blits = 0
+        self.fig.canvas.mpl_connect('draw_event', self._on_draw)
+        plt.show(block=False)
+        self._full_redraw()
+
+    def _on_draw(self, event):
+        # Any full draw (resize, zoom...) invalidates the cached background
+        self._background = self.fig.canvas.copy_from_bbox(self.ax.bbox)
+        for artist in self.artists:
+            self.ax.draw_artist(artist)
+
+    def _full_redraw(self):
+        self.redraws += 1
+        self.fig.canvas.draw()
+        self.fig.canvas.flush_events()
+
+    def _blit(self):
+        canvas = self.fig.canvas
+        if self._background is None or not getattr(canvas, 'supports_blit', False):
+            self._full_redraw()
+            return
+        self.blits += 1
+        canvas.restore_region(self._background)
+        for artist in self.artists:
+            self.ax.draw_artist(artist)
+        canvas.blit(self.ax.bbox)
+        canvas.flush_events()
+
+    def _grow_limits(self, x, ch1, ch2):
+        '''Expands the view to contain the data, returns True if it changed'''
+        changed = False
+        ax = self.ax
+        y = np.concatenate([ch1, ch2])
+        y = y[np.isfinite(y)]
+        if len(y):
+            ymin, ymax = ax.get_ylim()
+            lo, hi = y.min(), y.max()
+            if lo < ymin or hi > ymax:
+                pad = self.headroom * max(hi - lo, abs(hi), abs(lo), 1E-12)
+                ax.set_ylim(min(lo - pad, ymin), max(hi + pad, ymax))
+                changed = True
+        if not self._fixed_xlim and len(x):
+            lo, hi = np.nanmin(x), np.nanmax(x)
+            pad = self.headroom * max(hi - lo, 1E-12)
+            if self._xlim is None:
+                self._xlim = (lo - pad, hi + pad)
+            elif lo < self._xlim[0] or hi > self._xlim[1]:
+                self._xlim = (min(lo - pad, self._xlim[0]), max(hi + pad, self._xlim[1]))
+            else:
+                return changed
+            ax.set_xlim(*self._xlim)
+            changed = True
+        return changed
+
+    def update(self, xdata, ch1_data, ch2_data, force=False):
+        '''
+        Sets the plotted data. The figure is redrawn at most max_fps times
+        per second unless force is True; skipped updates are kept and drawn
+        by the next redraw or by finish().
+        '''
+        self._pending = (xdata, ch1_data, ch2_data)
+        now = time.perf_counter()
+        if not force and self.max_fps and (now - self._last_draw) < 1.0 / self.max_fps:
+            return False
+        self._draw_pending()
+        self._last_draw = time.perf_counter()
+        return True
+
+    def _draw_pending(self):
+        if self._pending is None:
+            return
+        x, ch1, ch2 = self._pending
+        self._pending = None
+        self.l1.set_data(x, ch1)
+        self.l2.set_data(x, ch2)
+        self.sc1.set_offsets(np.column_stack([x, ch1]))
+        self.sc2.set_offsets(np.column_stack([x, ch2]))
+        if self._grow_limits(x, ch1, ch2):
+            self._full_redraw()
+        else:
+            self._blit()
+
+    def finish(self):
+        '''
+        Draws the last data and turns the artists into normal (non animated)
+        ones so savefig includes them.
+        '''
+        self._draw_pending()
+        for artist in self.artists:
+            artist.set_animated(False)
+        self._full_redraw()
+
+
+class LiveMapPlot(object):
+    '''
+    Live frequency x field map.
+
+    Parameters:
+    fields, frequencies (array): Axes of the map (point centers).
+    data (array): The (frequencies x fields) map, NaN where not measured.
+        It is shared, not copied: fill it in place and call update().
+    title (str): Figure title.
+    max_fps (float): Maximum redraws per second.
+    headroom (float): Fraction of the data range added when the color limits grow.
+    '''
+
+    def __init__(self, fields, frequencies, data, title, max_fps=2, headroom=0.1,
+                 cmap='coolwarm', figsize=(10, 7)):
+        self.fig, self.ax = plt.subplots(figsize=figsize)
+        self.data = data
+        self.max_fps = max_fps
+        self.headroom = headroom
+        self.mesh = self.ax.pcolormesh(fields, frequencies, data, shading='nearest',
+                                       cmap=cmap, animated=True)
+        self.mesh.set_clim(-1E-9, 1E-9)
+        self.cbar = self.fig.colorbar(self.mesh)
+        self.ax.set_xlabel('Field (Oe)')
+        self.ax.set_ylabel('Frequency (GHz)')
+        self.ax.set_title(title)
+
+        self._clim = None
+        self._clim_changed = False
+        self._background = None
+        self._last_draw = 0.0
+        self._dirty = False
+        self.redraws = 0
+        self.blits = 0
+        self.fig.canvas.mpl_connect('draw_event', self._on_draw)
+        plt.show(block=False)
+        self._full_redraw()
+
+    def _on_draw(self, event):
+        self._background = self.fig.canvas.copy_from_bbox(self.ax.bbox)
+        self.ax.draw_artist(self.mesh)
+
+    def _full_redraw(self):
+        self.redraws += 1
+        self.fig.canvas.draw()
+        self.fig.canvas.flush_events()
+
+    def _grow_clim(self, values):
+        '''Expands the color limits to contain values, returns True if they changed'''
+        values = np.asarray(values)
+        values = values[np.isfinite(values)]
+        if not len(values):
+            return False
+        lo, hi = values.min(), values.max()
+        if self._clim is not None and lo >= self._clim[0] and hi <= self._clim[1]:
+            return False
+        if self._clim is not None:
+            lo, hi = min(lo, self._clim[0]), max(hi, self._clim[1])
+        pad = self.headroom * max(hi - lo, 1E-12)
+        self._clim = (lo - pad, hi + pad)
+        self.mesh.set_clim(*self._clim)
+        return True
+
+    def update(self, values=None, force=False):
+        '''
+        Call after writing a new row / column into data; values (the new
+        line) is used to grow the color limits. Redraws at most max_fps times
+        per second unless force is True.
+        '''
+        if values is not None and self._grow_clim(values):
+            self._clim_changed = True
+        self._dirty = True
+        now = time.perf_counter()
+        if not force and self.max_fps and (now - self._last_draw) < 1.0 / self.max_fps:
+            return False
+        self._draw()
+        self._last_draw = time.perf_counter()
+        return True
+
+    def _draw(self):
+        if not self._dirty:
+            return
+        self._dirty = False
+        self.mesh.set_array(self.data)
+        canvas = self.fig.canvas
+        if self._clim_changed or self._background is None \
+                or not getattr(canvas, 'supports_blit', False):
+            # The colorbar has to be redrawn too
+            self._clim_changed = False
+            self._full_redraw()
+            return
+        self.blits += 1
+        canvas.restore_region(self._background)
+        self.ax.draw_artist(self.mesh)
+        canvas.blit(self.ax.bbox)
+        canvas.flush_events()
+
+    def finish(self):
+        '''Draws the last data and makes the mesh non animated so savefig includes it'''
+        self._draw()
+        self.mesh.set_animated(False)
+        self._full_redraw()
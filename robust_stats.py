@@ -0,0 +1,161 @@
+# coding=utf-8
+
+# Robust averaging of lock-in repetitions.
+#
+# Every estimator works along the last axis, so one call reduces a single
+# set of repetitions or a whole (points x reps) block (e.g. a buffered
+# lock-in read), and returns (value, standard error) arrays.
+#
+# Usage :
+#     value, error = interquartile_mean(X_reps)
+#     est = get_estimator('huber')      # names, estimators or plain functions
+#     value, error = est(X_reps)
+
+import numpy as np
+
+__all__ = ['mean', 'trimmed_mean', 'interquartile_mean', 'median', 'huber',
+           'get_estimator', 'RepetitionBuffer']
+
+# Standard deviation of a normal distribution from its MAD
+MAD_SCALE = 1.4826
+
+
+def _safe_div(num, den):
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(den > 0, num / np.where(den > 0, den, 1), 0.0)[()]
+
+
+def mean(a, axis=-1):
+    '''Mean and its standard error'''
+    a = np.asarray(a, dtype=float)
+    n = a.shape[axis]
+    value = a.mean(axis=axis)
+    std = a.std(axis=axis, ddof=1) if n > 1 else np.zeros_like(value)
+    return value, std / np.sqrt(n)
+
+
+def trimmed_mean(a, proportion=0.1, axis=-1):
+    '''
+    Mean of the sorted values without the floor(n * proportion) smallest and
+    largest ones (at least one value is always kept). The standard error is
+    the Tukey-McLaughlin one, from the winsorized standard deviation.
+    Empty input gives NaN.
+    '''
+    a = np.moveaxis(np.asarray(a, dtype=float), axis, -1)
+    n = a.shape[-1]
+    if n == 0:
+        nan = np.full(a.shape[:-1], np.nan)[()]
+        return nan, nan
+    g = min(int(np.floor(n * proportion)), (n - 1) // 2)
+    s = np.sort(a, axis=-1)
+    value = s[..., g:n - g].mean(axis=-1)
+    if n > 1:
+        winsorized = np.clip(s, s[..., g:g + 1], s[..., n - g - 1:n - g]).std(axis=-1, ddof=1)
+    else:
+        winsorized = np.zeros_like(value)
+    error = winsorized / ((n - 2 * g) / float(n) * np.sqrt(n))
+    return value[()], error[()]
+
+
+def interquartile_mean(a, axis=-1):
+    '''Mean of the values between the quartiles (the former avg_mid_50)'''
+    return trimmed_mean(a, 0.25, axis)
+
+
+def median(a, axis=-1):
+    '''Median, the standard error is 1.2533 * (MAD scaled sigma) / sqrt(n)'''
+    a = np.asarray(a, dtype=float)
+    n = a.shape[axis]
+    med = np.median(a, axis=axis)
+    mad = np.median(np.abs(a - np.expand_dims(med, axis)), axis=axis)
+    return med, 1.2533 * MAD_SCALE * mad / np.sqrt(n)
+
+
+def huber(a, k=1.345, axis=-1, tol=1E-9, max_iter=50):
+    '''
+    Huber M-estimate of location (scale fixed to the MAD) by iteratively
+    reweighted means. The standard error is the asymptotic one,
+    s * sqrt(mean(psi**2)) / mean(psi') / sqrt(n).
+    '''
+    a = np.moveaxis(np.asarray(a, dtype=float), axis, -1)
+    n = a.shape[-1]
+    mu, _ = median(a)
+    s = MAD_SCALE * np.median(np.abs(a - mu[..., None]), axis=-1)
+    s_safe = np.where(s > 0, s, 1.0)[..., None]
+    for _ in range(max_iter):
+        r = np.abs(a - mu[..., None]) / s_safe
+        w = np.minimum(1.0, k / np.maximum(r, 1E-300))
+        new_mu = (w * a).sum(axis=-1) / w.sum(axis=-1)
+        converged = np.all(np.abs(new_mu - mu) <= tol * (s + np.abs(mu)))
+        mu = new_mu
+        if converged:
+            break
+    u = (a - mu[..., None]) / s_safe
+    psi = np.clip(u, -k, k)
+    slope = (np.abs(u) < k).mean(axis=-1)
+    error = _safe_div(s * np.sqrt((psi**2).mean(axis=-1)), slope * np.sqrt(n))
+    return mu, np.where(s > 0, error, 0.0)[()]
+
+
+_estimators = {'mean': mean,
+               'iqm': interquartile_mean,
+               'interquartile_mean': interquartile_mean,
+               'trimmed': trimmed_mean,
+               'trimmed_mean': trimmed_mean,
+               'median': median,
+               'huber': huber}
+
+
+def get_estimator(func):
+    '''
+    Returns an estimator a -> (value, error) reducing the last axis.
+    func can be one of the names 'mean', 'iqm', 'trimmed', 'median',
+    'huber', one of the estimators of this module, or any function of a
+    1D array returning a number (e.g. np.mean, its error is then std/sqrt(n)).
+    '''
+    if isinstance(func, str):
+        return _estimators[func]
+    if func in _estimators.values():
+        return func
+
+    def estimator(a, axis=-1):
+        a = np.moveaxis(np.asarray(a, dtype=float), axis, -1)
+        if a.ndim == 1:
+            value = func(a)
+        else:
+            value = np.array([func(row) for row in a.reshape(-1, a.shape[-1])]).reshape(a.shape[:-1])
+        return value, mean(a)[1]
+    return estimator
+
+
+class RepetitionBuffer(object):
+    '''
+    Preallocated (channels x reps) store for repetitions read one by one.
+
+    Usage :
+        buf = RepetitionBuffer(read_reps, 2)
+        for i in range(read_reps):
+            buf.add(*LIA.getXY())
+        (X, X_err), (Y, Y_err) = buf.reduce('iqm')
+    '''
+
+    def __init__(self, capacity, channels=2):
+        self.data = np.empty((channels, capacity))
+        self.size = 0
+
+    def reset(self):
+        self.size = 0
+
+    def add(self, *values):
+        self.data[:, self.size] = values
+        self.size += 1
+
+    @property
+    def values(self):
+        '''(channels x size) view of the repetitions read so far'''
+        return self.data[:, :self.size]
+
+    def reduce(self, estimator='iqm'):
+        '''(value, error) of every channel'''
+        value, error = get_estimator(estimator)(self.values)
+        return list(zip(value, error))
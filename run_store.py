@@ -0,0 +1,392 @@
+# coding=utf-8
+
+# Chunked binary store for the data of a run.
+#
+# A run is a directory holding a JSON sidecar (run.json : run metadata, and
+# per table its columns, dtypes, row shape, number of rows and metadata)
+# and one raw little endian file per table column. Rows are buffered in
+# memory and appended to the column files chunk_rows at a time, so writing
+# costs one write per column per chunk. Readers open the columns with
+# np.memmap and only the slices they touch are loaded.
+#
+# Crash safety : the column files are the reference, the number of rows of a
+# table is the number of complete rows in all its column files (a torn last
+# row is cut off when the store is reopened for appending). A flush opens,
+# appends to and closes the column files, so no file stays open between
+# writes. Written rows reach the OS at once and the tables written since
+# the last sync are fsync'ed at most every sync_interval s (and on sync() /
+# Table.close() / close()); the sidecar is replaced atomically.
+#
+# A table row is one sweep point (row_shape ()) or one map line (row_shape
+# (n_fields,), with per line scalars of shape ()), so a map campaign grows
+# line by line.
+#
+# Usage :
+#     with RunStore(r'...\Data\NiFe_2\run_1', 'a', metadata={'sample': 'NiFe'}) as store:
+#         table = store.create_table('sweep_1', ['field_Oe', 'X', 'Y'])
+#         table.append(field_Oe=1000, X=1E-6, Y=2E-7)
+#     X = RunStore(r'...\Data\NiFe_2\run_1')['sweep_1']['X']   # np.memmap
+#     export_csv(r'...\Data\NiFe_2\run_1', r'...\Data\NiFe_2\csv')
+
+import os
+import re
+import json
+import time
+import numpy as np
+
+__all__ = ['RunStore', 'Table', 'export_csv']
+
+SIDECAR = 'run.json'
+VERSION = 1
+
+
+def _dirname(name):
+    '''File system safe directory name of a table'''
+    return re.sub(r'[^\w.\-]+', '_', name).strip('_.') or 'table'
+
+
+def _jsonable(value):
+    if isinstance(value, dict):
+        return {str(k): _jsonable(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return [_jsonable(v) for v in value]
+    if isinstance(value, np.generic):
+        return value.item()
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    return str(value)
+
+
+class Table(object):
+    '''
+    Append-only columns of one table of a RunStore (made by
+    RunStore.create_table, or RunStore[name] to read).
+
+    column(name) / table[name] : np.memmap (rows x shape of the column) of
+    the rows written so far (pending rows are flushed first).
+    '''
+
+    def __init__(self, store, name, info):
+        self.store = store
+        self.name = name
+        self.path = os.path.join(store.path, info['dir'])
+        self.columns = list(info['columns'])
+        self.dtypes = {column: np.dtype(dtype) for column, (dtype, _) in info['columns'].items()}
+        self.shapes = {column: tuple(shape) for column, (_, shape) in info['columns'].items()}
+        self.row_shape = tuple(info['row_shape'])
+        self.chunk_rows = info['chunk_rows']
+        self.metadata = info['metadata']
+        self._pending = {column: [] for column in self.columns}
+        self._n_pending = 0
+        # Rows written since the last fsync
+        self._unsynced = False
+        self.rows = self._recover()
+
+    def _row_bytes(self, column):
+        return self.dtypes[column].itemsize * int(np.prod(self.shapes[column]))
+
+    def _recover(self):
+        '''Number of complete rows on disk, the files are cut to it when appending'''
+        sizes = {}
+        for column in self.columns:
+            path = self._file(column)
+            sizes[column] = os.path.getsize(path) if os.path.isfile(path) else 0
+        rows = min([sizes[column] // self._row_bytes(column) for column in self.columns] or [0])
+        if self.store.mode == 'a':
+            for column in self.columns:
+                if sizes[column] != rows * self._row_bytes(column):
+                    with open(self._file(column), 'r+b' if sizes[column] else 'wb') as f:
+                        f.truncate(rows * self._row_bytes(column))
+        return rows
+
+    def __len__(self):
+        return self.rows + self._n_pending
+
+    def __str__(self):
+        return 'Table %s : %d rows of %s, columns %s' % (self.name, len(self), self.row_shape, self.columns)
+
+    def __getitem__(self, name):
+        return self.column(name)
+
+    def _info(self):
+        return {'dir': os.path.basename(self.path),
+                'columns': {column: [self.dtypes[column].str, list(self.shapes[column])]
+                            for column in self.columns},
+                'row_shape': list(self.row_shape), 'chunk_rows': self.chunk_rows,
+                'rows': self.rows, 'metadata': _jsonable(self.metadata)}
+
+    def _file(self, column):
+        return os.path.join(self.path, column + '.bin')
+
+    def append(self, **values):
+        '''Adds one row, missing columns are NaN (0 for integer columns)'''
+        self.extend(**{column: [value] for column, value in values.items()})
+
+    def extend(self, **values):
+        '''Adds a block of rows (arrays of n x column shape, one per column)'''
+        self.store._check_writable()
+        unknown = set(values) - set(self.columns)
+        if unknown:
+            raise KeyError('Unknown columns %s of table %s' % (sorted(unknown), self.name))
+        n = None
+        for column, value in values.items():
+            block = np.asarray(value, dtype=self.dtypes[column]).reshape((-1,) + self.shapes[column])
+            if n is not None and len(block) != n:
+                raise ValueError('Columns of different lengths')
+            n = len(block)
+            self._pending[column].append(block)
+        if not n:
+            return
+        for column in self.columns:
+            if column not in values:
+                dtype = self.dtypes[column]
+                fill = np.nan if dtype.kind in 'fc' else 0
+                self._pending[column].append(np.full((n,) + self.shapes[column], fill, dtype))
+        self._n_pending += n
+        if self._n_pending >= self.chunk_rows:
+            self.flush()
+
+    def flush(self):
+        '''
+        Appends the pending rows to the column files (fsync'ed by the store).
+        All or nothing : if a write fails the columns are cut back to the
+        rows written before and the rows stay pending.
+        '''
+        if not self._n_pending:
+            return
+        blocks = {}
+        for column in self.columns:
+            block = np.concatenate(self._pending[column])
+            blocks[column] = np.ascontiguousarray(
+                block.astype(self.dtypes[column].newbyteorder('<'), copy=False)).tobytes()
+        size = {column: self.rows * self._row_bytes(column) for column in self.columns}
+        written = []
+        try:
+            for column in self.columns:
+                written.append(column)
+                # Closed at once, a table holds no file between writes
+                with open(self._file(column), 'ab') as f:
+                    f.write(blocks[column])
+        except Exception:
+            for column in written:
+                try:
+                    with open(self._file(column), 'r+b') as f:
+                        f.truncate(size[column])
+                except OSError:
+                    # Cut when the store is reopened (see _recover)
+                    pass
+            raise
+        for column in self.columns:
+            self._pending[column] = []
+        self.rows += self._n_pending
+        self._n_pending = 0
+        self._unsynced = True
+        self.store._written()
+
+    def _sync(self):
+        '''fsync of the column files written since the last sync'''
+        if not self._unsynced:
+            return False
+        for column in self.columns:
+            with open(self._file(column), 'ab') as f:
+                os.fsync(f.fileno())
+        self._unsynced = False
+        return True
+
+    def close(self):
+        '''Writes the pending rows and fsyncs them, once the table is finished'''
+        self.flush()
+        if self._sync():
+            self.store._write_sidecar()
+
+    def column(self, name):
+        if self._n_pending:
+            self.flush()
+        dtype = self.dtypes[name].newbyteorder('<')
+        shape = (self.rows,) + self.shapes[name]
+        if self.rows == 0:
+            return np.empty(shape, dtype)
+        return np.memmap(self._file(name), dtype=dtype, mode='r', shape=shape)
+
+    def to_dataframe(self, columns=None):
+        '''DataFrame of the columns (in memory, 1D tables only)'''
+        import pandas as pd
+        if self.row_shape:
+            raise ValueError('Table %s has rows of shape %s' % (self.name, self.row_shape))
+        return pd.DataFrame({name: np.array(self[name]) for name in (columns or self.columns)})
+
+    def to_csv(self, path, columns=None):
+        '''Writes a 1D table as CSV (header line of column names)'''
+        self.to_dataframe(columns).to_csv(path, index=False)
+
+
+class RunStore(object):
+    '''
+    Directory store of one run.
+
+    Parameters:
+    path (str): Run directory.
+    mode (str): 'r' read only, 'a' read / append (the directory is created
+        if needed).
+    metadata (dict): Run metadata, merged into the stored one ('a' only).
+    chunk_rows (int): Default number of rows buffered before a write.
+    sync_interval (float): Longest time (s) written rows wait for an fsync,
+        0 : fsync every write.
+    '''
+
+    def __init__(self, path, mode='r', metadata=None, chunk_rows=256, sync_interval=2.0):
+        if mode not in ['r', 'a']:
+            raise ValueError("mode must be 'r' or 'a'")
+        self.path = os.path.abspath(path)
+        self.mode = mode
+        self.chunk_rows = chunk_rows
+        self.sync_interval = sync_interval
+        self.closed = False
+        self._last_sync = time.time()
+        self._dirty = False
+        sidecar = os.path.join(self.path, SIDECAR)
+        if os.path.isfile(sidecar):
+            with open(sidecar) as f:
+                info = json.load(f)
+        elif mode == 'a':
+            os.makedirs(self.path, exist_ok=True)
+            info = {'version': VERSION, 'created': time.time(), 'metadata': {}, 'tables': {}}
+        else:
+            raise FileNotFoundError('No run store at ' + self.path)
+        self.created = info['created']
+        self.metadata = info['metadata']
+        self.metadata.update(_jsonable(metadata or {}))
+        self._tables = {name: Table(self, name, table) for name, table in info['tables'].items()}
+        if mode == 'a':
+            self._write_sidecar()
+
+    def __str__(self):
+        return 'RunStore %s : %d tables' % (self.path, len(self._tables))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __contains__(self, name):
+        return name in self._tables
+
+    def __getitem__(self, name):
+        return self._tables[name]
+
+    @property
+    def tables(self):
+        return list(self._tables)
+
+    def _check_writable(self):
+        if self.mode != 'a' or self.closed:
+            raise IOError('RunStore %s is not open for writing' % self.path)
+
+    def _write_sidecar(self):
+        info = {'version': VERSION, 'created': self.created, 'updated': time.time(),
+                'metadata': _jsonable(self.metadata),
+                'tables': {name: table._info() for name, table in self._tables.items()}}
+        # Replaced in one step, readers never see a half written sidecar
+        tmp = os.path.join(self.path, SIDECAR + '.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(info, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, os.path.join(self.path, SIDECAR))
+
+    def _written(self):
+        self._dirty = True
+        if time.time() - self._last_sync >= self.sync_interval:
+            self.sync()
+
+    def sync(self):
+        '''fsync of the tables written since the last sync, then the sidecar'''
+        synced = [table._sync() for table in self._tables.values()]
+        if self._dirty or any(synced):
+            self._write_sidecar()
+        self._dirty = False
+        self._last_sync = time.time()
+
+    def unique_name(self, name):
+        '''name, or name_2, name_3... if a table name is taken'''
+        unique, i = name, 1
+        while unique in self._tables:
+            i += 1
+            unique = '%s_%d' % (name, i)
+        return unique
+
+    def create_table(self, name, columns, row_shape=(), dtype='f8', metadata=None, chunk_rows=None):
+        '''
+        Adds an empty table.
+
+        columns (list | dict): Column names (all of dtype), or {name: dtype}
+            or {name: (dtype, shape)} for columns not of row_shape.
+        row_shape (tuple): Shape of one row of the columns, e.g. (n_fields,)
+            for a map stored line by line.
+        metadata (dict): Table metadata (instrument state, axes...).
+        chunk_rows (int): Rows buffered before a write (default: the store's,
+            for map lines at most 16).
+        Returns: Table
+        '''
+        self._check_writable()
+        if name in self._tables:
+            raise KeyError('Table %s exists' % name)
+        row_shape = tuple(int(n) for n in np.atleast_1d(row_shape)) if np.size(row_shape) else ()
+        if not isinstance(columns, dict):
+            columns = {column: dtype for column in columns}
+        columns = {column: spec if isinstance(spec, tuple) else (spec, row_shape)
+                   for column, spec in columns.items()}
+        if chunk_rows is None:
+            chunk_rows = min(self.chunk_rows, 16) if row_shape else self.chunk_rows
+        used = [os.path.basename(table.path) for table in self._tables.values()]
+        directory, i = _dirname(name), 1
+        while directory in used:
+            i += 1
+            directory = '%s_%d' % (_dirname(name), i)
+        os.makedirs(os.path.join(self.path, directory), exist_ok=True)
+        info = {'dir': directory,
+                'columns': {c: [np.dtype(d).str, list(shape)] for c, (d, shape) in columns.items()},
+                'row_shape': list(row_shape), 'chunk_rows': chunk_rows, 'rows': 0,
+                'metadata': _jsonable(metadata or {})}
+        table = Table(self, name, info)
+        for column in table.columns:
+            open(table._file(column), 'wb').close()
+        self._tables[name] = table
+        self._write_sidecar()
+        return table
+
+    def flush(self):
+        '''Writes the pending rows of every table'''
+        for table in self._tables.values():
+            table.flush()
+
+    def close(self):
+        '''Writes the pending rows and the sidecar, safe to call more than once'''
+        if self.closed:
+            return
+        if self.mode == 'a':
+            self.flush()
+            self.sync()
+        self.closed = True
+
+
+def export_csv(path, out_dir=None, tables=None):
+    '''
+    Converts the 1D tables of the run store at path to one CSV each, named
+    after the table, in out_dir (default: the run directory).
+    Returns: list of the CSV paths
+    '''
+    store = RunStore(path)
+    if out_dir is None:
+        out_dir = store.path
+    os.makedirs(out_dir, exist_ok=True)
+    paths = []
+    for name in (tables or store.tables):
+        table = store[name]
+        if table.row_shape:
+            continue
+        csv_path = os.path.join(out_dir, _dirname(name) + '.csv')
+        table.to_csv(csv_path)
+        paths.append(csv_path)
+    return paths
@@ -0,0 +1,215 @@
+# coding=utf-8
+
+# Visit order of a frequency x field map.
+#
+# make2D measures a map as lines of an inner axis (field sweeps at fixed
+# frequency, or frequency sweeps at fixed field). plan_scan() estimates the
+# time of every ordering from per instrument costs and returns the fastest:
+#     inner axis   : 'field' or 'frequency'
+#     traversal    : 'raster' (every line in the same direction) or
+#                    'serpentine' (every other line reversed, a line starts
+#                    where the previous one ended)
+#     magnet       : 'reset' (to 0 A after every line, the historical
+#                    behaviour) or 'hold' (energized until the end of the map)
+#
+# The magnet wait at the start of a line is line_start_wait(), also used by
+# make2D : the full from0_s after a reset to 0 A, while the magnet is held
+# from0_s scaled by the relative current jump,
+# min(1, |dH| / max(|H_before|, |H_after|)). With the PS ramp engine
+# (from0delay='ramp') it is field_slew_s_per_oe per Oe ramped instead, ramps
+# down included.
+#
+# Usage :
+#     costs = E.measure_scan_costs(frequencies, fields)
+#     plan = plan_scan(frequencies, fields, costs)
+#     print(plan.report())
+#     E.make2D(frequencies, fields, save_dir, schedule=plan)
+
+import numpy as np
+
+__all__ = ['ScanCosts', 'ScanPlan', 'plan_scan', 'estimate_scan', 'magnet_wait', 'line_start_wait']
+
+
+def magnet_wait(from0_s, before, after):
+    '''Wait (s) for a magnet jump from field (or current) before to after'''
+    top = max(abs(before), abs(after))
+    if top == 0:
+        return 0.0
+    return from0_s * min(1.0, abs(after - before) / top)
+
+
+def line_start_wait(from0_s, before, after, hold):
+    '''
+    Wait (s) of make2D after the first field (or current) of a line : from0_s,
+    or magnet_wait from before to after while the magnet is held
+    '''
+    if not hold:
+        return from0_s
+    return magnet_wait(from0_s, before, after)
+
+
+class ScanCosts(object):
+    '''
+    Time costs of a map scan.
+
+    Parameters:
+    field_point_s (float): Time of one point of a field sweep (new current,
+        settling, reading).
+    frequency_point_s (float): Time of one point of a frequency sweep.
+    from0_s (float): Magnet wait for a jump from 0 A (from0delay).
+    line_s (float): Fixed time per line (LIA setup, saving, plotting).
+    field_slew_s_per_oe, frequency_slew_s_per_ghz (float): Extra time per
+        unit jumped when setting a new line start.
+    '''
+
+    def __init__(self, field_point_s=0.1, frequency_point_s=0.1, from0_s=4.0, line_s=0.5,
+                 field_slew_s_per_oe=0.0, frequency_slew_s_per_ghz=0.0):
+        self.field_point_s = field_point_s
+        self.frequency_point_s = frequency_point_s
+        self.from0_s = from0_s
+        self.line_s = line_s
+        self.field_slew_s_per_oe = field_slew_s_per_oe
+        self.frequency_slew_s_per_ghz = frequency_slew_s_per_ghz
+
+    def __repr__(self):
+        return ('ScanCosts(field_point_s={:.4g}, frequency_point_s={:.4g}, from0_s={:.4g}, line_s={:.4g}, '
+                'field_slew_s_per_oe={:.4g}, frequency_slew_s_per_ghz={:.4g})').format(
+            self.field_point_s, self.frequency_point_s, self.from0_s, self.line_s,
+            self.field_slew_s_per_oe, self.frequency_slew_s_per_ghz)
+
+    @classmethod
+    def from_results(cls, results, **kwargs):
+        '''
+        Costs from measured SweepResults : the median time between points of
+        the field and of the frequency sweeps. kwargs set the other costs.
+        '''
+        steps = {'field_Oe': [], 'frequency_ghz': []}
+        for result in results:
+            if result.parameter in steps and len(result) > 1:
+                steps[result.parameter].append(np.diff(result.time))
+        costs = cls(**kwargs)
+        if steps['field_Oe']:
+            costs.field_point_s = float(np.median(np.concatenate(steps['field_Oe'])))
+        if steps['frequency_ghz']:
+            costs.frequency_point_s = float(np.median(np.concatenate(steps['frequency_ghz'])))
+        return costs
+
+
+def estimate_scan(frequencies, fields, costs, inner='field', traversal='raster', magnet='reset'):
+    '''Estimated time (s) of a map scan in one ordering (see plan_scan)'''
+    frequencies = np.asarray(frequencies, dtype=float)
+    fields = np.asarray(fields, dtype=float)
+    if inner == 'field':
+        outer_values, inner_values = frequencies, fields
+        point_s, slew = costs.field_point_s, costs.field_slew_s_per_oe
+    else:
+        outer_values, inner_values = fields, frequencies
+        point_s, slew = costs.frequency_point_s, costs.frequency_slew_s_per_ghz
+    total = 0.0
+    field = 0.0
+    inner_position = inner_values[0]
+    for i, outer in enumerate(outer_values):
+        line = inner_values[::-1] if traversal == 'serpentine' and i % 2 else inner_values
+        start_field = line[0] if inner == 'field' else outer
+        # Magnet to the first field of the line
+        total += line_start_wait(costs.from0_s, field, start_field, magnet == 'hold')
+        total += costs.field_slew_s_per_oe * abs(start_field - field)
+        if inner == 'field':
+            total += costs.frequency_slew_s_per_ghz * (abs(outer - outer_values[i - 1]) if i else 0.0)
+        else:
+            total += slew * abs(line[0] - inner_position)
+        total += costs.line_s + point_s * len(line) + slew * abs(line[-1] - line[0])
+        inner_position = line[-1]
+        field = line[-1] if inner == 'field' else outer
+        if magnet == 'reset':
+            total += costs.field_slew_s_per_oe * abs(field)
+            field = 0.0
+    if magnet == 'hold':
+        # Ramp down once at the end (no wait)
+        total += costs.field_slew_s_per_oe * abs(field)
+    return total
+
+
+class ScanPlan(object):
+    '''
+    Ordering of a map scan chosen by plan_scan.
+
+    inner ('field' / 'frequency'), serpentine (bool), hold_magnet (bool),
+    estimate_s (s), estimates : list of dicts (inner, traversal, magnet,
+    estimate_s) of every ordering, fastest first.
+    '''
+
+    def __init__(self, inner, traversal, magnet, estimates, costs):
+        self.inner = inner
+        self.traversal = traversal
+        self.magnet = magnet
+        self.estimates = estimates
+        self.costs = costs
+
+    def __repr__(self):
+        return 'ScanPlan(inner={!r}, traversal={!r}, magnet={!r}, estimate_s={:.4g})'.format(
+            self.inner, self.traversal, self.magnet, self.estimate_s)
+
+    @property
+    def serpentine(self):
+        return self.traversal == 'serpentine'
+
+    @property
+    def hold_magnet(self):
+        return self.magnet == 'hold'
+
+    @property
+    def primary(self):
+        '''make2D primary axis (the outer one)'''
+        return 'frequency' if self.inner == 'field' else 'field'
+
+    @property
+    def estimate_s(self):
+        for row in self.estimates:
+            if (row['inner'], row['traversal'], row['magnet']) == (self.inner, self.traversal, self.magnet):
+                return row['estimate_s']
+        return np.nan
+
+    def report(self):
+        '''Table of the estimated time of every ordering'''
+        lines = ['{:<10} {:<11} {:<6} {:>10}'.format('inner', 'traversal', 'magnet', 'time')]
+        for row in self.estimates:
+            chosen = ' <' if (row['inner'], row['traversal'], row['magnet']) == \
+                (self.inner, self.traversal, self.magnet) else ''
+            lines.append('{:<10} {:<11} {:<6} {:>10}{}'.format(
+                row['inner'], row['traversal'], row['magnet'], _duration(row['estimate_s']), chosen))
+        return '\n'.join(lines)
+
+
+def _duration(seconds):
+    if seconds < 60:
+        return '{:.1f} s'.format(seconds)
+    hours, rest = divmod(int(round(seconds)), 3600)
+    return '{}:{:02d}:{:02d}'.format(hours, *divmod(rest, 60))
+
+
+def plan_scan(frequencies, fields, costs=None, inner='auto', traversal='auto', magnet='hold'):
+    '''
+    Estimates every ordering of the map and picks the fastest one allowed
+    by inner ('auto', 'field', 'frequency'), traversal ('auto', 'raster',
+    'serpentine') and magnet ('auto', 'hold', 'reset').
+    costs : ScanCosts (default ScanCosts()).
+    Returns: ScanPlan
+    '''
+    if costs is None:
+        costs = ScanCosts()
+    estimates = []
+    for inner_axis in ['field', 'frequency']:
+        for traversal_kind in ['raster', 'serpentine']:
+            for magnet_kind in ['reset', 'hold']:
+                estimates.append({'inner': inner_axis, 'traversal': traversal_kind, 'magnet': magnet_kind,
+                                  'estimate_s': estimate_scan(frequencies, fields, costs, inner_axis,
+                                                              traversal_kind, magnet_kind)})
+    estimates.sort(key=lambda row: row['estimate_s'])
+    allowed = [row for row in estimates
+               if inner in ['auto', row['inner']] and traversal in ['auto', row['traversal']]
+               and magnet in ['auto', row['magnet']]]
+    if not allowed:
+        raise ValueError('No ordering with inner=%r, traversal=%r, magnet=%r' % (inner, traversal, magnet))
+    best = allowed[0]
+    return ScanPlan(best['inner'], best['traversal'], best['magnet'], estimates, costs)
@@ -0,0 +1,107 @@
+# coding=utf-8
+
+# Lock-in settling after a setpoint change.
+#
+# The SR830 output filter is a cascade of 1 to 4 RC stages (6 dB/octave
+# each) with the time constant TC. After a step of the input, the error of
+# such a cascade decays as
+#     exp(-t/TC) * sum(k < poles) (t/TC)**k / k!
+# so the minimum wait only depends on TC, the slope and the accepted
+# fraction of the step (e.g. 99 % settled : 4.6 TC at 6 dB/oct, 10 TC at
+# 24 dB/oct). Optionally the outputs are then polled (SNAP) until two
+# successive readings agree within a fraction of the sensitivity.
+
+import time
+import math
+
+__all__ = ['filter_settle_time', 'Settler']
+
+_settle_factors = {}
+
+
+def filter_settle_time(tc, slope_db=12, tolerance=0.01):
+    '''
+    Time for the output filter (time constant tc, slope_db dB/octave) to
+    settle within tolerance (fraction of the step) of its final value.
+    '''
+    poles = max(1, int(round(slope_db / 6.0)))
+    key = (poles, tolerance)
+    if key not in _settle_factors:
+        def error(x):
+            return math.exp(-x) * sum(x ** k / math.factorial(k) for k in range(poles))
+        lo, hi = 0.0, 1.0
+        while error(hi) > tolerance:
+            hi *= 2
+        for _ in range(60):
+            mid = (lo + hi) / 2
+            if error(mid) > tolerance:
+                lo = mid
+            else:
+                hi = mid
+        _settle_factors[key] = hi
+    return _settle_factors[key] * tc
+
+
+class Settler(object):
+    '''
+    Waits for the lock-in outputs to settle after a setpoint change.
+
+    Parameters:
+    lia (SRS_SR830): The lock-in (TC and slope are read from its settings cache).
+    tolerance (float): Fraction of the step left when the minimum wait ends.
+    poll (bool): After the minimum wait, poll SNAP until converged.
+    poll_tolerance (float): Convergence limit of successive readings,
+        as a fraction of the sensitivity.
+    poll_interval (float): Time between polls, in units of TC.
+    timeout_factor (float): Polling ends anyway after timeout_factor
+        times the minimum wait.
+    '''
+
+    def __init__(self, lia, tolerance=0.01, poll=False, poll_tolerance=0.002,
+                 poll_interval=1.0, timeout_factor=5):
+        self.lia = lia
+        self.tolerance = tolerance
+        self.poll = poll
+        self.poll_tolerance = poll_tolerance
+        self.poll_interval = poll_interval
+        self.timeout_factor = timeout_factor
+        self.timeouts = 0
+
+    def __str__(self):
+        return 'Settler : %.3g of the step%s' % (
+            self.tolerance, ', polling' if self.poll else '')
+
+    def wait_time(self):
+        '''Minimum wait for the current TC and filter slope'''
+        return filter_settle_time(self.lia.TC, self.lia.SlopeDB, self.tolerance)
+
+    def settle(self, start=None):
+        '''
+        Waits until the outputs settled after a setpoint sent at start
+        (time.perf_counter(), default now).
+        Returns: the settle time (s) counted from start
+        '''
+        if start is None:
+            start = time.perf_counter()
+        wait = self.wait_time()
+        remaining = start + wait - time.perf_counter()
+        if remaining > 0:
+            time.sleep(remaining)
+        if self.poll:
+            self._poll(start, self.timeout_factor * max(wait, self.lia.TC))
+        return time.perf_counter() - start
+
+    def _poll(self, start, timeout):
+        deadline = start + timeout
+        limit = self.poll_tolerance * self.lia.SEN
+        interval = self.poll_interval * self.lia.TC
+        X0, Y0 = self.lia.getXY()
+        while time.perf_counter() < deadline:
+            time.sleep(interval)
+            X, Y = self.lia.getXY()
+            if abs(X - X0) <= limit and abs(Y - Y0) <= limit:
+                return True
+            X0, Y0 = X, Y
+        self.timeouts += 1
+        self.lia._log('ERR ', 'Outputs not converged within %.3g s' % timeout)
+        return False
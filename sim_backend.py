@@ -0,0 +1,609 @@
+# coding=utf-8
+
+# In-process simulation of the SpinLab FMR rack:
+#   SRS SR830 Lock-In Amplifier  (GPIB0::8::INSTR)
+#   HP 8673G Signal Generator    (GPIB0::15::INSTR)
+#   KEPCO BOP 50-8D Power Supply (GPIB0::6::INSTR)
+#
+# The instruments share one SimRack, so the lock-in sees the field set on the
+# power supply and the frequency set on the generator. The FMR signal is the
+# field derivative of a Lorentzian line whose position follows the Kittel
+# dispersion of an in-plane thin film.
+#
+# Usage :
+#     from sim_backend import SimRack, set_rack
+#     set_rack(SimRack(latency=1E-3))
+#     E = Experiment(backend='@sim')
+
+import re
+import struct
+import threading
+import time
+import numpy as np
+
+__all__ = ['SimRack', 'SimResourceManager', 'SimResource', 'get_rack', 'set_rack']
+
+
+class SimRack(object):
+    '''
+    Shared physical state of the simulated instruments
+
+    Parameters:
+    latency (float): Bus latency in s charged on every write and every read.
+    Ms (float): Saturation magnetisation 4piMs in G.
+    gyro (float): Gyromagnetic ratio gamma/2pi in GHz/Oe.
+    linewidth (float): Half width at half maximum of the line in Oe.
+    amplitude (float): Peak derivative signal in V at 0 dB source level.
+    phase (float): Mixing angle in rad between absorption and dispersion.
+    noise (float): Gaussian noise added to X and Y in V.
+    oe_per_amp (float): Field produced by 1 A of magnet current.
+    magnet_tau (float): L/R time constant of the magnet in s.
+    seed (int): Seed for the noise generator.
+    '''
+
+    def __init__(self, latency=0.0, Ms=10000.0, gyro=0.0028, linewidth=15.0,
+                 amplitude=1E-4, phase=0.3, noise=1E-6, oe_per_amp=669.0,
+                 magnet_tau=0.0, seed=None):
+        self.latency = latency
+        self.Ms = Ms
+        self.gyro = gyro
+        self.linewidth = linewidth
+        self.amplitude = amplitude
+        self.phase = phase
+        self.noise = noise
+        self.oe_per_amp = oe_per_amp
+        self.magnet_tau = magnet_tau
+        self.rng = np.random.default_rng(seed)
+        self.lock = threading.RLock()
+        self.devices = {'GPIB0::8::INSTR': SimSR830,
+                        'GPIB0::15::INSTR': SimHP8673G,
+                        'GPIB0::6::INSTR': SimKEPCO}
+        self._models = {}
+        self.reset_stats()
+
+        # Physical state shared between instruments
+        self.frequency = 2.0  # GHz
+        self.level = 0.0  # dB
+        self.rf_on = True
+        self.current_set = 0.0  # A
+        self._current = 0.0
+        self._current_t = time.perf_counter()
+
+    def reset_stats(self):
+        '''Zero the bus transaction counters'''
+        self.stats = {'write': 0, 'read': 0}
+
+    @property
+    def round_trips(self):
+        '''Number of commands sent over the bus (a query counts once)'''
+        return self.stats['write']
+
+    def model(self, resource_name):
+        '''Returns the (persistent) instrument model living at resource_name'''
+        with self.lock:
+            if resource_name not in self._models:
+                if resource_name not in self.devices:
+                    raise ValueError('No simulated instrument at %s' % resource_name)
+                self._models[resource_name] = self.devices[resource_name](self)
+            return self._models[resource_name]
+
+    def bus_delay(self):
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+    # Magnet
+    def set_current(self, current):
+        with self.lock:
+            self._current = self.current
+            self._current_t = time.perf_counter()
+            self.current_set = current
+
+    @property
+    def current(self):
+        '''Actual magnet current in A'''
+        if self.magnet_tau <= 0:
+            return self.current_set
+        dt = time.perf_counter() - self._current_t
+        decay = np.exp(-dt / self.magnet_tau)
+        return self.current_set + (self._current - self.current_set) * decay
+
+    @property
+    def field(self):
+        return self.current * self.oe_per_amp
+
+    # FMR physics
+    def resonance_field(self, frequency):
+        '''Kittel resonance field (Oe) of an in-plane film at frequency (GHz)'''
+        half_Ms = self.Ms / 2.0
+        return -half_Ms + np.sqrt(half_Ms**2 + (np.asarray(frequency) / self.gyro)**2)
+
+    def signal(self, field=None, frequency=None):
+        '''Noise free X, Y lock-in signal (V) at field (Oe) and frequency (GHz)'''
+        if field is None:
+            field = self.field
+        if frequency is None:
+            frequency = self.frequency
+        if not self.rf_on:
+            return 0.0, 0.0
+        field = np.asarray(field, dtype=float)
+        Hr = self.resonance_field(frequency)
+        dH = self.linewidth
+        dabs = np.zeros_like(field)
+        ddis = np.zeros_like(field)
+        # Lines at +Hr and at -Hr (mirrored)
+        for sign in [1, -1]:
+            u = (field - sign * Hr) / dH
+            den = (1 + u**2)**2
+            dabs = dabs + sign * (-2 * u / den)
+            ddis = ddis + sign * ((1 - u**2) / den)
+        # Normalise the absorption derivative to unit peak amplitude
+        norm = 8 / (3 * np.sqrt(3))
+        A = self.amplitude * norm * 10**(self.level / 20.0)
+        X = A * (np.cos(self.phase) * dabs + np.sin(self.phase) * ddis)
+        Y = A * (-np.sin(self.phase) * dabs + np.cos(self.phase) * ddis)
+        return X, Y
+
+    def noisy_signal(self):
+        X, Y = self.signal()
+        if self.noise > 0:
+            X = X + self.rng.normal(0, self.noise)
+            Y = Y + self.rng.normal(0, self.noise)
+        return float(X), float(Y)
+
+
+class SimModel(object):
+    '''Base class for the command parsers of the simulated instruments'''
+    idn = ''
+
+    def __init__(self, rack):
+        self.rack = rack
+
+    def handle(self, command):
+        '''Process command, returns the response (str / bytes) or None'''
+        raise NotImplementedError
+
+    def clear(self):
+        pass
+
+
+class SimSR830(SimModel):
+    idn = 'Stanford_Research_Systems,SR830,s/n00000,ver1.07'
+    TC_bins = [10E-6, 30E-6, 100E-6, 300E-6,
+               1E-3, 3E-3, 10E-3, 30E-3, 100E-3, 300E-3,
+               1, 3, 10, 30, 100, 300,
+               1E3, 3E3, 10E3, 30E3]
+
+    SampleRates = [62.5E-3, 125E-3, 250E-3, 500E-3, 1, 2, 4, 8,
+                   16, 32, 64, 128, 256, 512]
+    buffer_size = 16383
+
+    def __init__(self, rack):
+        super().__init__(rack)
+        self.reset()
+
+    def reset(self):
+        self.regs = {'OUTX': 1, 'OVRM': 1, 'OFLT': 8, 'OFSL': 1, 'SENS': 22,
+                     'ISRC': 0, 'SYNC': 0, 'FREQ': 1000.0, 'SLVL': 1.0,
+                     'PHAS': 0.0, 'SRAT': 13, 'SEND': 1, 'TSTR': 0}
+        self.esr = 0
+        self._out = None
+        self._out_t = time.perf_counter()
+        self.reset_buffer()
+
+    # Data buffer
+    def reset_buffer(self):
+        self.buffer = []
+        self._storing = False
+        self._store_t = None
+        self._stored_before = 0
+
+    def _target_points(self):
+        '''Points that should be in the buffer at this moment'''
+        if self.regs['SRAT'] == 14 or self._store_t is None:
+            return len(self.buffer)
+        rate = self.SampleRates[self.regs['SRAT']]
+        elapsed = time.perf_counter() - self._store_t
+        return min(self._stored_before + int(elapsed * rate) + 1, self.buffer_size)
+
+    def _fill(self):
+        '''Stores the samples taken since the last call'''
+        if not self._storing:
+            return
+        for i in range(self._target_points() - len(self.buffer)):
+            self.buffer.append(self.output())
+
+    def trigger(self):
+        '''External trigger / TRIG command'''
+        if self.regs['TSTR'] and not self._storing:
+            self._start()
+        elif self._storing and self.regs['SRAT'] == 14:
+            if len(self.buffer) < self.buffer_size:
+                self.buffer.append(self.output())
+
+    def _start(self):
+        self._storing = True
+        self._stored_before = len(self.buffer)
+        self._store_t = time.perf_counter()
+
+    def buffer_command(self, name, arg):
+        '''Handles the storage commands, returns (handled, response)'''
+        if name == 'STRT':
+            if not self._storing:
+                self._start()
+            return True, None
+        if name == 'PAUS':
+            self._fill()
+            self._storing = False
+            self._store_t = None
+            return True, None
+        if name == 'REST':
+            self.reset_buffer()
+            return True, None
+        if name == 'TRIG':
+            self.trigger()
+            return True, None
+        if name == 'SPTS?':
+            self._fill()
+            return True, '%d' % len(self.buffer)
+        if name in ['TRCB?', 'TRCA?']:
+            self._fill()
+            channel, start, count = [int(a) for a in arg.split(',')]
+            data = [p[channel - 1] for p in self.buffer[start:start + count]]
+            if name == 'TRCA?':
+                return True, ','.join('%e' % d for d in data)
+            return True, struct.pack('<%df' % len(data), *data)
+        if name == 'DDEF':
+            return True, None
+        return False, None
+
+    def output(self):
+        '''
+        X, Y after the output low pass filter: every filter pole (6 dB/oct)
+        is modelled as one exponential stage with the time constant TC.
+        '''
+        target = np.array(self.rack.noisy_signal())
+        now = time.perf_counter()
+        poles = self.regs['OFSL'] + 1
+        if self._out is None:
+            self._out = np.tile(target, (poles, 1))
+        elif len(self._out) != poles:
+            self._out = np.tile(self._out[-1], (poles, 1))
+        tc = self.TC_bins[self.regs['OFLT']]
+        k = 1 - np.exp(-(now - self._out_t) / tc)
+        stage_in = target
+        for i in range(poles):
+            self._out[i] = self._out[i] + k * (stage_in - self._out[i])
+            stage_in = self._out[i]
+        self._out_t = now
+        return tuple(self._out[-1])
+
+    def handle(self, command):
+        response = None
+        for part in command.split(';'):
+            result = self.handle_one(part.strip())
+            if result is not None:
+                response = result
+        return response
+
+    def front_panel(self, register, value):
+        '''Simulates a change made by hand on the front panel'''
+        self.regs[register] = value
+        self.esr |= 64
+
+    def handle_one(self, command):
+        if command == '*IDN?':
+            return self.idn
+        if command == '*ESR?':
+            esr, self.esr = self.esr, 0
+            return '%d' % esr
+        if command == '*RST':
+            self.reset()
+            return None
+        name, _, arg = command.partition(' ')
+        handled, response = self.buffer_command(name, arg)
+        if handled:
+            return response
+        if command.startswith('SNAP?'):
+            X, Y = self.output()
+            values = {'1': X, '2': Y, '3': np.hypot(X, Y),
+                      '4': np.degrees(np.arctan2(Y, X))}
+            return ','.join('%e' % values[i.strip()] for i in command[5:].split(','))
+        if command.startswith('OUTP?'):
+            X, Y = self.output()
+            values = {'1': X, '2': Y, '3': np.hypot(X, Y),
+                      '4': np.degrees(np.arctan2(Y, X))}
+            return '%e' % values[command[5:].strip()]
+        if command.startswith('OAUX?'):
+            return '%e' % 0.0
+        if name.endswith('?'):
+            value = self.regs[name[:-1]]
+            if isinstance(value, float):
+                return '%g' % value
+            return '%d' % value
+        if name in self.regs:
+            if isinstance(self.regs[name], float):
+                self.regs[name] = float(arg)
+            else:
+                self.regs[name] = int(arg)
+        return None
+
+
+class SimHP8673G(SimModel):
+    # HP-IB has no *IDN? on this generator
+    _units = {'GZ': 1.0, 'MZ': 1E-3, 'KZ': 1E-6, 'HZ': 1E-9}
+    _set_re = re.compile(r'^(FR|FA|FB|FS|FI|SP)\s*([-+\d.eE]+)\s*(GZ|MZ|KZ|HZ)$')
+    _level_re = re.compile(r'^(LE|RA|VE)\s*([-+\d.eE]+)\s*DB$')
+    _steps_re = re.compile(r'^SP\s*(\d+)\s*SS$')
+
+    def __init__(self, rack):
+        super().__init__(rack)
+        self.message = '00'
+        self.registers = {'FA': 2.0, 'FB': 18.0, 'FS': 16.0, 'FI': 0.001, 'SP': 0.01}
+        self.steps = 50
+        self.range = 0
+        self.vernier = 0.0
+        self.sweep_mode = 'Off'
+
+    def _set_level(self):
+        self.rack.level = self.range + self.vernier
+
+    def _set_frequency(self, value):
+        if (value < 0.05) or (value > 26.0):
+            self.message = '01'
+        else:
+            self.rack.frequency = value
+
+    def clear(self):
+        self.message = '00'
+
+    def handle(self, command):
+        command = command.strip()
+        rack = self.rack
+        if command == 'MG':
+            code, self.message = self.message, '00'
+            return code
+        if command == 'OK':
+            return 'CW%011dHZ' % round(rack.frequency * 1E9)
+        if command in ['FA OA', 'FB OA', 'FS OA', 'FI OA']:
+            return '%s%011dHZ' % (command[:2], round(self.registers[command[:2]] * 1E9))
+        if command == 'SPOA':
+            return 'SP%011dHZ,SS%04dST' % (round(self.registers['SP'] * 1E9), self.steps)
+        if command == 'LE OA':
+            return 'LE%+.1fDB' % rack.level
+        if command == 'RA OA':
+            return 'RA%+dDB' % self.range
+        if command == 'VE OA':
+            return 'VE%+.1fDB' % self.vernier
+        if command in ['R0', 'R1']:
+            rack.rf_on = command == 'R1'
+            return None
+        if command == 'RU':
+            self.range = min(self.range + 10, 10)
+            self._set_level()
+            return None
+        if command == 'RD':
+            self.range = max(self.range - 10, -90)
+            self._set_level()
+            return None
+        if command in ['W0', 'W2', 'W3']:
+            self.sweep_mode = {'W0': 'Off', 'W2': 'Auto', 'W3': 'Manual'}[command]
+            return None
+        if command == 'W6':
+            self._set_frequency(self.registers['FA'])
+            return None
+        if command == 'TR':
+            if self.sweep_mode != 'Off':
+                new = min(rack.frequency + self.registers['SP'], self.registers['FB'])
+                self._set_frequency(new)
+            return None
+        if command.startswith('CT'):
+            return None
+        match = self._set_re.match(command)
+        if match:
+            reg, value, unit = match.groups()
+            value = float(value) * self._units[unit]
+            if reg == 'FR':
+                self._set_frequency(value)
+            else:
+                self.registers[reg] = value
+            return None
+        match = self._steps_re.match(command)
+        if match:
+            steps = int(match.group(1))
+            if (steps < 1) or (steps > 9999):
+                self.message = '07'
+            else:
+                self.steps = steps
+                span = self.registers['FB'] - self.registers['FA']
+                self.registers['SP'] = span / steps
+            return None
+        match = self._level_re.match(command)
+        if match:
+            reg, value = match.groups()
+            value = float(value)
+            if reg == 'LE':
+                if (value > 13) or (value < -102):
+                    self.message = '24'
+                else:
+                    self.range = int(np.ceil(value / 10.0) * 10)
+                    self.range = min(max(self.range, -90), 10)
+                    self.vernier = value - self.range
+            elif reg == 'RA':
+                self.range = int(value)
+            else:
+                self.vernier = value
+            self._set_level()
+            return None
+        self.message = '20'
+        return None
+
+
+class SimKEPCO(SimModel):
+    idn = 'KEPCO,BOP 50-8D,E1234,1.0'
+    resistance = 2.0  # Ohm
+    max_current = 8.0
+    max_voltage = 50.0
+
+    def __init__(self, rack):
+        super().__init__(rack)
+        self.reset()
+
+    def reset(self):
+        self.mode = 0
+        self.output = False
+        self.voltage = 0.0
+        self.rack.set_current(0.0)
+
+    def handle(self, command):
+        command = command.strip()
+        rack = self.rack
+        if command == '*IDN?':
+            return self.idn
+        if command == '*RST':
+            self.reset()
+            return None
+        if command in ['*CLS', 'SYST:BEEP']:
+            return None
+        if command.startswith('OUTPUT'):
+            self.output = command.endswith('ON')
+            return None
+        if command == 'FUNC:MODE?':
+            return '%d' % self.mode
+        if command.startswith('FUNC:MODE'):
+            self.mode = int(command.endswith('CURR'))
+            return None
+        if command == 'VOLT?':
+            return '%.4f' % self.voltage
+        if command.startswith('VOLT '):
+            self.voltage = float(command[5:])
+            return None
+        if command == 'CURR?':
+            return '%.4f' % rack.current_set
+        if command.startswith('CURR '):
+            current = float(command[5:])
+            current = min(max(current, -self.max_current), self.max_current)
+            rack.set_current(current)
+            return None
+        if command == 'MEAS:CURR?':
+            return '%.5f' % rack.current
+        if command == 'MEAS:VOLT?':
+            return '%.4f' % (rack.current * self.resistance)
+        return None
+
+
+class SimResource(object):
+    '''
+    Stands in for a pyvisa MessageBasedResource.
+    Only the subset of the interface used by InstrumentBase is implemented.
+    '''
+    LF = '\n'
+    CR = '\r'
+
+    def __init__(self, rack, resource_name, **kwargs):
+        self.rack = rack
+        self.resource_name = resource_name
+        self.model = rack.model(resource_name)
+        self.write_termination = None
+        self.read_termination = None
+        self.timeout = kwargs.get('timeout', 2000)
+        self._responses = []
+
+    def write(self, command):
+        rack = self.rack
+        rack.bus_delay()
+        with rack.lock:
+            rack.stats['write'] += 1
+            response = self.model.handle(command)
+        if response is not None:
+            self._responses.append(response)
+
+    def read_raw(self):
+        rack = self.rack
+        rack.bus_delay()
+        with rack.lock:
+            rack.stats['read'] += 1
+        if not self._responses:
+            raise TimeoutError('VI_ERROR_TMO: %s has nothing to say' % self.resource_name)
+        return self._responses.pop(0)
+
+    def read(self):
+        return self.read_raw()
+
+    def query(self, command, delay=None):
+        self.write(command)
+        if delay:
+            time.sleep(delay)
+        return self.read()
+
+    def query_ascii_values(self, command, converter='f', separator=',',
+                           container=list, delay=None):
+        response = self.query(command, delay)
+        values = [float(v) for v in response.split(separator)]
+        return container(values)
+
+    def query_binary_values(self, command, datatype='f', is_big_endian=False,
+                            header_fmt='ieee', container=list, delay=None,
+                            expect_termination=True, data_points=None):
+        self.write(command)
+        if delay:
+            time.sleep(delay)
+        raw = self.read_raw()
+        if isinstance(raw, str):
+            raw = raw.encode()
+        if header_fmt == 'ieee' and raw[:1] == b'#':
+            n = int(raw[1:2])
+            raw = raw[2 + n:]
+        size = struct.calcsize(datatype)
+        count = len(raw) // size
+        endian = '>' if is_big_endian else '<'
+        values = struct.unpack('%s%d%s' % (endian, count, datatype), raw[:count * size])
+        return container(values)
+
+    def clear(self):
+        self._responses = []
+        self.model.clear()
+
+    def close(self):
+        self._responses = []
+
+
+class SimResourceManager(object):
+    '''Stands in for pyvisa.ResourceManager on the simulated rack'''
+
+    def __init__(self, rack=None):
+        if rack is None:
+            rack = get_rack()
+        self.rack = rack
+
+    def list_resources(self, query='?*::INSTR'):
+        return tuple(self.rack.devices.keys())
+
+    def open_resource(self, resource_name, **kwargs):
+        return SimResource(self.rack, resource_name, **kwargs)
+
+    def close(self):
+        pass
+
+
+_rack = None
+
+
+def get_rack():
+    '''Returns the process-wide SimRack, creating a default one if needed'''
+    global _rack
+    if _rack is None:
+        _rack = SimRack()
+    return _rack
+
+
+def set_rack(rack):
+    '''
+    Replaces the process-wide SimRack used by SimResourceManager. The pooled
+    '@sim' manager and sessions (bound to the old rack) are closed, the
+    instruments opened next use the new one.
+    '''
+    global _rack
+    from instrument_base import resource_pool, SIM_BACKEND
+    resource_pool.close_all(SIM_BACKEND)
+    _rack = rack
+    return rack
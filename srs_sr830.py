@@ -10,28 +10,48 @@
 # TODO:
 # Make documentation
 
+import time as _time
 import numpy as _np
 from instrument_base import InstrumentBase as _InstrumentBase
+from instrument_base import cached_setting as _cached_setting
 
 class SRS_SR830(_InstrumentBase):
+    _cache_commands = {'OFLT': ['TC'],
+                       'OFSL': ['_slope_code'],
+                       'SENS': ['_sens_code'],
+                       'ISRC': ['_input_mode']}
+
     def __init__(self,
-                 GPIB_Address=8, GPIB_Device=0, RemoteOnly=False, ResourceName=None, logFile=None):
+                 GPIB_Address=8, GPIB_Device=0, RemoteOnly=False, ResourceName=None, logFile=None, backend=None):
         if ResourceName is None:
             ResourceName = 'GPIB%d::%d::INSTR' % (GPIB_Device, GPIB_Address)
-        super().__init__(ResourceName, logFile)
+        super().__init__(ResourceName, logFile, backend)
         self._IDN = 'SRS_SR830'
         self.VI.write_termination = self.VI.LF
         self.VI.read_termination = self.VI.LF
         self.write('OUTX 1')  # GPIB Mode
         self.RemoteOnly(RemoteOnly)
+        # TRCB? returns headerless little endian float32 data
+        self.values_format.datatype = 'f'
+        self.values_format.header_fmt = 'empty'
+        self._buffer_rate = None
 
     def RemoteOnly(self, rO=True):
+        self._remote_only = rO
         if rO:
             self.write('OVRM 0')
         else:
             self.write('OVRM 1')
 
+    def _front_panel_changed(self):
+        # The front panel is locked out in RemoteOnly mode
+        if self._remote_only:
+            return False
+        # *ESR? bit 6 (URQ) is set by any key press or knob rotation
+        return bool(self.query_int('*ESR?') & 64)
+
     @property
+    @_cached_setting
     def TC(self):
         '''
         Sets or return the Filter Time Constant
@@ -75,6 +95,17 @@ class SRS_SR830(_InstrumentBase):
                 1E3, 3E3, 10E3, 30E3]
         tc_i = _np.abs(_np.array(bins) - tc).argmin()
         self.write('OFLT %d' % tc_i)
+        self._cache_set('TC', bins[tc_i])
+
+    @property
+    @_cached_setting
+    def _sens_code(self):
+        return self.query_int('SENS?')
+
+    @property
+    @_cached_setting
+    def _input_mode(self):
+        return self.query('ISRC?')
 
     @property
     def SEN(self):
@@ -112,7 +143,7 @@ class SRS_SR830(_InstrumentBase):
         #  '24' = 200 mV   200 nA
         #  '25' = 500 mV   500 nA
         #  '26' = 1 V      1 uA
-        sen_i = self.query_int('SENS?')
+        sen_i = self._sens_code
         vSen = [2E-15, 5E-15, 10E-15, 20E-15,
                 50E-15, 100E-15, 200E-15, 500E-15,
                 1E-12, 2E-12, 5E-12, 10E-12, 20E-12,
@@ -120,8 +151,7 @@ class SRS_SR830(_InstrumentBase):
                 1E-9, 2E-9, 5E-9, 10E-9, 20E-9,
                 50E-9, 100E-9, 200E-9, 500E-9,
                 1E-6][sen_i]
-        inputMode = self.query('ISRC?')
-        if inputMode in ['0', '1']:
+        if self._input_mode in ['0', '1']:
             # Voltage mode
             vSen *= 1.0E6
         return vSen
@@ -129,7 +159,7 @@ class SRS_SR830(_InstrumentBase):
     @SEN.setter
     def SEN(self, vSen):
         vSen = _np.abs(vSen)
-        if self.query('ISRC?') in ['0', '1']:
+        if self._input_mode in ['0', '1']:
             # Voltage mode
             vSen *= 1.0E-6
         bins = [2E-15, 5E-15, 10E-15, 20E-15,
@@ -141,20 +171,23 @@ class SRS_SR830(_InstrumentBase):
                 1E-6]
         sen_i = _np.abs(_np.array(bins) - vSen).argmin()
         self.write('SENS %d' % sen_i)
+        self._cache_set('_sens_code', sen_i)
 
     def decrease_sensitivity(self):
-        sen_i = self.query_int('SENS?')
+        sen_i = self._sens_code
         if sen_i == 26:
             self._log('decrease_sensitivity ERR ', 'Sensivity already at minimum! Changing nothing.')
         else:
-            self.write('SENS %d' % sen_i + 1)
+            self.write('SENS %d' % (sen_i + 1))
+            self._cache_set('_sens_code', sen_i + 1)
 
     def increase_sensitivity(self):
-        sen_i = self.query_int('SENS?')
+        sen_i = self._sens_code
         if sen_i == 0:
             self._log('increase_sensitivity ERR ', 'Sensivity already at maximum! Changing nothing.')
         else:
-            self.write('SENS %d' % sen_i - 1)
+            self.write('SENS %d' % (sen_i - 1))
+            self._cache_set('_sens_code', sen_i - 1)
             
     def FilterSlope(self, sl):
         '''
@@ -169,9 +202,20 @@ class SRS_SR830(_InstrumentBase):
         '''
         if sl in ['0', '1', '2', '3']:
             self.write('OFSL %s' % sl)
+            self._cache_set('_slope_code', int(sl))
         else:
             self._log('ERR ', 'Wrong Slope Code')
 
+    @property
+    @_cached_setting
+    def _slope_code(self):
+        return self.query_int('OFSL?')
+
+    @property
+    def SlopeDB(self):
+        '''Output filter slope in dB/octave (6, 12, 18 or 24)'''
+        return 6 * (self._slope_code + 1)
+
     def InputMode(self, imode):
         '''
         Current/Voltage mode Input Selector
@@ -185,6 +229,7 @@ class SRS_SR830(_InstrumentBase):
         '''
         if imode in ['0', '1', '2', '3']:
             self.write('ISRC %s' % imode)
+            self._cache_set('_input_mode', imode)
         else:
             self._log('ERR ', 'Wrong Input Mode Code')
 
@@ -254,4 +299,110 @@ class SRS_SR830(_InstrumentBase):
 
     @property
     def AUX_In_4(self):
-        return self.query_float('OAUX?4')
\ No newline at end of file
+        return self.query_float('OAUX?4')
+
+    ### Data buffer (storage) methods
+    # SRAT codes, index 14 = external / TRIG command
+    SampleRates = [62.5E-3, 125E-3, 250E-3, 500E-3, 1, 2, 4, 8,
+                   16, 32, 64, 128, 256, 512]
+    # Points stored per channel
+    BufferSize = 16383
+
+    @property
+    def SampleRate(self):
+        '''
+        Sets or return the buffer sample rate in Hz
+        setted values are rounded to aviable hardware value.
+        'Trigger' stores one point per hardware trigger or TRIG command.
+        '''
+        srat_i = self.query_int('SRAT?')
+        if srat_i == 14:
+            return 'Trigger'
+        return self.SampleRates[srat_i]
+
+    @SampleRate.setter
+    def SampleRate(self, rate):
+        if rate == 'Trigger':
+            srat_i = 14
+        else:
+            srat_i = _np.abs(_np.log2(_np.array(self.SampleRates) / rate)).argmin()
+        self.write('SRAT %d' % srat_i)
+        self._buffer_rate = rate
+
+    def configure_buffer(self, rate=512, loop=False, trigger_start=False):
+        '''
+        Prepares the data buffer to store X (channel 1) and Y (channel 2)
+
+        Usage :
+            configure_buffer(rate, loop, trigger_start)
+                rate : Sample rate in Hz or 'Trigger'
+                loop : Loop mode (True) or stop when full (False)
+                trigger_start : Start storage with the external trigger
+        '''
+        self.write('DDEF 1,0,0')
+        self.write('DDEF 2,0,0')
+        self.write('SEND %d' % int(loop))
+        self.write('TSTR %d' % int(trigger_start))
+        self.SampleRate = rate
+        self.write('REST')
+
+    def start_buffer(self, reset=True):
+        '''Starts (or resumes) data storage, clearing the buffer if reset'''
+        if reset:
+            self.write('REST;STRT')
+        else:
+            self.write('STRT')
+
+    def pause_buffer(self):
+        self.write('PAUS')
+
+    def reset_buffer(self):
+        self.write('REST')
+
+    def software_trigger(self):
+        '''Stores one point when SampleRate is 'Trigger' '''
+        self.write('TRIG')
+
+    @property
+    def buffer_points(self):
+        '''Number of points stored in the buffer'''
+        return self.query_int('SPTS?')
+
+    def read_buffer(self, channel, start=0, count=None):
+        '''
+        Reads count points (all stored if None) of buffer channel (1 = X, 2 = Y)
+        as a binary transfer. Returns a numpy array.
+        '''
+        if count is None:
+            count = self.buffer_points - start
+        if count <= 0:
+            return _np.array([], dtype=float)
+        data = self.query_values('TRCB? %d,%d,%d' % (channel, start, count), data_points=count)
+        return _np.asarray(data, dtype=float)
+
+    def getXY_buffered(self, n, rate=512, timeout=None):
+        '''
+        Acquires n samples of X and Y using the internal data buffer.
+
+        The buffer is filled at rate (Hz) without host interaction and both
+        channels are then read in bulk, so n samples cost ~6 bus transactions
+        instead of n SNAP? queries.
+
+        Returns: X (array), Y (array)
+        '''
+        if self._buffer_rate != rate:
+            self.configure_buffer(rate)
+        if timeout is None:
+            timeout = 2.0 * n / rate + 1.0
+        self.start_buffer()
+        t0 = _time.perf_counter()
+        _time.sleep(n / rate)
+        stored = self.buffer_points
+        while stored < n and (_time.perf_counter() - t0) < timeout:
+            _time.sleep(max(n - stored, 1) / rate)
+            stored = self.buffer_points
+        self.pause_buffer()
+        if stored < n:
+            self._log('ERR ', 'Buffer timeout, %d of %d points stored' % (stored, n))
+            n = stored
+        return self.read_buffer(1, 0, n), self.read_buffer(2, 0, n)
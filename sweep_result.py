@@ -0,0 +1,315 @@
+# coding=utf-8
+
+# Preallocated result containers for FMR sweeps.
+#
+# SweepResult holds one 1D sweep as fixed length numpy columns filled up to a
+# pointer: no np.append growth during acquisition, and the column properties
+# are views of the filled part, so plotting and saving do not copy.
+# MapResult holds the X / Y maps of a make2D scan.
+# Both can stream to a RunStore table as they fill (see run_store.py).
+
+import time
+import numpy as np
+
+__all__ = ['SweepResult', 'MapResult']
+
+
+class SweepResult(object):
+    '''
+    Columnar result of one sweep.
+
+    Parameters:
+    parameter (str): Name of the swept column, e.g. 'field_Oe' or 'frequency_ghz'.
+    setpoints (array | None): Planned setpoints. If None, capacity points are
+        allocated and the setpoints are given to append().
+    aux (dict): Extra setpoint-like columns known in advance (e.g. 'current_A').
+    capacity (int): Number of points allocated when setpoints is None.
+    metadata (dict): Free form description of the sweep (frequency, level...).
+
+    Columns:
+    <aux>, <parameter>, X, Y, time (epoch s), sen (LIA sensitivity),
+    X_std, Y_std (spread of the repetitions), reps (number of repetitions),
+    X_err, Y_err (standard error of X and Y), settle_s (wait between the
+    setpoint and the reading)
+    '''
+    stat_columns = ['X', 'Y', 'time', 'sen', 'X_std', 'Y_std', 'reps', 'X_err', 'Y_err', 'settle_s']
+
+    def __init__(self, parameter, setpoints=None, aux=None, capacity=None, metadata=None):
+        if aux is None:
+            aux = {}
+        if setpoints is not None:
+            capacity = len(setpoints)
+        self.parameter = parameter
+        self.capacity = capacity
+        self.size = 0
+        self.metadata = dict(metadata or {})
+        self.sink = None
+        self._data = {}
+        self.columns = list(aux.keys()) + [parameter] + self.stat_columns
+        for name in self.columns:
+            self._data[name] = np.full(capacity, np.nan)
+        for name, values in aux.items():
+            self._data[name][:] = values
+        if setpoints is not None:
+            self._data[parameter][:] = setpoints
+
+    def __len__(self):
+        return self.size
+
+    def __str__(self):
+        return 'SweepResult : %s, %d of %d points' % (self.parameter, self.size, self.capacity)
+
+    def __getitem__(self, name):
+        '''View of the filled part of column name'''
+        return self._data[name][:self.size]
+
+    def column(self, name, n=None):
+        '''
+        View of the first n points of column name (default: the filled part).
+        Lets another thread read a consistent set of columns while points are
+        still being appended.
+        '''
+        return self._data[name][:self.size if n is None else n]
+
+    @property
+    def full(self):
+        return self.size >= self.capacity
+
+    @property
+    def setpoints(self):
+        return self[self.parameter]
+
+    @property
+    def X(self):
+        return self['X']
+
+    @property
+    def Y(self):
+        return self['Y']
+
+    @property
+    def time(self):
+        return self['time']
+
+    @property
+    def sen(self):
+        return self['sen']
+
+    def append(self, X, Y, sen=np.nan, X_std=np.nan, Y_std=np.nan, reps=1, t=None, **values):
+        '''
+        Stores one point at the fill pointer.
+        values can set the setpoint / aux columns of this point.
+        '''
+        i = self.size
+        if i >= self.capacity:
+            raise IndexError('SweepResult is full (%d points)' % self.capacity)
+        data = self._data
+        data['X'][i] = X
+        data['Y'][i] = Y
+        data['time'][i] = time.time() if t is None else t
+        data['sen'][i] = sen
+        data['X_std'][i] = X_std
+        data['Y_std'][i] = Y_std
+        data['reps'][i] = reps
+        for name, value in values.items():
+            data[name][i] = value
+        self.size = i + 1
+        if self.sink is not None:
+            self._stream(i, i + 1)
+
+    def plan(self, setpoints, **aux):
+        '''
+        Writes the setpoints (and aux columns) of the next points after the
+        fill pointer, for results allocated by capacity; append() then
+        measures them in that order.
+        '''
+        i, n = self.size, len(setpoints)
+        if i + n > self.capacity:
+            raise IndexError('SweepResult is full (%d points)' % self.capacity)
+        self._data[self.parameter][i:i + n] = setpoints
+        for name, values in aux.items():
+            self._data[name][i:i + n] = values
+
+    def extend(self, X, Y, sen=np.nan, X_std=np.nan, Y_std=np.nan, reps=1, t=None, **values):
+        '''Stores a block of points (arrays) at the fill pointer'''
+        X = np.asarray(X, dtype=float)
+        i, n = self.size, len(X)
+        if i + n > self.capacity:
+            raise IndexError('SweepResult is full (%d points)' % self.capacity)
+        data = self._data
+        block = slice(i, i + n)
+        data['X'][block] = X
+        data['Y'][block] = Y
+        data['time'][block] = time.time() if t is None else t
+        data['sen'][block] = sen
+        data['X_std'][block] = X_std
+        data['Y_std'][block] = Y_std
+        data['reps'][block] = reps
+        for name, value in values.items():
+            data[name][block] = value
+        self.size = i + n
+        if self.sink is not None:
+            self._stream(i, i + n)
+
+    def stream(self, table):
+        '''
+        Appends every point to table (a RunStore Table with the columns of
+        this result, see to_store) as soon as it is stored, starting with the
+        points already filled.
+        '''
+        self.sink = table
+        if self.size:
+            self._stream(0, self.size)
+
+    def _stream(self, start, stop):
+        self.sink.extend(**{name: self._data[name][start:stop] for name in self.columns})
+
+    def sorted(self):
+        '''New SweepResult of the filled points, sorted by setpoint'''
+        order = np.argsort(self.setpoints, kind='stable')
+        aux = [name for name in self.columns
+               if name != self.parameter and name not in self.stat_columns]
+        result = SweepResult(self.parameter, self.setpoints[order],
+                             aux={name: self[name][order] for name in aux},
+                             metadata=self.metadata)
+        for name in self.stat_columns:
+            result._data[name][:] = self[name][order]
+        result.size = self.size
+        # Already streamed in measurement order
+        result.sink = self.sink
+        return result
+
+    def as_array(self, columns=None):
+        '''(points x columns) array of the filled part'''
+        if columns is None:
+            columns = self.columns
+        return np.column_stack([self[name] for name in columns])
+
+    def to_csv(self, path, columns=None):
+        '''Writes the filled part as CSV (with a header line of column names)'''
+        if columns is None:
+            columns = self.columns
+        fmt = ['%.6f' if name == 'time' else '%.10g' for name in columns]
+        np.savetxt(path, self.as_array(columns), delimiter=',', fmt=fmt,
+                   header=','.join(columns), comments='')
+
+    def to_dataframe(self):
+        import pandas as pd
+        return pd.DataFrame({name: self[name] for name in self.columns})
+
+    def to_store(self, store, name, metadata=None, stream=False, chunk_rows=16):
+        '''
+        Writes the filled part as table name of a RunStore (see run_store.py),
+        with the sweep metadata updated by metadata.
+        stream=True also writes every following point as it comes, chunk_rows
+        points per write (see stream()); close the table at the end of the
+        sweep to write the last ones.
+        Returns: the Table
+        '''
+        info = dict(self.metadata, parameter=self.parameter, capacity=self.capacity)
+        info.update(metadata or {})
+        table = store.create_table(name, self.columns, metadata=info, chunk_rows=chunk_rows if stream else None)
+        if stream:
+            self.stream(table)
+        else:
+            table.extend(**{column: self[column] for column in self.columns})
+        table.flush()
+        return table
+
+
+class MapResult(object):
+    '''
+    X and Y maps of a make2D scan, indexed [frequency, field].
+
+    Parameters:
+    frequencies (array): Frequency axis (GHz).
+    fields (array): Field axis (Oe).
+    primary (str): 'frequency' (one field sweep per frequency, rows) or
+        'field' (one frequency sweep per field, columns).
+    metadata (dict): Free form description of the scan.
+
+    Z holds the plotted / saved channel (possibly integrated). Points not
+    measured (e.g. outside the window of a tracked scan) stay NaN, see
+    measured and masked(). resonance holds the line found in every line
+    of a tracked scan (NaN if none).
+    '''
+
+    def __init__(self, frequencies, fields, primary='frequency', metadata=None):
+        self.frequencies = np.asarray(frequencies, dtype=float)
+        self.fields = np.asarray(fields, dtype=float)
+        self.primary = primary
+        self.metadata = dict(metadata or {})
+        shape = (len(self.frequencies), len(self.fields))
+        self.X = np.full(shape, np.nan)
+        self.Y = np.full(shape, np.nan)
+        self.Z = np.full(shape, np.nan)
+        self.done = np.zeros(shape[0] if primary == 'frequency' else shape[1], dtype=bool)
+        self.resonance = np.full(len(self.done), np.nan)
+
+    def __str__(self):
+        return 'MapResult : %d x %d, %d of %d lines' % (
+            self.X.shape[0], self.X.shape[1], self.done.sum(), len(self.done))
+
+    def line(self, i):
+        '''Index of line i (a row for primary='frequency', a column otherwise)'''
+        if self.primary == 'frequency':
+            return np.s_[i, :]
+        return np.s_[:, i]
+
+    def set_line(self, i, X, Y, Z=None):
+        index = self.line(i)
+        self.X[index] = X
+        self.Y[index] = Y
+        self.Z[index] = X if Z is None else Z
+        self.done[i] = True
+
+    def channel(self, name):
+        return {'X': self.X, 'Y': self.Y, 'Z': self.Z}[name]
+
+    @property
+    def measured(self):
+        '''Boolean map of the measured points'''
+        return np.isfinite(self.X)
+
+    @property
+    def coverage(self):
+        '''Fraction of the map measured'''
+        return self.measured.mean()
+
+    def masked(self, name='Z'):
+        '''Channel name as a masked array (unmeasured points masked)'''
+        return np.ma.masked_invalid(self.channel(name))
+
+    def create_table(self, store, name, metadata=None):
+        '''
+        Adds an empty table name to a RunStore for the lines of this map :
+        one row per line with columns line (index), X, Y, Z and resonance.
+        The axes go to the table metadata. Fill it with store_line().
+        Returns: the Table
+        '''
+        n = len(self.fields) if self.primary == 'frequency' else len(self.frequencies)
+        info = dict(self.metadata, primary=self.primary, frequencies=self.frequencies, fields=self.fields)
+        info.update(metadata or {})
+        # Every line is written as soon as it is stored
+        return store.create_table(name, {'line': ('i4', ()), 'X': 'f8', 'Y': 'f8', 'Z': 'f8',
+                                         'resonance': ('f8', ())}, row_shape=(n,), metadata=info,
+                                  chunk_rows=1)
+
+    def store_line(self, table, i):
+        '''Appends line i to a table made by create_table'''
+        index = self.line(i)
+        table.append(line=i, X=self.X[index], Y=self.Y[index], Z=self.Z[index],
+                     resonance=self.resonance[i])
+
+    @classmethod
+    def from_table(cls, table):
+        '''MapResult of the lines stored in a RunStore table (in memory)'''
+        info = table.metadata
+        result = cls(info['frequencies'], info['fields'], info['primary'],
+                     metadata={k: v for k, v in info.items() if k not in ['frequencies', 'fields', 'primary']})
+        lines = np.asarray(table['line'])
+        X, Y, Z, resonance = table['X'], table['Y'], table['Z'], table['resonance']
+        for row, i in enumerate(lines):
+            result.set_line(i, X[row], Y[row], Z[row])
+            result.resonance[i] = resonance[row]
+        return result
@@ -0,0 +1,11 @@
+# coding=utf-8
+
+# The modules live at the repository root, figures go to the Agg canvas
+
+import os
+import sys
+
+import matplotlib
+matplotlib.use('Agg')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
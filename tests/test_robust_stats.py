@@ -0,0 +1,28 @@
+# coding=utf-8
+
+import numpy as np
+import pytest
+
+from robust_stats import trimmed_mean, interquartile_mean
+
+
+@pytest.mark.parametrize('values, expected', [([3.0], 3.0), ([1.0, 3.0], 2.0), ([1.0, 2.0, 6.0], 3.0)])
+def test_iqm_few_samples(values, expected):
+    value, error = interquartile_mean(values)
+    assert value == pytest.approx(expected)
+    assert np.isfinite(error)
+
+
+def test_iqm_trims_by_index():
+    value, _ = interquartile_mean([100.0, 1.0, 2.0, 3.0, -100.0, 4.0, 5.0, 6.0])
+    assert value == pytest.approx(3.5)
+
+
+def test_iqm_rows():
+    value, _ = interquartile_mean(np.array([[1.0, 3.0], [2.0, 4.0]]))
+    assert value == pytest.approx([2.0, 3.0])
+
+
+def test_trimmed_mean_empty():
+    value, error = trimmed_mean([])
+    assert np.isnan(value) and np.isnan(error)
@@ -0,0 +1,36 @@
+# coding=utf-8
+
+import time
+
+import numpy as np
+import pytest
+
+from benchmark import make_sim_experiment
+from scan_order import ScanCosts, ScanPlan, estimate_scan
+
+FROM0 = 0.5
+
+
+@pytest.fixture
+def experiment(tmp_path, monkeypatch):
+    E, rack = make_sim_experiment(str(tmp_path))
+    E.from0delay = FROM0
+    sleeps = []
+    # Recorded, not slept : only make2D's line start waits are not 0
+    monkeypatch.setattr(time, 'sleep', lambda s: sleeps.append(s))
+    yield E, sleeps
+    E.close()
+
+
+@pytest.mark.parametrize('fields', [np.linspace(0, 300, 7), np.linspace(200, 500, 7)])
+@pytest.mark.parametrize('traversal', ['raster', 'serpentine'])
+@pytest.mark.parametrize('magnet', ['reset', 'hold'])
+def test_estimate_matches_make2D_waits(experiment, tmp_path, fields, traversal, magnet):
+    E, sleeps = experiment
+    frequencies = np.linspace(5, 6, 4)
+    costs = ScanCosts(field_point_s=0, frequency_point_s=0, from0_s=FROM0, line_s=0)
+    estimate = estimate_scan(frequencies, fields, costs, 'field', traversal, magnet)
+    plan = ScanPlan('field', traversal, magnet, [], costs)
+    E.make2D(frequencies, fields, str(tmp_path), schedule=plan)
+    # The PS programs currents to 0.1 mA
+    assert sum(s for s in sleeps if s > 0) == pytest.approx(estimate, rel=1E-3)
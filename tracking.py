@@ -0,0 +1,129 @@
+# coding=utf-8
+
+# Resonance tracking for make2D.
+#
+# The in-plane Kittel relation f**2 = gyro**2 * H * (H + Meff) is linear in
+# (gyro**2, gyro**2 * Meff), so the resonance fields found in the rows
+# measured so far give the curve by plain least squares, and the curve
+# predicts where the next row's line is. Only a window around the
+# prediction is swept; if the line is not inside, the window is widened and
+# finally the whole row is measured.
+#
+# Usage :
+#     E.make2D(frequencies, fields, save_dir, track=ResonanceTracker(window=300))
+
+import numpy as np
+
+__all__ = ['kittel_field', 'fit_kittel', 'locate_resonance', 'ResonanceTracker']
+
+
+def kittel_field(frequency, gyro, Meff):
+    '''In-plane Kittel resonance field (Oe) at frequency (GHz), gyro in GHz/Oe'''
+    half_M = Meff / 2.0
+    return -half_M + np.sqrt(half_M**2 + (np.asarray(frequency) / gyro)**2)
+
+
+def fit_kittel(frequencies, fields, gyro=0.0028):
+    '''
+    Least squares (gyro, Meff) of the in-plane Kittel relation.
+    With a single point only Meff is fitted, gyro is kept.
+    '''
+    f = np.asarray(frequencies, dtype=float)
+    H = np.asarray(fields, dtype=float)
+    if len(f) >= 2:
+        (a, b), _, rank, _ = np.linalg.lstsq(np.column_stack([H**2, H]), f**2, rcond=None)
+        if rank == 2 and a > 0:
+            return np.sqrt(a), b / a
+    a = gyro**2
+    return gyro, np.mean((f**2 / a - H**2) / H)
+
+
+def locate_resonance(fields, X, Y, min_snr=8):
+    '''
+    Resonance field of a (derivative) line: midway between the extrema of the
+    stronger channel. None if the line is weaker than min_snr times the
+    noise, or if an extremum is on the edge of the measured range (the line
+    is not fully inside).
+    '''
+    fields = np.asarray(fields, dtype=float)
+    if len(fields) < 5:
+        return None
+    best = None
+    for y in (np.asarray(X, dtype=float), np.asarray(Y, dtype=float)):
+        span = np.ptp(y)
+        if best is None or span > best[0]:
+            best = (span, y)
+    span, y = best
+    d = np.diff(y)
+    noise = 1.4826 * np.median(np.abs(d - np.median(d))) / np.sqrt(2)
+    if span <= min_snr * max(noise, 1E-300):
+        return None
+    i_max, i_min = np.argmax(y), np.argmin(y)
+    last = len(y) - 1
+    if i_max in (0, last) or i_min in (0, last):
+        return None
+    return 0.5 * (fields[i_max] + fields[i_min])
+
+
+class ResonanceTracker(object):
+    '''
+    Predicts the resonance field of the next make2D row.
+
+    Parameters:
+    window (float): Field window (Oe, full width) swept around the prediction.
+    widen (float): Factor applied to the window when the line is not found.
+    max_widen (int): Number of wider windows tried before the full row.
+    min_snr (float): See locate_resonance.
+    gyro (float): Gyromagnetic ratio (GHz/Oe) used until two lines are found.
+
+    After the scan frequencies / resonances hold the lines found.
+    '''
+
+    def __init__(self, window=300, widen=2, max_widen=1, min_snr=8, gyro=0.0028):
+        self.window = window
+        self.widen = widen
+        self.max_widen = max_widen
+        self.min_snr = min_snr
+        self.gyro = gyro
+        self.reset()
+
+    def __str__(self):
+        return 'ResonanceTracker : %.4g Oe window, %d lines found' % (self.window, len(self.frequencies))
+
+    def reset(self):
+        self.frequencies = []
+        self.resonances = []
+
+    def add(self, frequency, field):
+        self.frequencies.append(frequency)
+        self.resonances.append(field)
+
+    def fit(self):
+        '''(gyro, Meff) of the lines found, None before the first one'''
+        if not self.frequencies:
+            return None
+        return fit_kittel(self.frequencies, self.resonances, self.gyro)
+
+    def predict(self, frequency):
+        '''Predicted resonance field (Oe) at frequency, None if unknown'''
+        params = self.fit()
+        if params is None:
+            return None
+        field = kittel_field(frequency, *params)
+        return float(field) if np.isfinite(field) else None
+
+    def windows(self, frequency):
+        '''
+        Field windows (centre, full width) to try at frequency, the last one
+        (None) meaning the whole row.
+        '''
+        centre = self.predict(frequency)
+        if centre is not None:
+            width = self.window
+            for _ in range(self.max_widen + 1):
+                yield centre, width
+                width *= self.widen
+        yield None
+
+    def locate(self, fields, X, Y):
+        return locate_resonance(fields, X, Y, self.min_snr)